@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк класса Database на синтетических данных разного масштаба.
+
+Для каждого масштаба (число пользователей) один раз строится шаблон БД:
+пользователи, used_photos, comments_log и withdrawals в пропорциях PER_USER.
+Шаблоны кэшируются в --data-dir; каждый прогон работает на свежей копии,
+поэтому изменяющие методы (add_comment, weekly_decrement_comments) не портят
+следующие замеры и цифры разных версий сравнимы.
+
+Результат — строки JSON (первая — описание окружения), по строке на метод:
+
+    python bench_db.py --scales 10000,100000 --out bench.jsonl
+    python bench_db.py --scales 1000000 --only broadcast,stats --repeat 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List
+
+import bot
+
+# Строк на одного пользователя в остальных таблицах
+PER_USER = {'used_photos': 2, 'comments_log': 5, 'withdrawals': 0.1}
+CHUNK = 50_000
+FIRST_USER_ID = 100_000_000
+BROADCAST_COUNT = 1000
+# Тяжёлые методы меняют всю таблицу — достаточно одного замера
+SINGLE_RUN = {'weekly_decrement_comments', 'reconcile_ledger'}
+DAY = 86400
+
+
+def _chunks(total: int, make_row):
+    for start in range(0, total, CHUNK):
+        yield [make_row(i) for i in range(start, min(total, start + CHUNK))]
+
+
+def build_template(path: str, users: int, seed: int):
+    """Схему создаёт сам Database, данные льются напрямую пачками executemany"""
+    bot.Database(path).executor.shutdown()
+    rng = random.Random(seed)
+    now = int(time.time())
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA synchronous=OFF')
+
+    def user_row(i):
+        balance = rng.randint(0, 40)
+        return (
+            FIRST_USER_ID + i, f"user{i}", f"Имя{i % 5000}", f"Фамилия{i % 7000}",
+            now - rng.randint(0, 365) * DAY, now - rng.randint(0, 100_000) * 60,
+            balance, rng.randint(0, 5000), rng.randint(0, 200), balance + rng.randint(0, 100),
+            balance < bot.config.COMMENT_THRESHOLD, False, rng.random() < 0.9, None, rng.random() < 0.01,
+        )
+    for rows in _chunks(users, user_row):
+        conn.executemany('''
+            INSERT INTO users (user_id, username, first_name, last_name, registration_date, last_activity,
+                               comment_balance, money_balance, tasks_completed, total_comments_ever,
+                               is_blocked, is_admin, accepted_rules, last_task_date, is_permanently_banned)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        conn.commit()
+    conn.execute('''
+        INSERT INTO ledger (user_id, amount, held, kind, created_at)
+        SELECT user_id, money_balance, 0, 'opening', ? FROM users WHERE money_balance != 0
+    ''', (now,))
+    conn.commit()
+
+    def random_user():
+        return FIRST_USER_ID + rng.randrange(users)
+
+    for rows in _chunks(int(users * PER_USER['used_photos']), lambda i: (
+            random_user(), f"{i:064x}", now - rng.randint(0, 500_000) * 60)):
+        conn.executemany("INSERT INTO used_photos (user_id, photo_hash, timestamp) VALUES (?, ?, ?)", rows)
+        conn.commit()
+
+    weekly: Counter = Counter()
+    monthly: Counter = Counter()
+
+    def comment_row(i):
+        ts = now - rng.randint(0, 500_000) * 60
+        moment = datetime.fromtimestamp(ts)
+        user_id = random_user()
+        weekly[(bot.year_week(moment), user_id)] += 1
+        monthly[(bot.year_month(moment), user_id)] += 1
+        return user_id, ts, moment.isocalendar()[1], moment.month
+    for rows in _chunks(int(users * PER_USER['comments_log']), comment_row):
+        conn.executemany("INSERT INTO comments_log (user_id, timestamp, week_number, month_number) VALUES (?, ?, ?, ?)", rows)
+        conn.commit()
+    conn.executemany("INSERT INTO comments_weekly (year_week, user_id, comments) VALUES (?, ?, ?)",
+                     [key + (n,) for key, n in weekly.items()])
+    conn.executemany("INSERT INTO comments_monthly (year_month, user_id, comments) VALUES (?, ?, ?)",
+                     [key + (n,) for key, n in monthly.items()])
+
+    def withdrawal_row(i):
+        status = rng.choices(['pending', 'approved', 'rejected'], [1, 8, 1])[0]
+        return random_user(), rng.randint(100, 5000), rng.choice(['card', 'phone']), '+79990000000', status, now
+    for rows in _chunks(int(users * PER_USER['withdrawals']), withdrawal_row):
+        conn.executemany("INSERT INTO withdrawals (user_id, amount, method, details, status, created_at) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        conn.commit()
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+
+
+def cases(users: int, rng: random.Random) -> List[tuple]:
+    """(группа, имя, фабрика аргументов); аргументы берутся заново на каждый замер"""
+    def user_id():
+        return FIRST_USER_ID + rng.randrange(users)
+    result = [
+        ('users', 'get_user', lambda: (user_id(),)),
+        ('users', 'add_comment', lambda: (user_id(),)),
+        ('users', 'check_photo_hash', lambda: (f"{rng.randrange(users * 4):064x}",)),
+        ('search', 'search_users[id]', lambda: (str(user_id()),)),
+        ('search', 'search_users[name]', lambda: (f"Имя{rng.randrange(5000)}",)),
+        ('stats', 'get_total_users', tuple),
+        ('stats', 'get_active_users', tuple),
+        ('stats', 'get_blocked_users', tuple),
+        ('stats', 'get_permanently_banned_users', tuple),
+        ('stats', 'get_total_unique_photos', tuple),
+        ('stats', 'get_withdrawal_stats', tuple),
+        ('stats', 'get_comment_activity', tuple),
+        ('users', 'get_user_comment_activity', lambda: (user_id(),)),
+        ('stats', 'get_top_comment_balance', tuple),
+        ('stats', 'get_top_tasks_completed', tuple),
+        ('users', 'get_rank[comment_balance]', lambda: ('comment_balance', rng.randint(0, 40))),
+        ('stats', 'get_pending_withdrawals_page', lambda: (0, None, bot.config.WITHDRAW_PAGE_SIZE)),
+        ('stats', 'get_pending_withdrawals_summary', lambda: (1, 1)),
+        ('stats', 'reconcile_ledger', tuple),
+        ('broadcast', 'get_all_user_ids', tuple),
+    ]
+    for target in ('all', 'top_active', 'top_inactive', 'random', 'blocked', 'unblocked'):
+        result.append(('broadcast', f'get_users_for_broadcast[{target}]', lambda t=target: (t, BROADCAST_COUNT)))
+    result.append(('weekly', 'weekly_decrement_comments', tuple))
+    return result
+
+
+def _rows(result) -> int:
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    return 1 if result is not None else 0
+
+
+async def bench_scale(path: str, users: int, repeat: int, only: List[str], seed: int) -> List[Dict]:
+    db = bot.Database(path)
+    rng = random.Random(seed)
+    results = []
+    try:
+        for group, name, make_args in cases(users, rng):
+            if only and not any(word == group or word in name for word in only):
+                continue
+            method = getattr(db, name.split('[')[0])
+            runs = 1 if name in SINGLE_RUN else repeat
+            timings = []
+            rows = 0
+            for _ in range(runs):
+                args = make_args()
+                started = time.perf_counter()
+                rows = _rows(await method(*args))
+                timings.append(time.perf_counter() - started)
+            timings.sort()
+            results.append({
+                'scale': users,
+                'group': group,
+                'method': name,
+                'runs': runs,
+                'rows': rows,
+                'min_ms': round(timings[0] * 1000, 3),
+                'median_ms': round(statistics.median(timings) * 1000, 3),
+                'p95_ms': round(timings[min(runs - 1, int(runs * 0.95))] * 1000, 3),
+                'max_ms': round(timings[-1] * 1000, 3),
+            })
+    finally:
+        await db.close()
+    return results
+
+
+def environment() -> Dict:
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {
+        'kind': 'environment',
+        'revision': revision,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(),
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='10000,100000,1000000', help='числа пользователей через запятую')
+    parser.add_argument('--repeat', type=int, default=20, help='замеров на метод')
+    parser.add_argument('--only', default='', help='группы или методы через запятую (users, search, stats, broadcast, weekly)')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'rudeps-bench-db'),
+                        help='кэш шаблонов БД')
+    parser.add_argument('--out', help='файл для строк JSON (по умолчанию stdout)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    only = [word for word in args.only.split(',') if word]
+    os.makedirs(args.data_dir, exist_ok=True)
+
+    out = open(args.out, 'w', encoding='utf-8') if args.out else None
+    def emit(record: Dict):
+        line = json.dumps(record, ensure_ascii=False)
+        print(line, flush=True)
+        if out:
+            out.write(line + '\n')
+            out.flush()
+
+    emit(environment())
+    for users in (int(s) for s in args.scales.split(',')):
+        # Версия схемы в имени: шаблон старой схемы не подхватывается
+        template = os.path.join(args.data_dir, f"template_v{len(bot.MIGRATIONS)}_{users}_{args.seed}.db")
+        if not os.path.exists(template):
+            started = time.perf_counter()
+            build_template(template + '.tmp', users, args.seed)
+            os.replace(template + '.tmp', template)
+            emit({'kind': 'build', 'scale': users, 'seconds': round(time.perf_counter() - started, 1),
+                  'size_bytes': os.path.getsize(template)})
+        workdir = tempfile.mkdtemp(prefix='rudeps-bench-')
+        path = os.path.join(workdir, 'bench.db')
+        shutil.copy(template, path)
+        try:
+            for record in asyncio.run(bench_scale(path, users, args.repeat, only, args.seed)):
+                emit({'kind': 'method', **record})
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if out:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Пропускная способность RudepsBot в зависимости от числа процессов-воркеров.
+
+Для каждого N от 1 до --max-workers запускает прогон fake_telegram.py
+(BOT_WORKERS=N) с одинаковой нагрузкой и печатает по строке JSON на прогон:
+
+    python bench_workers.py --max-workers 4 --users 300 --duration 20
+"""
+
+import argparse
+import asyncio
+import json
+
+import fake_telegram
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-workers', type=int, default=4)
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default='webhook')
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--duration', type=float, default=20)
+    # Пауза меньше ~0.35 с упирается в RATE_LIMIT_USER_RATE и превращается в таймауты
+    parser.add_argument('--think', type=float, default=0.4, help='пауза пользователя между действиями')
+    args = parser.parse_args()
+    baseline = None
+    for workers in range(1, args.max_workers + 1):
+        run_args = argparse.Namespace(mode=args.mode, workers=workers, users=args.users,
+                                      duration=args.duration, think=args.think)
+        result = asyncio.run(fake_telegram.run(run_args))
+        baseline = baseline or result['updates_per_s'] or 1
+        print(json.dumps({
+            'workers': workers,
+            'updates_per_s': result['updates_per_s'],
+            'speedup': round(result['updates_per_s'] / baseline, 2),
+            'p50_ms': result['p50_ms'],
+            'p99_ms': result['p99_ms'],
+            'errors': result['errors'],
+        }, ensure_ascii=False), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,26 +8,52 @@ RudepsBot v4.1 - Исправленная версия:
 """
 
 import asyncio
+import atexit
+import gc
+import itertools
 import logging
+import multiprocessing
+import queue
+import random
+import re
+import signal
 import sqlite3
 import os
+import sys
+import threading
 import time
+import traceback
+import tracemalloc
+import glob
+import gzip
 import hashlib
-import aiofiles
-from datetime import datetime
+import hmac
+import json
+import csv
+import io
+import tempfile
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
 from typing import Optional, Dict, List, Tuple, Any, Union
+from collections import Counter, deque
 from contextlib import contextmanager
+from contextvars import ContextVar
 from dataclasses import dataclass, field
 from enum import Enum
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from concurrent.futures import ThreadPoolExecutor
 
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.types import (
     ParseMode, ReplyKeyboardMarkup, KeyboardButton,
     InlineKeyboardMarkup, InlineKeyboardButton
 )
 from aiogram.dispatcher.filters import Text
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
 import aioschedule
 
 # ==================== КОНФИГУРАЦИЯ ====================
@@ -43,14 +69,106 @@ class Config:
     BOT_NAME: str = "RudepsBot"
     DATABASE_FILE: str = "bot_database.db"
     LOG_FILE: str = "bot.log"
+    # Формат лога: 'text' или 'json' (с user_id, update_id и именем хэндлера)
+    LOG_FORMAT: str = os.environ.get('LOG_FORMAT', 'text')
+    LOG_QUEUE_SIZE: int = 10000              # записей в очереди к потоку записи, лишние отбрасываются
+    LOG_ERROR_BURST: int = 5                 # одинаковых предупреждений/ошибок за окно, остальные подавляются
+    LOG_ERROR_WINDOW: float = 60.0
     MIN_WITHDRAW_CARD: int = 150
+    WITHDRAW_PAGE_SIZE: int = 5              # заявок на одной странице просмотра у админа
     MIN_WITHDRAW_PHONE: int = 100
     WEEKLY_COMMENT_DECREMENT: int = 10
     COMMENT_THRESHOLD: int = 10
     ANTIFLOOD_SECONDS: int = 1               # изменено с 10 на 1
+    RATE_LIMIT_USER_RATE: float = 3.0        # апдейтов в секунду на пользователя (все хэндлеры)
+    RATE_LIMIT_USER_BURST: int = 8
+    RATE_LIMIT_MENU_RATE: float = 2.0        # кнопки главного меню
+    RATE_LIMIT_MENU_BURST: int = 4
+    RATE_LIMIT_TASK_RATE: float = 1.0        # выполнение задания
+    RATE_LIMIT_TASK_BURST: int = 2
+    RATE_LIMIT_IDLE_TTL: int = 120           # простаивающие bucket'ы удаляются через столько секунд
     SCHEDULE_TIME: str = "00:00"
+    MAINTENANCE_TIME: str = "04:00"          # ежедневное обслуживание БД (чистка comments_log)
+    # Сырые строки comments_log старше горизонта удаляются пачками (отчёты читают сводки); 0 — хранить всё
+    COMMENTS_LOG_RETENTION_DAYS: int = int(os.environ.get('COMMENTS_LOG_RETENTION_DAYS', '0'))
+    COMMENTS_LOG_ARCHIVE: str = os.environ.get('COMMENTS_LOG_ARCHIVE', '')   # SQLite-файл архива; пусто — без архива
+    COMMENTS_LOG_PURGE_CHUNK: int = 5000
+    # Ежедневная сверка money_balance/money_held с денежным журналом (только отчёт в лог)
+    LEDGER_RECONCILE: bool = os.environ.get('LEDGER_RECONCILE', '1') == '1'
+    # Онлайн-бэкап БД через backup API SQLite, бот не останавливается; пусто — выключен.
+    # Снимки <имя БД>-<дата>-<время>.db.gz, хранятся последние BACKUP_KEEP
+    BACKUP_DIR: str = os.environ.get('BACKUP_DIR', '')
+    BACKUP_TIME: str = os.environ.get('BACKUP_TIME', '03:30')
+    BACKUP_KEEP: int = int(os.environ.get('BACKUP_KEEP', '7'))
+    BACKUP_STEP_PAGES: int = 256             # страниц за шаг — столько длится одна блокировка чтения
+    BACKUP_STEP_PAUSE: float = 0.01          # пауза между шагами, чтобы писатели не ждали
+    BACKUP_MAX_RESTARTS: int = 5             # перезапусков из-за записей в БД, дальше — копия одним шагом
+    # Экспорт пользователей: CSV в gzip частями не больше лимита документа Bot API (50 МБ)
+    EXPORT_PAGE_SIZE: int = 5000             # строк users за один запрос
+    EXPORT_PART_BYTES: int = 45 * 1024 * 1024
+    EXPORT_SPOOL_BYTES: int = 4 * 1024 * 1024   # часть больше этого уходит из памяти во временный файл
+    # Массовые корректировки балансов из CSV (user_id, комментарии, рубли, примечание)
+    BULK_BALANCE_CHUNK: int = 500            # строк файла в одной транзакции
+    BULK_BALANCE_MAX_ROWS: int = 200_000
+    BULK_BALANCE_MAX_BYTES: int = 20 * 1024 * 1024   # больше getFile Bot API не отдаёт
+    # Рейтинги по comment_balance и tasks_completed в памяти процесса
+    LEADERBOARD_SIZE: int = 100              # первых мест в памяти (в статистике админа — 10)
+    # Секунд до перестроения из индекса: так подхватываются записи других воркеров
+    LEADERBOARD_REFRESH: int = int(os.environ.get('LEADERBOARD_REFRESH', '300'))
     MAX_PHOTO_SIZE_MB: int = 20
     MAX_PHOTO_SIZE: int = 20 * 1024 * 1024
+    PHOTO_CHAT_ACTION_DELAY: float = 0.5     # если фото обрабатывается дольше — показываем «печатает…»
+    # Адрес Bot API (пусто — официальный сервер; для локального Bot API или тестового стенда)
+    API_SERVER: str = os.environ.get('TELEGRAM_API_SERVER', '')
+    # Режим приёма апдейтов: 'polling' или 'webhook'
+    MODE: str = os.environ.get('BOT_MODE', 'polling')
+    # Публичный https-адрес за TLS-терминатором (nginx и т.п.); пусто — setWebhook не вызывается
+    WEBHOOK_URL: str = os.environ.get('WEBHOOK_URL', '')
+    WEBHOOK_PATH: str = os.environ.get('WEBHOOK_PATH', '/webhook')
+    WEBHOOK_SECRET: str = os.environ.get('WEBHOOK_SECRET', '')
+    # Сам бот слушает обычный HTTP на локальном интерфейсе, TLS снимает прокси
+    WEBAPP_HOST: str = os.environ.get('WEBAPP_HOST', '127.0.0.1')
+    WEBAPP_PORT: int = int(os.environ.get('WEBAPP_PORT', '8080'))
+    WEBHOOK_MAX_CONNECTIONS: int = 40
+    WEBHOOK_QUEUE_SIZE: int = 1000           # при переполнении отвечаем 503, Telegram повторит доставку
+    WEBHOOK_WORKERS: int = 32
+    # >1 — супервизор принимает апдейты и раздаёт их процессам-воркерам по user_id
+    WORKERS: int = int(os.environ.get('BOT_WORKERS', '1'))
+    WORKER_QUEUE_SIZE: int = 1000
+    MAILBOX_MAX_PENDING: int = 20            # апдейтов в очереди одного пользователя, лишние отбрасываются
+    MAX_CONCURRENT_UPDATES: int = 256        # одновременно обрабатываемых апдейтов (разных пользователей)
+    # Классы приоритета приёма: (макс. длина очереди, макс. ожидание в секундах)
+    INTAKE_LANES: Dict[str, Tuple[int, float]] = field(default_factory=lambda: {
+        'admin': (1000, 300.0),
+        'callback': (500, 10.0),
+        'text': (2000, 15.0),
+        'photo': (1000, 30.0),
+    })
+    # Дедлайн мягкой остановки: приём, дообработка апдейтов и фоновых задач.
+    # Должен быть меньше таймаута принудительного убийства (systemd TimeoutStopSec и т.п.)
+    SHUTDOWN_DRAIN_TIMEOUT: float = 20.0
+    # Эндпоинт /metrics для Prometheus; 0 — метрики выключены.
+    # В режиме воркеров супервизор слушает METRICS_PORT, воркер i — METRICS_PORT + 1 + i
+    METRICS_PORT: int = int(os.environ.get('METRICS_PORT', '0'))
+    METRICS_HOST: str = os.environ.get('METRICS_HOST', '127.0.0.1')
+    # Профилирование SQL: запросы дольше порога пишутся в лог с планом; 0 — выключено
+    SLOW_QUERY_MS: float = float(os.environ.get('SLOW_QUERY_MS', '0'))
+    SLOW_QUERY_TOP: int = 15                 # сколько запросов показывать в /queries
+    DEBUG_MEMORY_TOP: int = 15               # строк топа аллокаций в /debug mem
+    # Монитор event loop'а: блокировка дольше порога пишется в лог со стеком; 0 — выключен
+    LOOP_STALL_MS: float = float(os.environ.get('LOOP_STALL_MS', '0'))
+    LOOP_LAG_INTERVAL: float = 0.1
+    # Трассировка апдейтов (Chrome Trace Event: chrome://tracing, Perfetto); пусто — выключена.
+    # Воркеры пишут в <имя>.worker<i><расширение>
+    TRACE_FILE: str = os.environ.get('TRACE_FILE', '')
+    TRACE_SAMPLE: float = float(os.environ.get('TRACE_SAMPLE', '1.0'))   # доля трассируемых апдейтов
+    # Запись входящих апдейтов для replay.py (анонимизированная); пусто — выключена.
+    # Соль анонимизации по умолчанию — токен бота; replay.py должен получить ту же
+    RECORD_FILE: str = os.environ.get('RECORD_FILE', '')
+    RECORD_SALT: str = os.environ.get('RECORD_SALT', '')
+    STATE_DB_FILE: str = "bot_states.db"
+    STATE_FLUSH_INTERVAL: float = 1.0        # секунды между пакетными записями состояний
+    STATE_FLUSH_BATCH: int = 500             # досрочная запись при таком числе изменений
 
     def __post_init__(self):
         if not self.BOT_TOKEN:
@@ -74,94 +192,515 @@ class UserState(Enum):
     MANAGE_BALANCES_SEARCH = "manage_balances_search"
     MANAGE_BALANCES_ACTIONS = "manage_balances_actions"
     WAITING_REJECT_REASON = "waiting_reject_reason"
+    EXPORT_OPTIONS = "export_options"
+    WITHDRAW_BULK_FILTER = "withdraw_bulk_filter"
+    BALANCE_CSV_CONFIRM = "balance_csv_confirm"
+
+MENU_BUTTONS = [
+    "📝 Проверить комментарий", "💰 Мой баланс", "💎 Вывод средств",
+    "📊 Статистика", "❓ Помощь"
+]
 
 # ==================== БАЗА ДАННЫХ ====================
 
+_WRITE_QUERY_RE = re.compile(r'^\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b', re.IGNORECASE)
+_QUERY_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+(\w+)', re.IGNORECASE)
+_query_labels: Dict[str, str] = {}
+_QUERY_LABELS_MAX = 1024
+
+def query_label(query: str) -> str:
+    """Метка запроса для метрик: «SELECT users». Кэш по тексту запроса ограничен
+    _QUERY_LABELS_MAX: запросы со списками IN (?, ?, ...) разной длины сверх него
+    размечаются заново при каждом вызове"""
+    label = _query_labels.get(query)
+    if label is None:
+        words = query.split(None, 1)
+        table = _QUERY_TABLE_RE.search(query)
+        label = ' '.join(filter(None, [words[0].upper() if words else '', table.group(1) if table else '']))
+        if len(_query_labels) < _QUERY_LABELS_MAX:
+            _query_labels[query] = label
+    return label
+
+_SQL_SPACES_RE = re.compile(r'\s+')
+_SQL_PLACEHOLDER_LIST_RE = re.compile(r'\?(?:\s*,\s*\?)+')
+
+def normalize_query(query: str) -> str:
+    """Форма запроса: без переводов строк и с одинаковым видом списков IN (?, ?, ...)"""
+    return _SQL_PLACEHOLDER_LIST_RE.sub('?, ...', _SQL_SPACES_RE.sub(' ', query).strip())
+
+def describe_params(params: tuple) -> str:
+    """Параметры запроса для лога без значений (в них реквизиты и тексты пользователей):
+    число и типы, подряд идущие одинаковые типы схлопываются — «3: int×2, str»"""
+    names = [type(p).__name__ for p in params]
+    runs = [(name, len(list(group))) for name, group in itertools.groupby(names)]
+    return f"{len(names)}: " + ', '.join(name if count == 1 else f"{name}×{count}" for name, count in runs)
+
+class QueryProfiler:
+    """Время каждого SQL-запроса по формам; медленные — в лог, EXPLAIN QUERY PLAN один раз на форму.
+
+    record() вызывается из потоков executor'а, поэтому статистика под блокировкой.
+    """
+    def __init__(self, logger, slow_ms: float):
+        self.logger = logger
+        self.slow_seconds = slow_ms / 1000
+        self._lock = threading.Lock()
+        # форма -> [число запросов, суммарное время, максимум]
+        self._stats: Dict[str, list] = {}
+        # форма -> план первого медленного выполнения
+        self._plans: Dict[str, List[str]] = {}
+
+    def record(self, conn: Optional[sqlite3.Connection], query: str, params: tuple, seconds: float):
+        shape = normalize_query(query)
+        with self._lock:
+            stat = self._stats.get(shape)
+            if stat is None:
+                stat = self._stats[shape] = [0, 0.0, 0.0]
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+            if seconds < self.slow_seconds:
+                return
+            explain = conn is not None and shape not in self._plans
+            if explain:
+                self._plans[shape] = []
+        self.logger.warning(f"Медленный запрос {seconds * 1000:.1f} мс: {shape} | параметры: {describe_params(params)}")
+        if explain:
+            self._explain(conn, query, params, shape)
+
+    def _explain(self, conn: sqlite3.Connection, query: str, params: tuple, shape: str):
+        try:
+            plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params)]
+        except sqlite3.Error as e:
+            plan = [f"EXPLAIN не удался: {e}"]
+        with self._lock:
+            self._plans[shape] = plan
+        level = self.logger.warning if self.has_full_scan(plan) else self.logger.info
+        level(f"План запроса {shape}: {'; '.join(plan)}")
+
+    @staticmethod
+    def has_full_scan(plan: List[str]) -> bool:
+        # «SCAN users» — полный просмотр таблицы; «SEARCH ... USING INDEX» — поиск по индексу
+        return any(step.startswith('SCAN') and 'COVERING INDEX' not in step for step in plan)
+
+    def top(self, limit: int) -> List[Dict]:
+        """Формы запросов по суммарному времени, самые дорогие первыми"""
+        with self._lock:
+            items = sorted(self._stats.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+            return [{
+                'query': shape, 'count': count, 'total': total, 'max': max_time,
+                'full_scan': self.has_full_scan(self._plans.get(shape, [])),
+            } for shape, (count, total, max_time) in items]
+
+def year_week(moment: datetime) -> int:
+    """ISO-неделя с годом: 202642"""
+    iso = moment.isocalendar()
+    return iso[0] * 100 + iso[1]
+
+def year_month(moment: datetime) -> int:
+    return moment.year * 100 + moment.month
+
+# ---------- миграции схемы ----------
+# Версия схемы — PRAGMA user_version: шаг MIGRATIONS[i] переводит базу из версии i в i + 1.
+# Версия повышается только после шага целиком, поэтому шаги обязаны переживать повторный запуск
+
+MIGRATION_CHUNK = 20000
+
+def _ensure_column(cur: sqlite3.Cursor, table: str, column: str, decl: str):
+    columns = {row[1] for row in cur.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+# year_week() и year_month() в SQL для строк datetime. strftime('%G%V') есть только с SQLite 3.46:
+# год ISO-недели — год её четверга, номер недели — по дню года этого четверга
+_SQL_ISO_THURSDAY = "date(timestamp, '-3 days', 'weekday 4')"
+_SQL_YEAR_WEEK = (f"CAST(strftime('%Y', {_SQL_ISO_THURSDAY}) AS INTEGER) * 100"
+                  f" + (CAST(strftime('%j', {_SQL_ISO_THURSDAY}) AS INTEGER) - 1) / 7 + 1")
+_SQL_YEAR_MONTH = "CAST(strftime('%Y%m', timestamp) AS INTEGER)"
+
+def _backfill_comment_rollups(conn: sqlite3.Connection):
+    """Заполнение сводок из comments_log для баз, созданных до их появления: INSERT ... SELECT
+    с GROUP BY пачками по rowid, коммит после каждой. Пройденная граница пишется в
+    comments_rollup_backfill в той же транзакции — прерванное заполнение продолжается с неё"""
+    conn.execute('CREATE TABLE IF NOT EXISTS comments_rollup_backfill (last_rowid INTEGER NOT NULL)')
+    row = conn.execute('SELECT last_rowid FROM comments_rollup_backfill').fetchone()
+    if row is None:
+        row = (-(1 << 63),)
+        conn.execute('INSERT INTO comments_rollup_backfill (last_rowid) VALUES (?)', row)
+    for low, high in _rowid_ranges(conn, 'comments_log', row[0]):
+        for table, period, expression in (('comments_weekly', 'year_week', _SQL_YEAR_WEEK),
+                                          ('comments_monthly', 'year_month', _SQL_YEAR_MONTH)):
+            conn.execute(f'''
+                INSERT INTO {table} ({period}, user_id, comments)
+                SELECT {expression}, user_id, COUNT(*) FROM comments_log
+                WHERE rowid > ? AND rowid <= ? AND timestamp IS NOT NULL
+                GROUP BY 1, 2
+                ON CONFLICT ({period}, user_id) DO UPDATE SET comments = comments + excluded.comments
+            ''', (low, high))
+        conn.execute('UPDATE comments_rollup_backfill SET last_rowid = ?', (high,))
+        conn.commit()
+    conn.execute('DROP TABLE comments_rollup_backfill')
+
+def _migration_initial_schema(conn: sqlite3.Connection):
+    """Схема на момент появления версий; на старых базах IF NOT EXISTS пропускает готовое.
+    Колонки TIMESTAMP имеют числовое сродство — целые секунды хранятся как INTEGER"""
+    cur = conn.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            registration_date TIMESTAMP,
+            last_activity TIMESTAMP,
+            comment_balance INTEGER DEFAULT 0,
+            money_balance INTEGER DEFAULT 0,
+            tasks_completed INTEGER DEFAULT 0,
+            total_comments_ever INTEGER DEFAULT 0,
+            is_blocked BOOLEAN DEFAULT FALSE,
+            is_admin BOOLEAN DEFAULT FALSE,
+            accepted_rules BOOLEAN DEFAULT FALSE,
+            last_task_date TIMESTAMP,
+            is_permanently_banned BOOLEAN DEFAULT FALSE
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS used_photos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            photo_hash TEXT UNIQUE,
+            timestamp TIMESTAMP
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS comments_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            timestamp TIMESTAMP,
+            week_number INTEGER,
+            month_number INTEGER
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS comments_weekly (
+            year_week INTEGER,
+            user_id INTEGER,
+            comments INTEGER NOT NULL,
+            PRIMARY KEY (year_week, user_id)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS comments_monthly (
+            year_month INTEGER,
+            user_id INTEGER,
+            comments INTEGER NOT NULL,
+            PRIMARY KEY (year_month, user_id)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount INTEGER,
+            method TEXT,
+            details TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP,
+            processed_at TIMESTAMP,
+            reject_reason TEXT
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            target_type TEXT,
+            target_count INTEGER,
+            message_text TEXT,
+            link TEXT,
+            reward_amount INTEGER,
+            sent_count INTEGER,
+            error_count INTEGER,
+            created_at TIMESTAMP
+        )
+    ''')
+    # Колонки, добавленные после первых релизов
+    _ensure_column(cur, 'broadcasts', 'status', "TEXT DEFAULT 'done'")
+    _ensure_column(cur, 'broadcasts', 'pending_user_ids', 'TEXT')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_users_is_permanently_banned ON users(is_permanently_banned)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_withdrawals_status ON withdrawals(status)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_comments_log_user ON comments_log(user_id)')
+    backfill_started = cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'comments_rollup_backfill'").fetchone()
+    if backfill_started or cur.execute('SELECT 1 FROM comments_weekly LIMIT 1').fetchone() is None:
+        _backfill_comment_rollups(conn)
+
+def _rowid_ranges(conn: sqlite3.Connection, table: str, low: int = -(1 << 63)):
+    """Диапазоны (low, high] по MIGRATION_CHUNK строк; последний открыт до максимального rowid"""
+    while True:
+        bound = conn.execute(f"SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT 1 OFFSET ?",
+                             (low, MIGRATION_CHUNK - 1)).fetchone()
+        high = bound[0] if bound else (1 << 63) - 1
+        yield low, high
+        if bound is None:
+            return
+        low = high
+
+def _update_in_chunks(conn: sqlite3.Connection, table: str, assignment: str, condition: str):
+    """UPDATE пачками по rowid с коммитом после каждой: писатель держит блокировку доли секунды,
+    остальные запросы (и другие процессы) успевают между пачками"""
+    for low, high in _rowid_ranges(conn, table):
+        conn.execute(f"UPDATE {table} SET {assignment} WHERE rowid > ? AND rowid <= ? AND ({condition})", (low, high))
+        conn.commit()
+
+_TIMESTAMP_COLUMNS = {
+    'users': ('registration_date', 'last_activity', 'last_task_date'),
+    'used_photos': ('timestamp',),
+    'comments_log': ('timestamp',),
+    'withdrawals': ('created_at', 'processed_at'),
+    'broadcasts': ('created_at',),
+}
+
+def _migration_epoch_timestamps(conn: sqlite3.Connection):
+    """Строки datetime ('2024-05-01 12:00:00.123456', локальное время) -> целые секунды Unix.
+    Меняются только текстовые значения, так что прерванный шаг продолжается с места сбоя"""
+    for table, columns in _TIMESTAMP_COLUMNS.items():
+        assignment = ', '.join(
+            f"{c} = CASE WHEN typeof({c}) = 'text' THEN CAST(strftime('%s', {c}, 'utc') AS INTEGER) ELSE {c} END"
+            for c in columns)
+        condition = ' OR '.join(f"typeof({c}) = 'text'" for c in columns)
+        _update_in_chunks(conn, table, assignment, condition)
+
+def _migration_drop_redundant_indexes(conn: sqlite3.Connection):
+    # photo_hash UNIQUE уже создаёт свой индекс (sqlite_autoindex_used_photos_1)
+    conn.execute('DROP INDEX IF EXISTS idx_used_photos_hash')
+    # week_number без года бесполезен для отчётов — они читают comments_weekly
+    conn.execute('DROP INDEX IF EXISTS idx_comments_log_week')
+
+def _migration_money_ledger(conn: sqlite3.Connection):
+    """Денежный журнал: каждое изменение money_balance/money_held — строка ledger в той же
+    транзакции. Текущие балансы заносятся начальными записями; старые ожидающие заявки
+    остаются с held = 0 — деньги по ним списываются при одобрении, как раньше"""
+    cur = conn.cursor()
+    _ensure_column(cur, 'users', 'money_held', 'INTEGER NOT NULL DEFAULT 0')
+    _ensure_column(cur, 'withdrawals', 'held', 'INTEGER NOT NULL DEFAULT 0')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS ledger (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            held INTEGER NOT NULL DEFAULT 0,
+            kind TEXT NOT NULL,
+            ref_id INTEGER,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger(user_id)')
+    # Вставка и повышение user_version коммитятся вместе — повтор шага не задвоит записи
+    cur.execute('''
+        INSERT INTO ledger (user_id, amount, held, kind, created_at)
+        SELECT user_id, money_balance, 0, 'opening', CAST(strftime('%s', 'now') AS INTEGER)
+        FROM users WHERE money_balance != 0
+    ''')
+
+def _migration_balance_adjustments(conn: sqlite3.Connection):
+    """Аудит массовых корректировок из CSV: строка файла — строка таблицы. batch_id — хэш
+    файла; (batch_id, line) уникальны, поэтому повторная загрузка того же файла
+    применяет только строки, которые ещё не применялись"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS balance_adjustments (
+            id INTEGER PRIMARY KEY,
+            batch_id TEXT NOT NULL,
+            line INTEGER NOT NULL,
+            admin_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            comment_delta INTEGER NOT NULL,
+            money_delta INTEGER NOT NULL,
+            note TEXT,
+            created_at INTEGER NOT NULL,
+            UNIQUE (batch_id, line)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_balance_adjustments_user ON balance_adjustments(user_id)')
+
+def _migration_leaderboard_indexes(conn: sqlite3.Connection):
+    # Частичные индексы под рейтинги: перестроение рейтинга читает индекс, а не всю таблицу
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_comment_balance ON users(comment_balance) WHERE is_permanently_banned = 0')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_tasks_completed ON users(tasks_completed) WHERE is_permanently_banned = 0')
+
+def _migration_broadcast_offsets(conn: sqlite3.Connection):
+    """Список получателей рассылки пишется один раз при создании, прогресс — смещением в нём.
+    Остаток прерванных рассылок переносится в список с нулевым смещением; у рассылок,
+    упавших до первой контрольной точки, списка нет — возобновить их нечем"""
+    cur = conn.cursor()
+    _ensure_column(cur, 'broadcasts', 'recipient_ids', 'TEXT')
+    _ensure_column(cur, 'broadcasts', 'sent_offset', 'INTEGER NOT NULL DEFAULT 0')
+    cur.execute("""UPDATE broadcasts SET recipient_ids = pending_user_ids, sent_offset = 0, pending_user_ids = NULL
+                   WHERE status = 'interrupted' AND pending_user_ids IS NOT NULL""")
+    cur.execute("UPDATE broadcasts SET status = 'done' WHERE status = 'running' AND recipient_ids IS NULL")
+
+MIGRATIONS = [
+    ("исходная схема", _migration_initial_schema),
+    ("время в секундах Unix", _migration_epoch_timestamps),
+    ("лишние индексы", _migration_drop_redundant_indexes),
+    ("денежный журнал", _migration_money_ledger),
+    ("аудит массовых корректировок", _migration_balance_adjustments),
+    ("индексы рейтингов", _migration_leaderboard_indexes),
+    ("контрольные точки рассылок", _migration_broadcast_offsets),
+]
+
+def migrate(conn: sqlite3.Connection):
+    """Применяет недостающие миграции; на актуальной схеме — один PRAGMA и никакого DDL"""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return
+    # WAL: читатели из других процессов не блокируют писателя; режим хранится в самом файле
+    conn.execute('PRAGMA journal_mode=WAL')
+    log = logging.getLogger('RudepsBot')
+    for number in range(version, len(MIGRATIONS)):
+        name, step = MIGRATIONS[number]
+        started = time.perf_counter()
+        step(conn)
+        conn.execute(f'PRAGMA user_version = {number + 1}')
+        conn.commit()
+        log.info(f"Миграция БД {number + 1} ({name}): {time.perf_counter() - started:.1f} с")
+
+class _BackupRestarted(Exception):
+    """Онлайн-копия перезапускалась чаще BACKUP_MAX_RESTARTS"""
+
+LEADERBOARD_COLUMNS = ('comment_balance', 'tasks_completed')
+
+class Leaderboard:
+    """Рейтинг незабаненных пользователей по колонке users в памяти процесса.
+
+    Первые size мест — отсортированный список (-значение, user_id), место в нём ищется
+    бинарным поиском. Для «вашего места» хранится число пользователей на каждое
+    положительное значение. Записи через Database обновляют рейтинг сразу; записи других
+    воркеров и массовые операции он видит после перестроения из индекса"""
+
+    def __init__(self, column: str, size: int):
+        self.column = column
+        self.size = size
+        self._top: List[Tuple[int, int]] = []
+        self._scores: Dict[int, int] = {}
+        # Значение любого пользователя вне _top не больше _floor: места выше него достоверны
+        self._floor = 0
+        self._counts: Counter = Counter()
+        self.loaded_at: Optional[float] = None
+
+    def load(self, top_rows: List[Tuple[int, int]], count_rows: List[Tuple[int, int]]):
+        self._top = sorted((-score, user_id) for user_id, score in top_rows)
+        self._scores = {user_id: score for user_id, score in top_rows}
+        self._floor = -self._top[-1][0] if len(self._top) >= self.size else 0
+        self._counts = Counter({score: count for score, count in count_rows})
+        self.loaded_at = time.monotonic()
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    def fresh(self, places: int = 0) -> bool:
+        """Загружен, не старше LEADERBOARD_REFRESH и ручается за первые places мест"""
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > config.LEADERBOARD_REFRESH:
+            return False
+        return self.top(places) is not None
+
+    def top(self, places: int) -> Optional[List[Tuple[int, int]]]:
+        """Первые places мест (user_id, значение); None — после уменьшений значений в памяти
+        не хватает достоверных мест, нужен перестрой"""
+        entries = self._top[:places]
+        if len(entries) < places and self._floor > 0:
+            return None
+        if entries and -entries[-1][0] < self._floor:
+            return None
+        return [(user_id, -score) for score, user_id in entries]
+
+    def rank(self, score: int) -> Optional[int]:
+        """Место со значением score: 1 + число пользователей с большим значением"""
+        if self.loaded_at is None or score <= 0:
+            return None
+        return 1 + sum(count for value, count in self._counts.items() if value > score)
+
+    @property
+    def total(self) -> int:
+        """Пользователей с положительным значением"""
+        return sum(self._counts.values())
+
+    def update(self, user_id: int, old: int, new: int):
+        if self.loaded_at is None or old == new:
+            return
+        self._count(old, -1)
+        self._count(new, 1)
+        self._discard(user_id)
+        self._place(user_id, new)
+
+    def remove(self, user_id: int, score: int):
+        """Пользователь выбыл из рейтинга (бан)"""
+        if self.loaded_at is None:
+            return
+        self._count(score, -1)
+        self._discard(user_id)
+
+    def _count(self, score: int, delta: int):
+        if score > 0:
+            self._counts[score] += delta
+            if self._counts[score] <= 0:
+                del self._counts[score]
+
+    def _discard(self, user_id: int):
+        score = self._scores.pop(user_id, None)
+        if score is not None:
+            del self._top[bisect_left(self._top, (-score, user_id))]
+
+    def _place(self, user_id: int, score: int):
+        if score <= 0:
+            return
+        entry = (-score, user_id)
+        if len(self._top) >= self.size and entry > self._top[-1]:
+            self._floor = max(self._floor, score)
+            return
+        insort(self._top, entry)
+        self._scores[user_id] = score
+        if len(self._top) > self.size:
+            evicted_score, evicted = self._top.pop()
+            del self._scores[evicted]
+            self._floor = max(self._floor, -evicted_score)
+
 class Database:
     """Класс для работы с БД (без изменений, сохранён как в исходном коде)"""
     # ... (весь класс Database остаётся без изменений)
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, writer: Optional[Any] = None,
+                 profiler: Optional[QueryProfiler] = None):
         self.db_path = db_path
-        self.executor = ThreadPoolExecutor(max_workers=4)
+        # Если задан writer, все изменяющие запросы уходят в единственный процесс-писатель
+        self.writer = writer
+        self.profiler = profiler
+        self.executor_workers = 4
+        self.executor = ThreadPoolExecutor(max_workers=self.executor_workers)
+        # Запросы, отданные в executor и ещё не завершённые; меняется только на event loop'е
+        self.executor_pending = 0
         self._cache: Dict[str, tuple] = {}
         self._cache_time: Dict[str, float] = {}
         self._lock = asyncio.Lock()
+        self.leaderboards = {column: Leaderboard(column, config.LEADERBOARD_SIZE) for column in LEADERBOARD_COLUMNS}
+        self._leaderboard_lock = asyncio.Lock()
         self._init_db_sync()
 
     def _init_db_sync(self):
         os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
         with self._get_conn_sync() as conn:
-            cur = conn.cursor()
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    registration_date TIMESTAMP,
-                    last_activity TIMESTAMP,
-                    comment_balance INTEGER DEFAULT 0,
-                    money_balance INTEGER DEFAULT 0,
-                    tasks_completed INTEGER DEFAULT 0,
-                    total_comments_ever INTEGER DEFAULT 0,
-                    is_blocked BOOLEAN DEFAULT FALSE,
-                    is_admin BOOLEAN DEFAULT FALSE,
-                    accepted_rules BOOLEAN DEFAULT FALSE,
-                    last_task_date TIMESTAMP,
-                    is_permanently_banned BOOLEAN DEFAULT FALSE
-                )
-            ''')
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS used_photos (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    photo_hash TEXT UNIQUE,
-                    timestamp TIMESTAMP
-                )
-            ''')
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS comments_log (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    timestamp TIMESTAMP,
-                    week_number INTEGER,
-                    month_number INTEGER
-                )
-            ''')
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS withdrawals (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    amount INTEGER,
-                    method TEXT,
-                    details TEXT,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP,
-                    processed_at TIMESTAMP,
-                    reject_reason TEXT
-                )
-            ''')
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS broadcasts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    admin_id INTEGER,
-                    target_type TEXT,
-                    target_count INTEGER,
-                    message_text TEXT,
-                    link TEXT,
-                    reward_amount INTEGER,
-                    sent_count INTEGER,
-                    error_count INTEGER,
-                    created_at TIMESTAMP
-                )
-            ''')
-            cur.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)')
-            cur.execute('CREATE INDEX IF NOT EXISTS idx_users_is_permanently_banned ON users(is_permanently_banned)')
-            cur.execute('CREATE INDEX IF NOT EXISTS idx_used_photos_hash ON used_photos(photo_hash)')
-            cur.execute('CREATE INDEX IF NOT EXISTS idx_withdrawals_status ON withdrawals(status)')
-            cur.execute('CREATE INDEX IF NOT EXISTS idx_comments_log_user ON comments_log(user_id)')
-            cur.execute('CREATE INDEX IF NOT EXISTS idx_comments_log_week ON comments_log(week_number)')
-            conn.commit()
+            migrate(conn)
+
+    def executor_queue(self) -> int:
+        """Запросы, ждущие свободного потока executor'а"""
+        return max(0, self.executor_pending - self.executor_workers)
+
+    async def _run(self, func, *args):
+        """Выполняет func в executor'е БД с учётом глубины очереди"""
+        self.executor_pending += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.executor_pending -= 1
 
     @contextmanager
     def _get_conn_sync(self):
@@ -174,29 +713,72 @@ class Database:
 
     async def _execute(self, query: str, params: tuple = (), fetch_one: bool = False,
                        fetch_all: bool = False, commit: bool = True) -> Any:
-        loop = asyncio.get_event_loop()
+        label = query_label(query)
+        with metrics.timer('rudeps_db_query_seconds', label), tracer.span('db', label):
+            return await self._execute_timed(query, params, fetch_one, fetch_all, commit)
+
+    async def _execute_timed(self, query: str, params: tuple, fetch_one: bool,
+                             fetch_all: bool, commit: bool) -> Any:
+        if self.writer and _WRITE_QUERY_RE.match(query):
+            started = time.perf_counter()
+            await self.writer.execute([(query, params)])
+            if self.profiler:
+                # Запись выполняется в другом процессе: время — с пересылкой, без плана
+                self.profiler.record(None, query, params, time.perf_counter() - started)
+            return None
         def sync_execute():
             with self._get_conn_sync() as conn:
+                started = time.perf_counter()
                 cur = conn.cursor()
                 cur.execute(query, params)
                 if commit:
                     conn.commit()
+                result = None
                 if fetch_one:
-                    return cur.fetchone()
-                if fetch_all:
-                    return cur.fetchall()
-                return None
-        return await loop.run_in_executor(self.executor, sync_execute)
-
-    async def _execute_many(self, queries: List[tuple]) -> None:
-        loop = asyncio.get_event_loop()
+                    result = cur.fetchone()
+                elif fetch_all:
+                    result = cur.fetchall()
+                if self.profiler:
+                    self.profiler.record(conn, query, params, time.perf_counter() - started)
+                return result
+        return await self._run(sync_execute)
+
+    async def _insert(self, query: str, params: tuple = ()) -> int:
+        """INSERT, возвращающий rowid новой строки"""
+        label = query_label(query)
+        with metrics.timer('rudeps_db_query_seconds', label), tracer.span('db', label):
+            return await self._insert_timed(query, params)
+
+    async def _insert_timed(self, query: str, params: tuple) -> int:
+        if self.writer:
+            return await self.writer.execute([(query, params)])
+        def sync_insert():
+            with self._get_conn_sync() as conn:
+                cur = conn.execute(query, params)
+                conn.commit()
+                return cur.lastrowid
+        return await self._run(sync_insert)
+
+    async def _execute_many(self, queries: List[tuple]) -> Optional[int]:
+        """Запросы одной транзакцией. Возвращает rowid, вставленный последним запросом,
+        или None, если последний запрос ничего не изменил (условные INSERT ... WHERE changes())"""
+        with metrics.timer('rudeps_db_query_seconds', 'BATCH'), tracer.span('db', 'BATCH'):
+            return await self._execute_many_timed(queries)
+
+    async def _execute_many_timed(self, queries: List[tuple]) -> Optional[int]:
+        if self.writer:
+            return await self.writer.execute(queries)
         def sync_execute_many():
             with self._get_conn_sync() as conn:
                 cur = conn.cursor()
                 for query, params in queries:
+                    started = time.perf_counter()
                     cur.execute(query, params)
+                    if self.profiler:
+                        self.profiler.record(conn, query, params, time.perf_counter() - started)
                 conn.commit()
-        await loop.run_in_executor(self.executor, sync_execute_many)
+                return cur.lastrowid if cur.rowcount else None
+        return await self._run(sync_execute_many)
 
     # Методы работы с пользователями, комментариями, выводами и т.д. (полностью сохранены)
     async def get_user(self, user_id: int) -> Optional[Dict]:
@@ -204,7 +786,7 @@ class Database:
         return dict(row) if row else None
 
     async def create_user(self, user_id: int, username: str, first_name: str, last_name: str) -> None:
-        now = datetime.now()
+        now = int(time.time())
         is_admin = user_id in config.ADMIN_IDS
         await self._execute('''
             INSERT OR IGNORE INTO users
@@ -213,7 +795,7 @@ class Database:
         ''', (user_id, username, first_name, last_name, now, now, is_admin, True, False), commit=True)
 
     async def update_user_activity(self, user_id: int) -> None:
-        await self._execute("UPDATE users SET last_activity = ? WHERE user_id = ?", (datetime.now(), user_id), commit=True)
+        await self._execute("UPDATE users SET last_activity = ? WHERE user_id = ?", (int(time.time()), user_id), commit=True)
 
     async def set_accepted_rules(self, user_id: int) -> None:
         await self._execute("UPDATE users SET accepted_rules = 1 WHERE user_id = ?", (user_id,), commit=True)
@@ -222,7 +804,11 @@ class Database:
         await self._execute("UPDATE users SET is_blocked = ? WHERE user_id = ?", (blocked, user_id), commit=True)
 
     async def ban_user_permanently(self, user_id: int) -> None:
+        user = await self.get_user(user_id)
         await self._execute("UPDATE users SET is_permanently_banned = 1, is_blocked = 1 WHERE user_id = ?", (user_id,), commit=True)
+        if user and not user['is_permanently_banned']:
+            for column, board in self.leaderboards.items():
+                board.remove(user_id, user[column])
 
     async def is_permanently_banned(self, user_id: int) -> bool:
         user = await self.get_user(user_id)
@@ -236,7 +822,7 @@ class Database:
         return row is not None
 
     async def save_photo_hash(self, user_id: int, photo_hash: str) -> None:
-        await self._execute("INSERT INTO used_photos (user_id, photo_hash, timestamp) VALUES (?, ?, ?)", (user_id, photo_hash, datetime.now()), commit=True)
+        await self._execute("INSERT INTO used_photos (user_id, photo_hash, timestamp) VALUES (?, ?, ?)", (user_id, photo_hash, int(time.time())), commit=True)
 
     async def add_comment(self, user_id: int) -> int:
         now = datetime.now()
@@ -244,48 +830,417 @@ class Database:
         month = now.month
         queries = [
             ('''UPDATE users SET comment_balance = comment_balance + 1, total_comments_ever = total_comments_ever + 1 WHERE user_id = ?''', (user_id,)),
-            ('''INSERT INTO comments_log (user_id, timestamp, week_number, month_number) VALUES (?, ?, ?, ?)''', (user_id, now, week, month))
+            ('''INSERT INTO comments_log (user_id, timestamp, week_number, month_number) VALUES (?, ?, ?, ?)''', (user_id, int(now.timestamp()), week, month)),
+            ('''INSERT INTO comments_weekly (year_week, user_id, comments) VALUES (?, ?, 1)
+                ON CONFLICT (year_week, user_id) DO UPDATE SET comments = comments + 1''', (year_week(now), user_id)),
+            ('''INSERT INTO comments_monthly (year_month, user_id, comments) VALUES (?, ?, 1)
+                ON CONFLICT (year_month, user_id) DO UPDATE SET comments = comments + 1''', (year_month(now), user_id)),
         ]
         await self._execute_many(queries)
-        row = await self._execute("SELECT comment_balance FROM users WHERE user_id = ?", (user_id,), fetch_one=True)
+        row = await self._execute("SELECT comment_balance, is_permanently_banned FROM users WHERE user_id = ?", (user_id,), fetch_one=True)
         new_balance = row[0] if row else 0
         new_blocked = new_balance < config.COMMENT_THRESHOLD
         await self._execute("UPDATE users SET is_blocked = ? WHERE user_id = ?", (new_blocked, user_id), commit=True)
+        if row and not row[1]:
+            self.leaderboards['comment_balance'].update(user_id, new_balance - 1, new_balance)
         return new_balance
 
+    async def change_comment_balance(self, user_id: int, delta: int) -> Optional[int]:
+        """Ручное начисление (delta > 0) или списание комментариев; новый баланс"""
+        await self._execute("UPDATE users SET comment_balance = comment_balance + ? WHERE user_id = ?", (delta, user_id), commit=True)
+        row = await self._execute("SELECT comment_balance, is_permanently_banned FROM users WHERE user_id = ?", (user_id,), fetch_one=True)
+        if not row:
+            return None
+        if not row[1]:
+            self.leaderboards['comment_balance'].update(user_id, row[0] - delta, row[0])
+        return row[0]
+
+    async def get_comment_activity(self) -> Dict[str, int]:
+        """Комментарии и число авторов за текущие неделю и месяц — из сводок, без comments_log"""
+        now = datetime.now()
+        week = await self._execute("SELECT COALESCE(SUM(comments), 0), COUNT(*) FROM comments_weekly WHERE year_week = ?",
+                                   (year_week(now),), fetch_one=True)
+        month = await self._execute("SELECT COALESCE(SUM(comments), 0), COUNT(*) FROM comments_monthly WHERE year_month = ?",
+                                    (year_month(now),), fetch_one=True)
+        return {'week_comments': week[0], 'week_authors': week[1],
+                'month_comments': month[0], 'month_authors': month[1]}
+
+    async def get_user_comment_activity(self, user_id: int) -> Tuple[int, int]:
+        """(за текущую неделю, за текущий месяц)"""
+        now = datetime.now()
+        row = await self._execute('''
+            SELECT (SELECT comments FROM comments_weekly WHERE year_week = ? AND user_id = ?),
+                   (SELECT comments FROM comments_monthly WHERE year_month = ? AND user_id = ?)
+        ''', (year_week(now), user_id, year_month(now), user_id), fetch_one=True)
+        return row[0] or 0, row[1] or 0
+
+    async def purge_comments_log(self, before: datetime, chunk: int, archive_path: str = '') -> int:
+        """Удаляет строки comments_log старше before пачками по chunk (сводки не трогаются).
+        С archive_path строки сначала копируются в отдельный SQLite-файл. Возвращает число строк"""
+        cutoff = int(before.timestamp())
+        total = 0
+        while True:
+            rows = await self._execute(
+                "SELECT id, user_id, timestamp, week_number, month_number FROM comments_log WHERE timestamp < ? ORDER BY id LIMIT ?",
+                (cutoff, chunk), fetch_all=True)
+            if not rows:
+                return total
+            if archive_path:
+                await self._run(self._archive_comments_sync, archive_path, rows)
+            # Выбраны первые по id подходящие строки, поэтому в диапазоне id других подходящих нет
+            await self._execute("DELETE FROM comments_log WHERE id BETWEEN ? AND ? AND timestamp < ?",
+                                (rows[0][0], rows[-1][0], cutoff), commit=True)
+            total += len(rows)
+
+    @staticmethod
+    def _archive_comments_sync(path: str, rows: List[sqlite3.Row]):
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS comments_log (
+                    id INTEGER PRIMARY KEY, user_id INTEGER, timestamp INTEGER,
+                    week_number INTEGER, month_number INTEGER
+                )
+            ''')
+            # OR IGNORE: пачка, заархивированная перед сбоем, при повторе не дублируется
+            conn.executemany('INSERT OR IGNORE INTO comments_log VALUES (?, ?, ?, ?, ?)', [tuple(row) for row in rows])
+            conn.commit()
+        finally:
+            conn.close()
+
     async def get_comment_balance(self, user_id: int) -> int:
         user = await self.get_user(user_id)
         return user['comment_balance'] if user else 0
 
-    async def add_money(self, user_id: int, amount: int) -> None:
-        await self._execute("UPDATE users SET money_balance = money_balance + ? WHERE user_id = ?", (amount, user_id), commit=True)
+    @staticmethod
+    def _ledger_queries(user_id: int, amount: int, held: int, kind: str, ref_id: Optional[int] = None,
+                        condition: str = '', condition_params: tuple = ()) -> List[tuple]:
+        """Изменение money_balance на amount и money_held на held с записью в ledger.
+        condition — дополнительное условие на строку users; если оно (или сам пользователь)
+        не совпало, запись в журнал не делается и батч возвращает None"""
+        return [
+            (f"UPDATE users SET money_balance = money_balance + ?, money_held = money_held + ? WHERE user_id = ?{condition}",
+             (amount, held, user_id, *condition_params)),
+            ("INSERT INTO ledger (user_id, amount, held, kind, ref_id, created_at) SELECT ?, ?, ?, ?, ?, ? WHERE changes() = 1",
+             (user_id, amount, held, kind, ref_id, int(time.time()))),
+        ]
 
-    async def deduct_money(self, user_id: int, amount: int) -> None:
-        await self._execute("UPDATE users SET money_balance = money_balance - ? WHERE user_id = ?", (amount, user_id), commit=True)
+    async def add_money(self, user_id: int, amount: int, kind: str = 'admin_credit') -> None:
+        await self._execute_many(self._ledger_queries(user_id, amount, 0, kind))
+
+    async def deduct_money(self, user_id: int, amount: int, kind: str = 'admin_debit') -> None:
+        await self._execute_many(self._ledger_queries(user_id, -amount, 0, kind))
+
+    async def get_balances(self, user_ids: List[int]) -> Dict[int, Tuple[int, int]]:
+        """(comment_balance, money_balance) найденных user_ids (вызывающий ограничивает число id пачкой)"""
+        placeholders = ','.join('?' * len(user_ids))
+        rows = await self._execute(f"SELECT user_id, comment_balance, money_balance FROM users WHERE user_id IN ({placeholders})",
+                                   tuple(user_ids), fetch_all=True)
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+    async def get_applied_adjustment_lines(self, batch_id: str) -> set:
+        rows = await self._execute("SELECT line FROM balance_adjustments WHERE batch_id = ?", (batch_id,), fetch_all=True)
+        return {row[0] for row in rows}
+
+    async def apply_balance_adjustments(self, batch_id: str, admin_id: int, rows: List[tuple]) -> Dict[str, List[int]]:
+        """Пачка строк файла корректировок (строка, user_id, комментарии, рубли, примечание)
+        одной транзакцией: балансы, строка balance_adjustments и запись ledger для рублей.
+        Строка применяется, только если её ещё нет в batch_id и ни один баланс не уходит
+        в минус. Возвращает номера строк: applied, duplicate (применены раньше), rejected"""
+        done_query = "SELECT line FROM balance_adjustments WHERE batch_id = ? AND line BETWEEN ? AND ?"
+        bounds = (batch_id, rows[0][0], rows[-1][0])
+        before = {row[0] for row in await self._execute(done_query, bounds, fetch_all=True)}
+        now = int(time.time())
+        queries = []
+        for line, user_id, comments, money, note in rows:
+            if line in before:
+                continue
+            queries.append(('''
+                UPDATE users SET comment_balance = comment_balance + ?, money_balance = money_balance + ?,
+                    is_blocked = CASE WHEN ? = 0 OR is_permanently_banned THEN is_blocked ELSE comment_balance + ? < ? END
+                WHERE user_id = ? AND (? >= 0 OR comment_balance + ? >= 0) AND (? >= 0 OR money_balance + ? >= 0)
+                  AND NOT EXISTS (SELECT 1 FROM balance_adjustments WHERE batch_id = ? AND line = ?)
+            ''', (comments, money, comments, comments, config.COMMENT_THRESHOLD,
+                  user_id, comments, comments, money, money, batch_id, line)))
+            queries.append(('''
+                INSERT INTO balance_adjustments (batch_id, line, admin_id, user_id, comment_delta, money_delta, note, created_at)
+                SELECT ?, ?, ?, ?, ?, ?, ?, ? WHERE changes() = 1
+            ''', (batch_id, line, admin_id, user_id, comments, money, note, now)))
+            if money:
+                queries.append(("INSERT INTO ledger (user_id, amount, held, kind, ref_id, created_at) "
+                                "SELECT ?, ?, 0, 'admin_bulk', last_insert_rowid(), ? WHERE changes() = 1",
+                                (user_id, money, now)))
+        if queries:
+            await self._execute_many(queries)
+            if any(row[2] for row in rows):
+                self.leaderboards['comment_balance'].invalidate()
+        after = {row[0] for row in await self._execute(done_query, bounds, fetch_all=True)}
+        lines = [row[0] for row in rows]
+        return {
+            'applied': [line for line in lines if line in after and line not in before],
+            'duplicate': [line for line in lines if line in before],
+            'rejected': [line for line in lines if line not in after],
+        }
 
     async def get_money_balance(self, user_id: int) -> int:
         user = await self.get_user(user_id)
         return user['money_balance'] if user else 0
 
-    async def increment_tasks_completed(self, user_id: int, reward: int) -> None:
-        await self._execute('''UPDATE users SET tasks_completed = tasks_completed + 1, money_balance = money_balance + ?, last_task_date = ? WHERE user_id = ?''', (reward, datetime.now(), user_id), commit=True)
-
-    async def create_withdrawal(self, user_id: int, amount: int, method: str, details: str) -> None:
-        await self._execute('''INSERT INTO withdrawals (user_id, amount, method, details, created_at) VALUES (?, ?, ?, ?, ?)''', (user_id, amount, method, details, datetime.now()), commit=True)
-
-    async def get_pending_withdrawals(self) -> List[Dict]:
-        rows = await self._execute("SELECT * FROM withdrawals WHERE status = 'pending' ORDER BY created_at", fetch_all=True)
-        return [dict(row) for row in rows] if rows else []
+    async def increment_tasks_completed(self, user_id: int, reward: int, broadcast_id: Optional[int] = None) -> None:
+        queries = [('''UPDATE users SET tasks_completed = tasks_completed + 1, last_task_date = ? WHERE user_id = ?''', (int(time.time()), user_id))]
+        if reward:
+            queries += self._ledger_queries(user_id, reward, 0, 'task_reward', broadcast_id)
+        await self._execute_many(queries)
+        row = await self._execute("SELECT tasks_completed, is_permanently_banned FROM users WHERE user_id = ?", (user_id,), fetch_one=True)
+        if row and not row[1]:
+            self.leaderboards['tasks_completed'].update(user_id, row[0] - 1, row[0])
+
+    async def create_withdrawal(self, user_id: int, amount: int, method: str, details: str) -> bool:
+        """Заявка с удержанием суммы: списание с money_balance в money_held только при достаточном
+        балансе, заявка и запись журнала — в той же транзакции. False — денег не хватило"""
+        now = int(time.time())
+        queries = [
+            ("UPDATE users SET money_balance = money_balance - ?, money_held = money_held + ? WHERE user_id = ? AND money_balance >= ?",
+             (amount, amount, user_id, amount)),
+            ("INSERT INTO withdrawals (user_id, amount, method, details, created_at, held) SELECT ?, ?, ?, ?, ?, 1 WHERE changes() = 1",
+             (user_id, amount, method, details, now)),
+            ("INSERT INTO ledger (user_id, amount, held, kind, ref_id, created_at) SELECT ?, ?, ?, 'withdrawal_hold', last_insert_rowid(), ? WHERE changes() = 1",
+             (user_id, -amount, amount, now)),
+        ]
+        return await self._execute_many(queries) is not None
 
     async def get_withdrawal(self, withdrawal_id: int) -> Optional[Dict]:
         row = await self._execute("SELECT * FROM withdrawals WHERE id = ?", (withdrawal_id,), fetch_one=True)
         return dict(row) if row else None
 
-    async def update_withdrawal_status(self, withdrawal_id: int, status: str, reject_reason: str = None) -> None:
-        if reject_reason:
-            await self._execute('''UPDATE withdrawals SET status = ?, processed_at = ?, reject_reason = ? WHERE id = ?''', (status, datetime.now(), reject_reason, withdrawal_id), commit=True)
+    async def get_pending_withdrawals_page(self, after_id: int = 0, before_id: Optional[int] = None,
+                                           limit: int = 5) -> List[Dict]:
+        """Страница ожидающих заявок вместе с именем пользователя — один запрос. Keyset по id:
+        after_id — заявки дальше него, before_id — последние limit перед ним; порядок — по id"""
+        query = '''
+            SELECT w.*, u.username, u.first_name, u.last_name
+            FROM withdrawals w LEFT JOIN users u ON u.user_id = w.user_id
+            WHERE w.status = 'pending' AND {bound} ORDER BY w.id {order} LIMIT ?
+        '''
+        if before_id is not None:
+            rows = await self._execute(query.format(bound='w.id < ?', order='DESC'), (before_id, limit), fetch_all=True)
+            rows = rows[::-1]
         else:
-            await self._execute('''UPDATE withdrawals SET status = ?, processed_at = ? WHERE id = ?''', (status, datetime.now(), withdrawal_id), commit=True)
+            rows = await self._execute(query.format(bound='w.id > ?', order='ASC'), (after_id, limit), fetch_all=True)
+        return [dict(row) for row in rows]
+
+    async def get_pending_withdrawals_summary(self, first_id: int = 0, last_id: int = 0) -> Dict[str, int]:
+        """Всего ожидающих заявок и их сумма; before/after — сколько их до first_id и после last_id"""
+        row = await self._execute('''
+            SELECT COUNT(*), COALESCE(SUM(amount), 0), COALESCE(SUM(id < ?), 0), COALESCE(SUM(id > ?), 0)
+            FROM withdrawals WHERE status = 'pending'
+        ''', (first_id, last_id), fetch_one=True)
+        return {'count': row[0], 'amount': row[1], 'before': row[2], 'after': row[3]}
+
+    @staticmethod
+    def _withdrawal_filter(method: Optional[str], max_amount: Optional[int], max_id: int) -> Tuple[str, tuple]:
+        """Условие массового одобрения по колонкам withdrawals w; max_id отсекает заявки,
+        созданные после того, как админ увидел итог"""
+        conditions, params = ['w.id <= ?'], [max_id]
+        if method:
+            conditions.append('w.method = ?')
+            params.append(method)
+        if max_amount:
+            conditions.append('w.amount <= ?')
+            params.append(max_amount)
+        return ' AND '.join(conditions), tuple(params)
+
+    async def preview_withdrawals(self, method: Optional[str], max_amount: Optional[int]) -> Dict[str, int]:
+        """Сколько ожидающих заявок подходит под фильтр, на какую сумму и до какого id"""
+        condition, params = self._withdrawal_filter(method, max_amount, (1 << 63) - 1)
+        row = await self._execute(f"SELECT COUNT(*), COALESCE(SUM(amount), 0), COALESCE(MAX(id), 0) FROM withdrawals w "
+                                  f"WHERE w.status = 'pending' AND {condition}", params, fetch_one=True)
+        return {'count': row[0], 'amount': row[1], 'max_id': row[2]}
+
+    async def approve_withdrawals_range(self, first_id: int, last_id: int) -> List[Dict]:
+        return await self._approve_withdrawals('w.id BETWEEN ? AND ?', (first_id, last_id))
+
+    async def approve_withdrawals_filtered(self, method: Optional[str], max_amount: Optional[int], max_id: int) -> List[Dict]:
+        return await self._approve_withdrawals(*self._withdrawal_filter(method, max_amount, max_id))
+
+    async def _approve_withdrawals(self, condition: str, params: tuple) -> List[Dict]:
+        """Одобряет одной транзакцией все ожидающие заявки под condition, как approve_withdrawal
+        по каждой: журнал, списание удержанного (или баланса у старых заявок), статус.
+        Возвращает одобренные заявки (id, user_id, amount) для уведомлений"""
+        now = int(time.time())
+        pending = f"w.status = 'pending' AND {condition}"
+        candidates = {row[0] for row in await self._execute(f"SELECT w.id FROM withdrawals w WHERE {pending}",
+                                                             params, fetch_all=True)}
+        if not candidates:
+            return []
+        queries = [
+            (f'''INSERT INTO ledger (user_id, amount, held, kind, ref_id, created_at)
+                SELECT w.user_id, CASE WHEN w.held THEN 0 ELSE -w.amount END, CASE WHEN w.held THEN -w.amount ELSE 0 END,
+                       'withdrawal_paid', w.id, ?
+                FROM withdrawals w WHERE {pending}''', (now, *params)),
+            (f'''UPDATE users SET
+                    money_balance = money_balance - COALESCE((SELECT SUM(w.amount) FROM withdrawals w
+                                                              WHERE w.user_id = users.user_id AND w.held = 0 AND {pending}), 0),
+                    money_held = money_held - COALESCE((SELECT SUM(w.amount) FROM withdrawals w
+                                                        WHERE w.user_id = users.user_id AND w.held = 1 AND {pending}), 0)
+                WHERE user_id IN (SELECT w.user_id FROM withdrawals w WHERE {pending})''', params * 3),
+            (f"UPDATE withdrawals AS w SET status = 'approved', processed_at = ? WHERE {pending}", (now, *params)),
+        ]
+        await self._execute_many(queries)
+        # Одобренные этой транзакцией: ожидали до неё и получили её processed_at (одиночное
+        # одобрение той же заявки другим админом в ту же секунду даст лишнее уведомление,
+        # но не лишнее списание)
+        rows = await self._execute(f"SELECT w.id, w.user_id, w.amount FROM withdrawals w "
+                                   f"WHERE w.status = 'approved' AND w.processed_at = ? AND {condition}",
+                                   (now, *params), fetch_all=True)
+        return [dict(row) for row in rows if row['id'] in candidates]
+
+    async def approve_withdrawal(self, withdrawal: Dict) -> bool:
+        """Одобрение: удержанное списывается окончательно (held -= amount). Старые заявки без
+        удержания (held = 0) списываются с баланса сейчас. False — заявка уже обработана"""
+        user_id, amount = withdrawal['user_id'], withdrawal['amount']
+        held = withdrawal['held']
+        queries = [("UPDATE withdrawals SET status = 'approved', processed_at = ? WHERE id = ? AND status = 'pending'",
+                    (int(time.time()), withdrawal['id']))]
+        queries += self._ledger_queries(user_id, 0 if held else -amount, -amount if held else 0, 'withdrawal_paid',
+                                        withdrawal['id'], ' AND changes() = 1')
+        return await self._execute_many(queries) is not None
+
+    async def reject_withdrawal(self, withdrawal: Dict, reject_reason: str) -> bool:
+        """Отказ: удержанная сумма возвращается на баланс. False — заявка уже обработана"""
+        queries = [("UPDATE withdrawals SET status = 'rejected', processed_at = ?, reject_reason = ? WHERE id = ? AND status = 'pending'",
+                    (int(time.time()), reject_reason, withdrawal['id']))]
+        if withdrawal['held']:
+            amount = withdrawal['amount']
+            queries += self._ledger_queries(withdrawal['user_id'], amount, -amount, 'withdrawal_released',
+                                            withdrawal['id'], ' AND changes() = 1')
+        return await self._execute_many(queries) is not None
+
+    async def reconcile_ledger(self, sample: int = 10) -> Dict[str, Any]:
+        """Сверка кэша балансов с журналом: money_balance = SUM(amount), money_held = SUM(held)
+        и money_held = сумма ожидающих заявок с удержанием. Только читает; в отчёте — число
+        расхождений и до sample примеров (user_id, кэш, журнал)"""
+        totals = await self._execute('''
+            SELECT (SELECT COUNT(*) FROM users), (SELECT COALESCE(SUM(money_balance), 0) FROM users),
+                   (SELECT COALESCE(SUM(money_held), 0) FROM users), (SELECT COALESCE(SUM(amount), 0) FROM ledger),
+                   (SELECT COALESCE(SUM(held), 0) FROM ledger)
+        ''', fetch_one=True)
+        balance = await self._execute('''
+            SELECT u.user_id, u.money_balance, u.money_held, COALESCE(l.amount, 0), COALESCE(l.held, 0)
+            FROM users u LEFT JOIN (SELECT user_id, SUM(amount) AS amount, SUM(held) AS held FROM ledger GROUP BY user_id) l
+                ON l.user_id = u.user_id
+            WHERE u.money_balance != COALESCE(l.amount, 0) OR u.money_held != COALESCE(l.held, 0)
+        ''', fetch_all=True)
+        pending = await self._execute('''
+            SELECT u.user_id, u.money_held, COALESCE(w.amount, 0)
+            FROM users u LEFT JOIN (SELECT user_id, SUM(amount) AS amount FROM withdrawals
+                                    WHERE status = 'pending' AND held = 1 GROUP BY user_id) w ON w.user_id = u.user_id
+            WHERE u.money_held != COALESCE(w.amount, 0)
+        ''', fetch_all=True)
+        return {
+            'users': totals[0],
+            'balance_total': totals[1],
+            'held_total': totals[2],
+            'ledger_amount_total': totals[3],
+            'ledger_held_total': totals[4],
+            'ledger_mismatches': len(balance),
+            'pending_mismatches': len(pending),
+            'ledger_examples': [tuple(row) for row in balance[:sample]],
+            'pending_examples': [tuple(row) for row in pending[:sample]],
+        }
+
+    async def create_broadcast(self, admin_id: int, target_type: str, target_count: int,
+                               message_text: str, link: Optional[str], reward: int, recipient_ids: List[int]) -> int:
+        """Полный список получателей сохраняется сразу: рассылку можно возобновить после падения
+        в любой момент, а контрольные точки пишут только смещение в нём"""
+        return await self._insert('''
+            INSERT INTO broadcasts
+            (admin_id, target_type, target_count, message_text, link, reward_amount, sent_count, error_count,
+             created_at, status, recipient_ids, sent_offset)
+            VALUES (?, ?, ?, ?, ?, ?, 0, 0, ?, 'running', ?, 0)
+        ''', (admin_id, target_type, target_count, message_text, link, reward, int(time.time()),
+              json.dumps(recipient_ids)))
+
+    async def update_broadcast_progress(self, broadcast_id: int, sent: int, errors: int,
+                                        offset: int, status: str = 'running') -> None:
+        """Контрольная точка: offset — сколько получателей из recipient_ids уже обработано.
+        Список получателей у завершённой рассылки больше не нужен и удаляется"""
+        clear = ", recipient_ids = NULL" if status == 'done' else ""
+        await self._execute(f'''UPDATE broadcasts SET sent_count = ?, error_count = ?, sent_offset = ?, status = ?{clear}
+                                WHERE id = ?''', (sent, errors, offset, status, broadcast_id), commit=True)
+
+    async def get_interrupted_broadcasts(self) -> List[Dict]:
+        """Недосланные рассылки. Вызывается при старте, так что 'running' здесь — рассылка,
+        оборванная падением процесса, а не идущая сейчас"""
+        rows = await self._execute(
+            "SELECT * FROM broadcasts WHERE status IN ('interrupted', 'running') AND recipient_ids IS NOT NULL ORDER BY id",
+            fetch_all=True)
+        return [dict(row) for row in rows] if rows else []
+
+    async def get_broadcast_link(self, broadcast_id: int) -> Optional[str]:
+        row = await self._execute("SELECT link FROM broadcasts WHERE id = ?", (broadcast_id,), fetch_one=True)
+        return row[0] if row else None
+
+    async def close(self) -> None:
+        """Дожидается всех запросов в executor'е и останавливает его"""
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.executor.shutdown, True)
+
+    async def backup(self, target: str, pages: int, pause: float, max_restarts: int) -> Dict[str, Any]:
+        """Онлайн-копия БД в файл target по pages страниц за шаг с паузой pause между шагами.
+        Идёт в отдельном потоке, а не в executor'е запросов: долгая копия не занимает его потоки"""
+        loop = asyncio.get_event_loop()
+        report, steps = await loop.run_in_executor(None, self._backup_sync, target, pages, pause, max_restarts)
+        for step in steps:
+            metrics.observe('rudeps_backup_step_seconds', step)
+        return report
+
+    def _backup_sync(self, target: str, pages: int, pause: float, max_restarts: int) -> Tuple[Dict[str, Any], List[float]]:
+        # Шаг держит транзакцию чтения только на время копирования своих страниц (в WAL
+        # писатели не ждут, но откладывается checkpoint). Запись в БД другим соединением
+        # перезапускает копию с начала; если перезапусков слишком много, остаток
+        # копируется одним шагом — это согласованный снимок за одну транзакцию чтения
+        steps: List[float] = []
+        progress_state = {'remaining': None, 'restarts': 0, 'step_started': time.perf_counter()}
+
+        def progress(status: int, remaining: int, total: int):
+            steps.append(time.perf_counter() - progress_state['step_started'])
+            previous = progress_state['remaining']
+            progress_state['remaining'] = remaining
+            if previous is not None and remaining >= previous:
+                progress_state['restarts'] += 1
+                if progress_state['restarts'] > max_restarts:
+                    raise _BackupRestarted()
+            if remaining:
+                time.sleep(pause)
+            progress_state['step_started'] = time.perf_counter()
+
+        started = time.perf_counter()
+        single_step = False
+        source = sqlite3.connect(self.db_path)
+        destination = sqlite3.connect(target)
+        try:
+            try:
+                source.backup(destination, pages=pages, progress=progress)
+            except _BackupRestarted:
+                single_step = True
+                step_started = time.perf_counter()
+                source.backup(destination)
+                steps.append(time.perf_counter() - step_started)
+            page_size = destination.execute('PRAGMA page_size').fetchone()[0]
+            page_count = destination.execute('PRAGMA page_count').fetchone()[0]
+        finally:
+            destination.close()
+            source.close()
+        return {
+            'pages': page_count,
+            'size_bytes': page_size * page_count,
+            'steps': len(steps),
+            'restarts': progress_state['restarts'],
+            'single_step': single_step,
+            'copy_seconds': time.perf_counter() - started,
+            'max_lock_seconds': max(steps, default=0.0),
+        }, steps
 
     async def get_total_users(self) -> int:
         row = await self._execute("SELECT COUNT(*) FROM users WHERE is_permanently_banned = 0", fetch_one=True)
@@ -311,18 +1266,65 @@ class Database:
         rows = await self._execute("SELECT status, COUNT(*) FROM withdrawals GROUP BY status", fetch_all=True)
         return {row[0]: row[1] for row in rows} if rows else {}
 
+    async def _leaderboard(self, column: str, places: int = 0) -> Leaderboard:
+        """Рейтинг column; перестраивается из индекса, если устарел или не ручается за places мест"""
+        board = self.leaderboards[column]
+        if board.fresh(places):
+            return board
+        async with self._leaderboard_lock:
+            if not board.fresh(places):
+                # Индекс указан явно: по статистике планировщик выбирает idx_users_is_permanently_banned
+                # и сортирует всю выборку
+                source = f"users INDEXED BY idx_users_{column} WHERE is_permanently_banned = 0 AND {column} > 0"
+                top = await self._execute(f"SELECT user_id, {column} FROM {source} ORDER BY {column} DESC LIMIT ?",
+                                          (board.size,), fetch_all=True)
+                counts = await self._execute(f"SELECT {column}, COUNT(*) FROM {source} GROUP BY {column}", fetch_all=True)
+                board.load([tuple(row) for row in top], [tuple(row) for row in counts])
+        return board
+
+    async def _leaderboard_top(self, column: str, limit: int) -> List[Tuple]:
+        """(user_id, значение, username, first_name, last_name) первых limit мест"""
+        limit = min(limit, config.LEADERBOARD_SIZE)
+        places = (await self._leaderboard(column, limit)).top(limit) or []
+        if not places:
+            return []
+        rows = await self._execute(f"SELECT user_id, username, first_name, last_name FROM users "
+                                   f"WHERE user_id IN ({','.join('?' * len(places))})",
+                                   tuple(user_id for user_id, _ in places), fetch_all=True)
+        names = {row[0]: tuple(row[1:]) for row in rows}
+        return [(user_id, score, *names.get(user_id, (None, None, None))) for user_id, score in places]
+
     async def get_top_comment_balance(self, limit: int = 10) -> List[Tuple]:
-        rows = await self._execute('''SELECT user_id, comment_balance, username, first_name, last_name FROM users WHERE is_permanently_banned = 0 ORDER BY comment_balance DESC LIMIT ?''', (limit,), fetch_all=True)
-        return rows or []
+        return await self._leaderboard_top('comment_balance', limit)
 
     async def get_top_tasks_completed(self, limit: int = 10) -> List[Tuple]:
-        rows = await self._execute('''SELECT user_id, tasks_completed, username, first_name, last_name FROM users WHERE is_permanently_banned = 0 ORDER BY tasks_completed DESC LIMIT ?''', (limit,), fetch_all=True)
-        return rows or []
+        return await self._leaderboard_top('tasks_completed', limit)
+
+    async def get_rank(self, column: str, score: int) -> Tuple[Optional[int], int]:
+        """Место в рейтинге column со значением score (None — вне рейтинга) и число участников"""
+        board = await self._leaderboard(column)
+        return board.rank(score), board.total
 
     async def get_all_user_ids(self) -> List[int]:
         rows = await self._execute("SELECT user_id FROM users WHERE accepted_rules = 1 AND is_permanently_banned = 0", fetch_all=True)
         return [row[0] for row in rows] if rows else []
 
+    async def iter_users(self, columns: List[str], condition: str, params: tuple, page: int):
+        """Строки users по возрастанию user_id страницами по page (user_id всегда первый).
+        Каждая страница — отдельный запрос от последнего user_id: транзакция чтения короткая,
+        в памяти одна страница. columns и condition подставляются в SQL — только из белых списков"""
+        select = ', '.join(['user_id'] + [c for c in columns if c != 'user_id'])
+        last = -(1 << 63)
+        while True:
+            rows = await self._execute(
+                f"SELECT {select} FROM users WHERE user_id > ? AND ({condition}) ORDER BY user_id LIMIT ?",
+                (last, *params, page), fetch_all=True)
+            if rows:
+                yield rows
+            if len(rows) < page:
+                return
+            last = rows[-1][0]
+
     async def get_users_for_broadcast(self, target_type: str, count: int = 0) -> List[int]:
         base_condition = "accepted_rules = 1 AND is_permanently_banned = 0"
         if target_type == 'all':
@@ -363,38 +1365,639 @@ class Database:
                 newly_blocked.append((user_id, new_balance))
         if queries:
             await self._execute_many(queries)
+            self.leaderboards['comment_balance'].invalidate()
         return newly_blocked
 
 # ==================== ЛОГГЕР ====================
 
+# (user_id, update_id) апдейта, который сейчас обрабатывается; задаётся в UserMailboxes
+log_update: ContextVar[Tuple[Optional[int], Optional[int]]] = ContextVar('log_update', default=(None, None))
+_LOG_DIGITS_RE = re.compile(r'\d+')
+
+class LogContextFilter(logging.Filter):
+    """Добавляет к записи user_id, update_id и имя хэндлера — пока мы ещё в контексте апдейта"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.user_id, record.update_id = log_update.get()
+        record.handler = getattr(current_handler.get(None), '__name__', None)
+        return True
+
+class ErrorSampler(logging.Filter):
+    """Ограничение повторяющихся предупреждений и ошибок.
+
+    Сообщения с точностью до чисел (ID пользователей, суммы) считаются одинаковыми:
+    за окно window пропускается не больше burst таких записей. Первая запись нового
+    окна сообщает, сколько повторов было подавлено в предыдущем. Если записи больше
+    не повторяются, число подавленных передаётся в report: при очистке истёкших окон
+    (не реже раза за window, пока в лог что-то пишется) и при закрытии лога (flush).
+    """
+    MAX_KEYS = 1000
+
+    def __init__(self, burst: int, window: float, report=None):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.report = report
+        self._lock = threading.Lock()
+        self._windows: Dict[str, List] = {}  # шаблон -> [начало окна, записей в окне]
+        self._swept = time.monotonic()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.burst <= 0:
+            return True
+        now = time.monotonic()
+        if now - self._swept >= self.window:
+            self.flush(now)
+        if record.levelno < logging.WARNING:
+            return True
+        key = _LOG_DIGITS_RE.sub('#', record.getMessage())[:200]
+        expired = []
+        with self._lock:
+            entry = self._windows.get(key)
+            if entry is not None and now - entry[0] < self.window:
+                entry[1] += 1
+                return entry[1] <= self.burst
+            suppressed = entry[1] - self.burst if entry is not None and entry[1] > self.burst else 0
+            if len(self._windows) >= self.MAX_KEYS:
+                expired = self._expire(now)
+            self._windows[key] = [now, 1]
+        self._report(expired)
+        if suppressed:
+            record.msg = f"{record.getMessage()} (подавлено похожих за прошлые {self.window:g} с: {suppressed})"
+            record.args = None
+        return True
+
+    def flush(self, now: Optional[float] = None, everything: bool = False):
+        """Сообщает о подавленных записях истёкших окон (everything — всех окон) и забывает их"""
+        with self._lock:
+            expired = self._expire(time.monotonic() if now is None else now, everything)
+        self._report(expired)
+
+    def _expire(self, now: float, everything: bool = False) -> List[Tuple[str, int]]:
+        # Вызывается под self._lock
+        done = {k: v for k, v in self._windows.items() if everything or now - v[0] >= self.window}
+        for key in done:
+            del self._windows[key]
+        self._swept = now
+        return [(key, count - self.burst) for key, (_, count) in done.items() if count > self.burst]
+
+    def _report(self, expired: List[Tuple[str, int]]):
+        # Вне блокировки: report пишет в тот же лог и снова проходит через filter
+        if self.report:
+            for key, suppressed in expired:
+                self.report(f"Подавлено похожих записей за {self.window:g} с: {suppressed} — {key}")
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key in ('user_id', 'update_id', 'handler'):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """Кладёт запись в очередь как есть: форматирование и запись на диск — в потоке QueueListener.
+    При переполнении очереди (диск не успевает) запись отбрасывается, цикл событий не ждёт."""
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Очередь в том же процессе — pickle не нужен, исключение отформатирует поток записи
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
 class Logger:
     def __init__(self, log_file: str):
         self.logger = logging.getLogger('RudepsBot')
         self.logger.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-        from logging.handlers import RotatingFileHandler
+        if config.LOG_FORMAT == 'json':
+            formatter = JsonLogFormatter()
+        else:
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
         file_handler = RotatingFileHandler(log_file, maxBytes=10*1024*1024, backupCount=5, encoding='utf-8')
         file_handler.setFormatter(formatter)
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
-        self.logger.addHandler(console_handler)
+        self._queue_handler = _NonBlockingQueueHandler(queue.Queue(config.LOG_QUEUE_SIZE))
+        self._sampler = ErrorSampler(config.LOG_ERROR_BURST, config.LOG_ERROR_WINDOW, report=self.logger.warning)
+        self._queue_handler.addFilter(self._sampler)
+        self._queue_handler.addFilter(LogContextFilter())
+        self._listener = QueueListener(self._queue_handler.queue, file_handler, console_handler)
+        self._listener.start()
+        self.logger.addHandler(self._queue_handler)
+        atexit.register(self.close)
 
     def info(self, msg: str): self.logger.info(msg)
     def error(self, msg: str): self.logger.error(msg)
     def warning(self, msg: str): self.logger.warning(msg)
     def critical(self, msg: str): self.logger.critical(msg)
 
+    def close(self):
+        """Дописывает очередь и останавливает поток записи; повторный вызов ничего не делает"""
+        if self._listener is None:
+            return
+        self._sampler.flush(everything=True)
+        if self._queue_handler.dropped:
+            self.logger.warning(f"Очередь лога переполнялась, потеряно записей: {self._queue_handler.dropped}")
+        self.logger.removeHandler(self._queue_handler)
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+        self._listener = None
+
+# ==================== МЕТРИКИ ====================
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names: Tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped)) + '}'
+
+class Metrics:
+    """Реестр метрик в текстовом формате Prometheus.
+
+    Серия — ключ словаря из значений меток, поэтому запись стоит пару обращений к dict
+    и годится для горячих путей. Все записи идут из потока event loop'а. При
+    enabled=False запись сразу возвращается.
+    """
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        # имя -> (тип, описание, имена меток)
+        self._meta: Dict[str, Tuple[str, str, Tuple[str, ...]]] = {}
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        # серия гистограммы: [счётчики по бакетам (последний — +Inf), сумма]
+        self._histograms: Dict[str, Dict[tuple, list]] = {}
+        self._gauges: Dict[str, Any] = {}
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self._meta[name] = ('counter', help_text, labels)
+        self._counters[name] = {}
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self._meta[name] = ('histogram', help_text, labels)
+        self._histograms[name] = {}
+
+    def gauge(self, name: str, help_text: str, fn, labels: Tuple[str, ...] = ()):
+        """fn() вызывается при каждом опросе: число или dict {значение метки: число}"""
+        self._meta[name] = ('gauge', help_text, labels)
+        self._gauges[name] = fn
+
+    def inc(self, name: str, *labels, value: float = 1.0):
+        if not self.enabled:
+            return
+        series = self._counters[name]
+        series[labels] = series.get(labels, 0.0) + value
+
+    def observe(self, name: str, seconds: float, *labels):
+        if not self.enabled:
+            return
+        series = self._histograms[name]
+        hist = series.get(labels)
+        if hist is None:
+            hist = series[labels] = [[0] * (len(_LATENCY_BUCKETS) + 1), 0.0]
+        hist[0][bisect_left(_LATENCY_BUCKETS, seconds)] += 1
+        hist[1] += seconds
+
+    @contextmanager
+    def timer(self, name: str, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, *labels)
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text, label_names) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for values, value in self._counters[name].items():
+                    lines.append(f"{name}{_format_labels(label_names, values)} {value}")
+            elif kind == 'histogram':
+                bucket_names = label_names + ('le',)
+                for values, (buckets, total) in self._histograms[name].items():
+                    cumulative = 0
+                    for le, count in zip(_LATENCY_BUCKETS + ('+Inf',), buckets):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(bucket_names, values + (le,))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(label_names, values)} {total}")
+                    lines.append(f"{name}_count{_format_labels(label_names, values)} {cumulative}")
+            else:
+                try:
+                    value = self._gauges[name]()
+                except Exception:
+                    continue
+                items = value.items() if isinstance(value, dict) else [((), value)]
+                for values, v in items:
+                    values = values if isinstance(values, tuple) else (values,)
+                    lines.append(f"{name}{_format_labels(label_names, values)} {v}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(enabled=bool(config.METRICS_PORT))
+metrics.counter('rudeps_updates_total', 'Принятые апдейты по типу', ('type',))
+metrics.counter('rudeps_updates_shed_total', 'Апдейты, сброшенные при перегрузке', ('lane',))
+metrics.counter('rudeps_updates_dropped_total', 'Апдейты, отброшенные из-за переполнения очереди пользователя')
+metrics.histogram('rudeps_handler_seconds', 'Время работы хэндлера', ('handler',))
+metrics.histogram('rudeps_db_query_seconds', 'Время запроса к БД, включая ожидание в executor', ('query',))
+metrics.counter('rudeps_bot_api_calls_total', 'Вызовы Bot API', ('method',))
+metrics.histogram('rudeps_bot_api_seconds', 'Время вызова Bot API', ('method',))
+metrics.counter('rudeps_bot_api_errors_total', 'Ошибки вызовов Bot API', ('method', 'error'))
+metrics.counter('rudeps_broadcast_messages_total', 'Сообщения рассылок', ('result',))
+metrics.histogram('rudeps_loop_lag_seconds', 'Опоздание пробуждения event loop\'а')
+metrics.counter('rudeps_loop_stalls_total', 'Блокировки event loop\'а дольше LOOP_STALL_MS')
+metrics.histogram('rudeps_backup_seconds', 'Длительность бэкапа БД целиком (копия, проверка, сжатие)')
+metrics.histogram('rudeps_backup_step_seconds', 'Длительность шага онлайн-копии (удержание транзакции чтения)')
+metrics.counter('rudeps_backups_total', 'Бэкапы БД', ('result',))
+metrics.counter('rudeps_balance_adjustments_total', 'Строки массовых корректировок балансов', ('result',))
+
+class MetricsServer:
+    """HTTP-эндпоинты /metrics и /debug (то же, что команда /debug), отдельные от webhook"""
+    def __init__(self, registry: Metrics, logger: Logger, host: str, port: int, inspector: Optional[Any] = None):
+        self.registry = registry
+        self.logger = logger
+        self.host = host
+        self.port = port
+        self.inspector = inspector
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
+
+    async def _handle_debug(self, request: web.Request) -> web.Response:
+        """?mem — топ аллокаций, ?mem=start / ?mem=stop — включить / выключить tracemalloc"""
+        result = self.inspector.snapshot()
+        if 'mem' in request.query:
+            result['memory'] = await self.inspector.memory(request.query['mem'], config.DEBUG_MEMORY_TOP)
+        return web.json_response(result, dumps=lambda obj: json.dumps(obj, ensure_ascii=False, indent=1))
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        if self.inspector:
+            app.router.add_get('/debug', self._handle_debug)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.logger.info(f"Метрики: http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+async def start_metrics_server(logger: Logger, port: int, inspector: Optional[Any] = None) -> Optional[MetricsServer]:
+    if not metrics.enabled:
+        return None
+    server = MetricsServer(metrics, logger, config.METRICS_HOST, port, inspector)
+    await server.start()
+    return server
+
+# ==================== ДИАГНОСТИКА ====================
+
+class LoopLagMonitor:
+    """Задержка event loop'а и стеки блокировок.
+
+    Корутина-пульс просыпается каждые interval секунд и отмечает время; опоздание
+    пробуждения и есть задержка loop'а. Отдельный поток-сторож следит за отметкой:
+    если её нет дольше threshold, loop чем-то занят синхронно, и сторож снимает стек
+    его потока — в логе виден код, который блокирует, а не только факт задержки.
+    """
+    def __init__(self, logger: Logger, interval: float, threshold: float):
+        self.logger = logger
+        self.interval = interval
+        self.threshold = threshold
+        self._beat = time.monotonic()
+        # Отметка пульса, блокировку после которой сторож уже записал в лог со стеком
+        self._reported: Optional[float] = None
+        self._loop_thread_id: Optional[int] = None
+        self._stop = threading.Event()
+
+    async def run(self):
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+        try:
+            while True:
+                expected = time.monotonic() + self.interval
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                previous, self._beat = self._beat, now
+                lag = max(0.0, now - expected)
+                metrics.observe('rudeps_loop_lag_seconds', lag)
+                if lag >= self.threshold:
+                    metrics.inc('rudeps_loop_stalls_total')
+                    # Блокировку, пойманную сторожем, в лог второй раз не пишем
+                    if self._reported != previous:
+                        self.logger.warning(f"Event loop был заблокирован {lag * 1000:.0f} мс")
+        finally:
+            self._stop.set()
+
+    def _watch(self):
+        while not self._stop.wait(self.threshold / 2):
+            beat = self._beat
+            # Следующий пульс ожидается через interval после отметки — задержка считается от него,
+            # как у пульса, иначе лог и rudeps_loop_stalls_total расходятся
+            stalled = time.monotonic() - beat - self.interval
+            if stalled < self.threshold or self._reported == beat:
+                continue
+            # Одна блокировка — один стек, снятый в момент обнаружения
+            self._reported = beat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame else "(стек недоступен)\n"
+            self.logger.warning(f"Event loop не отвечает {stalled * 1000:.0f} мс, сейчас выполняется:\n{stack.rstrip()}")
+
+def start_loop_monitor(logger: Logger) -> Optional[asyncio.Task]:
+    if config.LOOP_STALL_MS <= 0:
+        return None
+    monitor = LoopLagMonitor(logger, config.LOOP_LAG_INTERVAL, config.LOOP_STALL_MS / 1000)
+    return asyncio.create_task(monitor.run())
+
+class _Trace:
+    __slots__ = ('tid', 'events', 'closed')
+
+    def __init__(self, tid: int):
+        self.tid = tid
+        self.events: List[Dict] = []
+        self.closed = False
+
+# Трасса апдейта, который сейчас обрабатывается; фоновые задачи наследуют её, пока апдейт не закончен
+_current_trace: ContextVar[Optional[_Trace]] = ContextVar('current_trace', default=None)
+
+class Tracer:
+    """Спаны обработки апдейтов в формате Chrome Trace Event.
+
+    Корневой спан — апдейт (UserMailboxes), внутри — хэндлер, запросы к БД и вызовы
+    Bot API. tid события — user_id: апдейты одного пользователя обрабатываются строго
+    по очереди, поэтому спаны вкладываются без пересечений. Файл открывается в
+    chrome://tracing, Perfetto или speedscope; пишет его отдельный поток, закрывающая
+    скобка массива не нужна — формат допускает оборванный файл.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.sample = 1.0
+        self._queue: Optional[queue.SimpleQueue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._pid = os.getpid()
+
+    def open(self, path: str, sample: float):
+        self.sample = sample
+        self._pid = os.getpid()
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write, args=(path,), name='trace-writer', daemon=True)
+        self._thread.start()
+        self.enabled = True
+
+    def close(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._queue.put(None)
+        self._thread.join()
+
+    def _write(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('[\n')
+            separator = ''
+            while True:
+                events = self._queue.get()
+                if events is None:
+                    break
+                for event in events:
+                    f.write(separator + json.dumps(event, ensure_ascii=False))
+                    separator = ',\n'
+                if self._queue.empty():
+                    f.flush()
+
+    def _event(self, trace: _Trace, category: str, name: str, started: float, args: Optional[Dict] = None):
+        event = {
+            'name': name, 'cat': category, 'ph': 'X', 'pid': self._pid, 'tid': trace.tid,
+            'ts': round(started * 1e6), 'dur': round((time.perf_counter() - started) * 1e6),
+        }
+        if args:
+            event['args'] = args
+        trace.events.append(event)
+
+    @contextmanager
+    def update(self, user_id: int, update_id: Optional[int]):
+        if not self.enabled or (self.sample < 1.0 and random.random() >= self.sample):
+            yield
+            return
+        trace = _Trace(user_id)
+        token = _current_trace.set(trace)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            _current_trace.reset(token)
+            self._event(trace, 'update', 'update', started, {'update_id': update_id})
+            trace.closed = True
+            self._queue.put(trace.events)
+
+    @contextmanager
+    def span(self, category: str, name: str):
+        trace = _current_trace.get()
+        if trace is None:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if not trace.closed:
+                self._event(trace, category, name, started)
+
+    def record(self, category: str, name: str, started: float):
+        """Спан, начало которого засечено заранее (хуки middleware)"""
+        trace = _current_trace.get()
+        if trace is not None and not trace.closed:
+            self._event(trace, category, name, started)
+
+tracer = Tracer()
+
+def start_tracing(path: str):
+    if path:
+        tracer.open(path, config.TRACE_SAMPLE)
+
+# ==================== ХРАНИЛИЩЕ СОСТОЯНИЙ ====================
+
+def _encode_state_value(obj: Any) -> Any:
+    if isinstance(obj, types.base.TelegramObject):
+        return {'__tg__': type(obj).__name__, 'data': obj.to_python()}
+    if isinstance(obj, datetime):
+        return {'__dt__': obj.isoformat()}
+    raise TypeError(f"Не удаётся сериализовать {type(obj).__name__}")
+
+def _decode_state_value(obj: Dict) -> Any:
+    if '__tg__' in obj:
+        return getattr(types, obj['__tg__']).to_object(obj['data'])
+    if '__dt__' in obj:
+        return datetime.fromisoformat(obj['__dt__'])
+    return obj
+
+class StateStore:
+    """SQLite-хранилище состояний диалогов: чтение из памяти, запись пакетами в фоне"""
+    def __init__(self, db_path: str, logger: Logger,
+                 flush_interval: float = 1.0, batch_size: int = 500):
+        self.db_path = db_path
+        self.logger = logger
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # user_id -> запись состояния (None означает удаление)
+        self._pending: Dict[int, Optional[Dict]] = {}
+        self._wakeup = asyncio.Event()
+        self._running = False
+        self._init_db_sync()
+
+    def _init_db_sync(self):
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        with self._get_conn_sync() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS user_states (
+                    user_id INTEGER PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    updated_at REAL
+                )
+            ''')
+            conn.commit()
+
+    @contextmanager
+    def _get_conn_sync(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def load_all(self, shard: Optional[Tuple[int, int]] = None) -> Dict[int, Dict]:
+        """Читает сохранённые состояния (только своего шарда); вызывается один раз при старте"""
+        states = {}
+        query, params = "SELECT user_id, state, data FROM user_states", ()
+        if shard:
+            query, params = query + " WHERE user_id % ? = ?", (shard[1], shard[0])
+        with self._get_conn_sync() as conn:
+            for user_id, state, data in conn.execute(query, params):
+                try:
+                    states[user_id] = {
+                        'state': UserState(state),
+                        'data': json.loads(data, object_hook=_decode_state_value)
+                    }
+                except (ValueError, TypeError, KeyError) as e:
+                    self.logger.warning(f"Пропущено повреждённое состояние {user_id}: {e}")
+        return states
+
+    def put(self, user_id: int, entry: Optional[Dict]):
+        self._pending[user_id] = entry
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def _write_batch_sync(self, upserts: List[tuple], deletes: List[tuple]):
+        with self._get_conn_sync() as conn:
+            if upserts:
+                conn.executemany('''
+                    INSERT INTO user_states (user_id, state, data, updated_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET state = excluded.state, data = excluded.data,
+                                                       updated_at = excluded.updated_at
+                ''', upserts)
+            if deletes:
+                conn.executemany("DELETE FROM user_states WHERE user_id = ?", deletes)
+            conn.commit()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        now = time.time()
+        upserts, deletes = [], []
+        # Сериализуем в потоке цикла: словари данных могут меняться хэндлерами
+        for user_id, entry in pending.items():
+            if entry is None:
+                deletes.append((user_id,))
+                continue
+            try:
+                data = json.dumps(entry['data'], default=_encode_state_value, ensure_ascii=False)
+            except (TypeError, ValueError) as e:
+                self.logger.error(f"Состояние {user_id} не сохранено: {e}")
+                continue
+            upserts.append((user_id, entry['state'].value, data, now))
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(self.executor, self._write_batch_sync, upserts, deletes)
+        except Exception:
+            # Возвращаем неудачный пакет, не затирая более свежие изменения
+            for user_id, entry in pending.items():
+                self._pending.setdefault(user_id, entry)
+            raise
+
+    async def run(self):
+        self._running = True
+        while self._running:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                self.logger.error(f"Ошибка записи состояний: {e}")
+
+    async def close(self):
+        self._running = False
+        self._wakeup.set()
+        await self.flush()
+        self.executor.shutdown(wait=True)
+
 # ==================== УТИЛИТЫ ====================
 
+def format_timestamp(ts: Optional[int]) -> str:
+    """Время из БД (секунды Unix) для показа пользователю"""
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M') if ts else "—"
+
+_MARKDOWN_SPECIAL_RE = re.compile(r'([_*`\[])')
+
+def escape_markdown(text: Any) -> str:
+    """Пользовательский текст внутри сообщения с разметкой Markdown (имена, реквизиты)"""
+    return _MARKDOWN_SPECIAL_RE.sub(r'\\\1', str(text))
+
 class UserStateManager:
-    def __init__(self):
-        self._states: Dict[int, Dict] = {}
+    def __init__(self, store: Optional[StateStore] = None, shard: Optional[Tuple[int, int]] = None):
+        self._store = store
+        self._states: Dict[int, Dict] = store.load_all(shard) if store else {}
         self._lock = asyncio.Lock()
 
+    def _persist(self, user_id: int):
+        if self._store:
+            self._store.put(user_id, self._states.get(user_id))
+
     async def set_state(self, user_id: int, state: UserState, **data):
         async with self._lock:
             self._states[user_id] = {'state': state, 'data': data}
+            self._persist(user_id)
+
+    async def advance(self, user_id: int, state: UserState, **data):
+        """Следующий шаг мастера: в отличие от set_state, накопленные данные сохраняются"""
+        async with self._lock:
+            current = self._states.get(user_id, {}).get('data', {})
+            self._states[user_id] = {'state': state, 'data': {**current, **data}}
+            self._persist(user_id)
 
     async def get_state(self, user_id: int) -> Optional[UserState]:
         async with self._lock:
@@ -412,10 +2015,12 @@ class UserStateManager:
         async with self._lock:
             if user_id in self._states:
                 self._states[user_id]['data'].update(data)
+                self._persist(user_id)
 
     async def clear_state(self, user_id: int):
         async with self._lock:
-            self._states.pop(user_id, None)
+            if self._states.pop(user_id, None) is not None:
+                self._persist(user_id)
 
     async def has_state(self, user_id: int, state: Union[UserState, List[UserState]]) -> bool:
         async with self._lock:
@@ -461,6 +2066,274 @@ class KeyboardFactory:
         markup.add(KeyboardButton("❌ Отмена"))
         return markup
 
+# ==================== ЭКСПОРТ ПОЛЬЗОВАТЕЛЕЙ ====================
+
+# Колонки users, доступные для выгрузки (в файле — в этом порядке), и подписи кнопок
+EXPORT_COLUMNS: Dict[str, str] = {
+    'user_id': "ID",
+    'username': "Username",
+    'first_name': "Имя",
+    'last_name': "Фамилия",
+    'registration_date': "Регистрация",
+    'last_activity': "Активность",
+    'comment_balance': "Комментарии",
+    'money_balance': "Деньги",
+    'tasks_completed': "Задания",
+    'total_comments_ever': "Всего комментариев",
+    'is_blocked': "Заблокирован",
+}
+_EXPORT_TIMESTAMP_COLUMNS = {'registration_date', 'last_activity'}
+
+# Сегмент -> (подпись, условие WHERE)
+EXPORT_SEGMENTS: Dict[str, Tuple[str, str]] = {
+    'all': ("Принявшие правила", "accepted_rules = 1 AND is_permanently_banned = 0"),
+    'unblocked': ("С доступом", "accepted_rules = 1 AND is_permanently_banned = 0 AND is_blocked = 0"),
+    'blocked': ("Заблокированные", "accepted_rules = 1 AND is_permanently_banned = 0 AND is_blocked = 1"),
+    'banned': ("Забаненные", "is_permanently_banned = 1"),
+    'everyone': ("Все записи", "1 = 1"),
+}
+
+def export_filter(segment: str, registered_from: Optional[str], registered_to: Optional[str]) -> Tuple[str, tuple]:
+    """Условие и параметры для Database.iter_users; даты — ГГГГ-ММ-ДД, обе границы включительно"""
+    conditions = [EXPORT_SEGMENTS[segment][1]]
+    params = []
+    if registered_from:
+        conditions.append("registration_date >= ?")
+        params.append(int(datetime.strptime(registered_from, '%Y-%m-%d').timestamp()))
+    if registered_to:
+        conditions.append("registration_date < ?")
+        params.append(int((datetime.strptime(registered_to, '%Y-%m-%d') + timedelta(days=1)).timestamp()))
+    return ' AND '.join(conditions), tuple(params)
+
+class CsvGzipParts:
+    """CSV, сжатый gzip, по частям: часть держится в памяти, пока не вырастет больше spool
+    байт, дальше — во временном файле. Когда сжатая часть доходит до part_bytes, она
+    закрывается и следующая начинается с того же заголовка, так что каждую часть можно
+    открыть отдельно. Готовые части забираются через take_ready()"""
+    def __init__(self, columns: List[str], part_bytes: int, spool: int):
+        self.columns = columns
+        self.part_bytes = part_bytes
+        self.spool = spool
+        self.rows = 0
+        self.parts = 0
+        self._ready: List[Tuple[Any, int]] = []
+        self._buffer = None
+        self._open_part()
+
+    def _open_part(self):
+        self._buffer = tempfile.SpooledTemporaryFile(max_size=self.spool)
+        self._gzip = gzip.GzipFile(fileobj=self._buffer, mode='wb', compresslevel=6)
+        self._text = io.TextIOWrapper(self._gzip, encoding='utf-8', newline='')
+        self._csv = csv.writer(self._text)
+        self._csv.writerow(self.columns)
+        self._part_rows = 0
+
+    def _close_part(self):
+        self._text.flush()
+        self._text.detach()
+        self._gzip.close()
+        self._buffer.seek(0)
+        self._ready.append((self._buffer, self._part_rows))
+        self._buffer = None
+        self.parts += 1
+
+    def write_rows(self, rows: List[sqlite3.Row]):
+        for row in rows:
+            self._csv.writerow([self._value(column, row[column]) for column in self.columns])
+        self._part_rows += len(rows)
+        self.rows += len(rows)
+        # Размер на диске отстаёт от записанного на внутренний буфер zlib — запас в EXPORT_PART_BYTES
+        if self._buffer.tell() >= self.part_bytes:
+            self._close_part()
+            self._open_part()
+
+    @staticmethod
+    def _value(column: str, value: Any) -> Any:
+        if column in _EXPORT_TIMESTAMP_COLUMNS:
+            return datetime.fromtimestamp(value).isoformat(sep=' ') if value else ''
+        return '' if value is None else value
+
+    def take_ready(self) -> List[Tuple[Any, int]]:
+        """Закрытые части: (файл с позицией в начале, строк); закрыть файл — забота вызывающего"""
+        ready, self._ready = self._ready, []
+        return ready
+
+    def finish(self) -> List[Tuple[Any, int]]:
+        """Закрывает последнюю часть; пустая часть не отдаётся"""
+        if self._part_rows:
+            self._close_part()
+        else:
+            self._text.detach()
+            self._gzip.close()
+            self._buffer.close()
+        return self.take_ready()
+
+# ==================== МАССОВЫЕ КОРРЕКТИРОВКИ ====================
+
+BULK_BALANCE_NOTE_MAX = 200
+
+def parse_balance_csv(stream):
+    """Построчный разбор файла корректировок: (строка, (user_id, комментарии, рубли,
+    примечание) или None, ошибка). Первая строка с нечисловым user_id считается
+    заголовком; разделитель — запятая или точка с запятой (Excel)"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    line = 0
+    try:
+        first = text.readline()
+        delimiter = ';' if first.count(';') > first.count(',') else ','
+        reader = csv.reader(itertools.chain([first], text), delimiter=delimiter)
+        header_checked = False
+        for fields in reader:
+            line = reader.line_num
+            fields = [cell.strip() for cell in fields]
+            if not any(fields):
+                continue
+            if not header_checked:
+                header_checked = True
+                if not fields[0].lstrip('+-').isdigit():
+                    continue
+            if len(fields) not in (3, 4):
+                yield line, None, "нужно 3–4 колонки: user_id, комментарии, рубли, примечание"
+                continue
+            try:
+                user_id, comments, money = int(fields[0]), int(fields[1] or 0), int(fields[2] or 0)
+            except ValueError:
+                yield line, None, "user_id, комментарии и рубли должны быть целыми числами"
+                continue
+            note = fields[3] if len(fields) == 4 else ''
+            if user_id <= 0:
+                yield line, None, f"неверный user_id {user_id}"
+            elif not comments and not money:
+                yield line, None, "пустая корректировка"
+            elif len(note) > BULK_BALANCE_NOTE_MAX:
+                yield line, None, f"примечание длиннее {BULK_BALANCE_NOTE_MAX} символов"
+            else:
+                yield line, (user_id, comments, money, note), None
+    except (UnicodeDecodeError, csv.Error) as e:
+        yield line + 1, None, f"файл не читается как CSV в UTF-8 ({e}), остаток не обработан"
+    finally:
+        # Поток закрывает вызывающий
+        text.detach()
+
+class BalanceCsvSummary:
+    """Итоги проверки или применения файла корректировок и ошибки по строкам для отчёта"""
+    ERRORS_IN_TEXT = 10
+
+    def __init__(self):
+        self.rows = 0
+        self.users = set()
+        self.comments_added = self.comments_removed = 0
+        self.money_added = self.money_removed = 0
+        self.duplicates = 0
+        self.errors: List[Tuple[int, str]] = []
+
+    def add(self, row: tuple):
+        _, user_id, comments, money, _ = row
+        self.rows += 1
+        self.users.add(user_id)
+        self.comments_added += max(comments, 0)
+        self.comments_removed += max(-comments, 0)
+        self.money_added += max(money, 0)
+        self.money_removed += max(-money, 0)
+
+    def error(self, line: int, message: str):
+        self.errors.append((line, message))
+
+    def text(self, title: str) -> str:
+        lines = [
+            title,
+            f"📄 Строк: {self.rows} (пользователей: {len(self.users)})",
+            f"📝 Комментарии: +{self.comments_added} / −{self.comments_removed}",
+            f"💰 Рубли: +{self.money_added} / −{self.money_removed}",
+        ]
+        if self.duplicates:
+            lines.append(f"🔁 Уже применялись раньше: {self.duplicates}")
+        if self.errors:
+            lines.append(f"⚠️ Строк с ошибками: {len(self.errors)} — они не применяются")
+            self.errors.sort()
+            lines += [f"  • строка {line}: {escape_markdown(message)}" for line, message in self.errors[:self.ERRORS_IN_TEXT]]
+            if len(self.errors) > self.ERRORS_IN_TEXT:
+                lines.append("  • … полный список — в файле")
+        return '\n'.join(lines)
+
+    def errors_file(self) -> Optional[types.InputFile]:
+        """CSV со всеми ошибками, если в текст они не поместились"""
+        if len(self.errors) <= self.ERRORS_IN_TEXT:
+            return None
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['line', 'error'])
+        writer.writerows(sorted(self.errors))
+        return types.InputFile(io.BytesIO(buffer.getvalue().encode('utf-8-sig')), filename='balance_errors.csv')
+
+# ==================== РЕЗЕРВНЫЕ КОПИИ ====================
+
+_BACKUP_IO_CHUNK = 1024 * 1024
+
+def _finish_snapshot(raw_path: str, target: str) -> Dict[str, Any]:
+    """Проверка копии, сжатие и сверка сжатого файла с копией; target появляется только целым"""
+    started = time.perf_counter()
+    conn = sqlite3.connect(raw_path)
+    try:
+        integrity = conn.execute('PRAGMA integrity_check').fetchone()[0]
+    finally:
+        conn.close()
+    if integrity != 'ok':
+        raise RuntimeError(f"копия не прошла integrity_check: {integrity}")
+    checked = time.perf_counter()
+
+    digest = hashlib.sha256()
+    with open(raw_path, 'rb') as src, gzip.open(target + '.tmp', 'wb', compresslevel=6) as dst:
+        for chunk in iter(lambda: src.read(_BACKUP_IO_CHUNK), b''):
+            digest.update(chunk)
+            dst.write(chunk)
+    compressed = time.perf_counter()
+
+    restored = hashlib.sha256()
+    with gzip.open(target + '.tmp', 'rb') as f:
+        for chunk in iter(lambda: f.read(_BACKUP_IO_CHUNK), b''):
+            restored.update(chunk)
+    if restored.digest() != digest.digest():
+        raise RuntimeError("распакованный снимок не совпадает с копией")
+    os.replace(target + '.tmp', target)
+    return {
+        'compressed_bytes': os.path.getsize(target),
+        'sha256': digest.hexdigest(),
+        'integrity_seconds': checked - started,
+        'compress_seconds': compressed - checked,
+        'verify_seconds': time.perf_counter() - compressed,
+    }
+
+def rotate_backups(directory: str, name: str, keep: int) -> List[str]:
+    """Удаляет снимки name сверх последних keep (имена сортируются по времени); возвращает удалённые"""
+    snapshots = sorted(glob.glob(os.path.join(glob.escape(directory), f"{glob.escape(name)}-*.db.gz")))
+    removed = snapshots[:-keep] if keep > 0 else []
+    for path in removed:
+        os.remove(path)
+    return removed
+
+async def backup_database(db: Database, directory: str, keep: int) -> Dict[str, Any]:
+    """Снимок БД в directory: онлайн-копия по шагам, integrity_check, gzip со сверкой, ротация"""
+    loop = asyncio.get_event_loop()
+    started = time.perf_counter()
+    os.makedirs(directory, exist_ok=True)
+    name = os.path.splitext(os.path.basename(db.db_path))[0]
+    target = os.path.join(directory, f"{name}-{datetime.now():%Y%m%d-%H%M%S}.db.gz")
+    raw_path = os.path.join(directory, f".{name}.backup.tmp")
+    try:
+        report = await db.backup(raw_path, config.BACKUP_STEP_PAGES, config.BACKUP_STEP_PAUSE,
+                                 config.BACKUP_MAX_RESTARTS)
+        report.update(await loop.run_in_executor(None, _finish_snapshot, raw_path, target))
+    finally:
+        for path in (raw_path, target + '.tmp'):
+            if os.path.exists(path):
+                os.remove(path)
+    report['path'] = target
+    report['removed'] = await loop.run_in_executor(None, rotate_backups, directory, name, keep)
+    report['seconds'] = time.perf_counter() - started
+    metrics.observe('rudeps_backup_seconds', report['seconds'])
+    return report
+
 # ==================== ПЛАНИРОВЩИК ====================
 
 class Scheduler:
@@ -473,6 +2346,12 @@ class Scheduler:
     async def start(self):
         self._running = True
         aioschedule.every().monday.at(config.SCHEDULE_TIME).do(self.weekly_check)
+        if config.COMMENTS_LOG_RETENTION_DAYS > 0:
+            aioschedule.every().day.at(config.MAINTENANCE_TIME).do(self.purge_comments_log)
+        if config.LEDGER_RECONCILE:
+            aioschedule.every().day.at(config.MAINTENANCE_TIME).do(self.reconcile_ledger)
+        if config.BACKUP_DIR:
+            aioschedule.every().day.at(config.BACKUP_TIME).do(self.backup_database)
         while self._running:
             await aioschedule.run_pending()
             await asyncio.sleep(60)
@@ -490,6 +2369,53 @@ class Scheduler:
             await asyncio.gather(*tasks, return_exceptions=True)
         self.logger.info(f"Списание завершено. Заблокировано: {len(blocked_users)}")
 
+    async def purge_comments_log(self):
+        before = datetime.now() - timedelta(days=config.COMMENTS_LOG_RETENTION_DAYS)
+        started = time.perf_counter()
+        try:
+            removed = await self.db.purge_comments_log(before, config.COMMENTS_LOG_PURGE_CHUNK, config.COMMENTS_LOG_ARCHIVE)
+        except Exception as e:
+            self.logger.error(f"Ошибка чистки comments_log: {e}")
+            return
+        where = f", архив: {config.COMMENTS_LOG_ARCHIVE}" if config.COMMENTS_LOG_ARCHIVE else ""
+        self.logger.info(f"Чистка comments_log: удалено {removed} строк старше {before:%Y-%m-%d} "
+                         f"за {time.perf_counter() - started:.1f} с{where}")
+
+    async def reconcile_ledger(self):
+        started = time.perf_counter()
+        try:
+            report = await self.db.reconcile_ledger()
+        except Exception as e:
+            self.logger.error(f"Ошибка сверки денежного журнала: {e}")
+            return
+        summary = (f"пользователей {report['users']}, балансы {report['balance_total']}/{report['ledger_amount_total']}, "
+                   f"удержано {report['held_total']}/{report['ledger_held_total']} (кэш/журнал), "
+                   f"{time.perf_counter() - started:.1f} с")
+        if report['ledger_mismatches'] or report['pending_mismatches']:
+            self.logger.warning(
+                f"Сверка денежного журнала: расхождений с журналом {report['ledger_mismatches']}, "
+                f"с ожидающими заявками {report['pending_mismatches']}; {summary}. "
+                f"Примеры (user_id, баланс, удержано, журнал: баланс, удержано): {report['ledger_examples']}; "
+                f"(user_id, удержано, сумма заявок): {report['pending_examples']}")
+        else:
+            self.logger.info(f"Сверка денежного журнала: расхождений нет; {summary}")
+
+    async def backup_database(self):
+        try:
+            report = await backup_database(self.db, config.BACKUP_DIR, config.BACKUP_KEEP)
+        except Exception as e:
+            metrics.inc('rudeps_backups_total', 'error')
+            self.logger.error(f"Ошибка бэкапа БД: {e}")
+            return
+        metrics.inc('rudeps_backups_total', 'ok')
+        mode = ", остаток одним шагом" if report['single_step'] else ""
+        self.logger.info(
+            f"Бэкап БД: {report['path']} ({report['size_bytes'] / 1e6:.1f} → {report['compressed_bytes'] / 1e6:.1f} МБ) "
+            f"за {report['seconds']:.1f} с; копия {report['copy_seconds']:.1f} с, шагов {report['steps']}, "
+            f"перезапусков {report['restarts']}{mode}, макс. удержание чтения {report['max_lock_seconds'] * 1000:.0f} мс; "
+            f"проверка {report['integrity_seconds']:.1f} с, сжатие {report['compress_seconds']:.1f} с, "
+            f"сверка {report['verify_seconds']:.1f} с; удалено старых: {len(report['removed'])}")
+
     async def _notify_user(self, user_id: int, new_balance: int):
         try:
             await self.bot.send_message(
@@ -504,52 +2430,371 @@ class Scheduler:
         except Exception as e:
             self.logger.error(f"Не удалось отправить уведомление {user_id}: {e}")
 
-# ==================== ОБРАБОТЧИКИ ====================
+# ==================== BOT API ====================
 
-class Handlers:
-    def __init__(self, dp: Dispatcher, bot: Bot, db: Database,
-                 state_manager: UserStateManager, logger: Logger):
-        self.dp = dp
-        self.bot = bot
-        self.db = db
-        self.state_manager = state_manager
-        self.logger = logger
-        self._last_photo_time: Dict[int, float] = {}
+# Счётчик вызовов Bot API текущего апдейта (выставляется на время обработки)
+_update_api_calls: ContextVar[Optional[list]] = ContextVar('update_api_calls', default=None)
 
-    def register_all(self):
-        self._register_common()
-        self._register_comment()
-        self._register_withdraw()
-        self._register_admin()
-        # Добавляем общий обработчик для inline-кнопки инструкции
-        self.dp.callback_query_handler(lambda c: c.data == "instruction")(self.cmd_instruction)
+class CountingBot(Bot):
+    """Bot, считающий исходящие вызовы Bot API: всего по методам и в расчёте на апдейт"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.api_calls: Counter = Counter()
+        # число вызовов за апдейт -> сколько апдейтов обошлись таким числом
+        self.calls_per_update: Counter = Counter()
 
-    # ---------- ВСПОМОГАТЕЛЬНЫЕ МЕТОДЫ ----------
+    def _count(self, method: str):
+        self.api_calls[method] += 1
+        metrics.inc('rudeps_bot_api_calls_total', method)
+        calls = _update_api_calls.get()
+        if calls is not None:
+            calls[0] += 1
 
-    async def _send_main_menu(self, chat_id: int, user_id: int):
-        user = await self.db.get_user(user_id)
-        if not user:
-            return
-        banned = user['is_permanently_banned']
-        blocked = user['is_blocked']
+    async def _timed(self, method: str, coro):
+        with metrics.timer('rudeps_bot_api_seconds', method), tracer.span('api', method):
+            try:
+                return await coro
+            except Exception as e:
+                metrics.inc('rudeps_bot_api_errors_total', method, type(e).__name__)
+                raise
 
-        if banned:
-            await self.bot.send_message(chat_id, "⛔ Вы забанены навсегда.")
-            return
+    async def request(self, method, data=None, files=None, **kwargs):
+        self._count(method)
+        return await self._timed(method, super().request(method, data, files, **kwargs))
 
-        if blocked:
-            remaining = max(0, config.COMMENT_THRESHOLD - user['comment_balance'])
-            text = (
-                f"🔒 *Доступ заблокирован*\n\n"
-                f"📝 Текущий баланс: {user['comment_balance']}\n"
-                f"⏳ Осталось для разблокировки: {remaining}\n\n"
-                f"Отправляйте скриншоты с упоминанием @{config.BOT_NAME} чтобы получить комментарии!"
-            )
-            # Добавляем inline-кнопку с инструкцией
-            markup = InlineKeyboardMarkup().add(InlineKeyboardButton("📖 Инструкция", callback_data="instruction"))
-            await self.bot.send_message(chat_id, text, reply_markup=markup)
-        else:
-            await self.bot.send_message(chat_id, "Главное меню:", reply_markup=KeyboardFactory.main())
+    async def download_file(self, *args, **kwargs):
+        self._count('downloadFile')
+        return await self._timed('downloadFile', super().download_file(*args, **kwargs))
+
+    @contextmanager
+    def track_update(self):
+        calls = [0]
+        token = _update_api_calls.set(calls)
+        try:
+            yield
+        finally:
+            _update_api_calls.reset(token)
+            self.calls_per_update[calls[0]] += 1
+
+    def average_calls_per_update(self) -> float:
+        updates = sum(self.calls_per_update.values())
+        total = sum(calls * n for calls, n in self.calls_per_update.items())
+        return total / updates if updates else 0.0
+
+# ==================== MIDDLEWARE ====================
+
+class RateLimiter:
+    """Token bucket'ы по (ключ, user_id); память пропорциональна активным пользователям"""
+    def __init__(self, idle_ttl: float = 120, sweep_interval: float = 30):
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        # (ключ, user_id) -> [токены, время обновления, предупреждён ли]
+        self._buckets: Dict[Tuple[str, int], list] = {}
+        self._last_sweep = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def _sweep(self, now: float):
+        # Bucket, простоявший дольше idle_ttl, уже полон — удаление равносильно новому
+        cutoff = now - self.idle_ttl
+        self._buckets = {k: b for k, b in self._buckets.items() if b[1] >= cutoff}
+        self._last_sweep = now
+
+    def _refill(self, key: str, user_id: int, rate: float, burst: int, now: float) -> list:
+        if now - self._last_sweep >= self.sweep_interval:
+            self._sweep(now)
+        bucket = self._buckets.get((key, user_id))
+        if bucket is None:
+            bucket = self._buckets[(key, user_id)] = [float(burst), now, False]
+        else:
+            bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        return bucket
+
+    def hit(self, key: str, user_id: int, rate: float, burst: int = 1) -> float:
+        """Списывает токен. Возвращает 0, если разрешено, иначе секунды до следующего токена"""
+        bucket = self._refill(key, user_id, rate, burst, time.monotonic())
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return 0.0
+        return (1 - bucket[0]) / rate
+
+    def peek(self, key: str, user_id: int, rate: float, burst: int = 1) -> float:
+        """Как hit, но без списания токена"""
+        bucket = self._refill(key, user_id, rate, burst, time.monotonic())
+        return 0.0 if bucket[0] >= 1 else (1 - bucket[0]) / rate
+
+    def should_warn(self, key: str, user_id: int) -> bool:
+        """True только для первого отказа подряд — чтобы не тратить API-вызовы на флудера"""
+        bucket = self._buckets.get((key, user_id))
+        if bucket is None or bucket[2]:
+            return False
+        bucket[2] = True
+        return True
+
+def rate_limit(rate: float, burst: int = 1, key: Optional[str] = None):
+    """Декоратор лимита для отдельного хэндлера (проверяется в RateLimitMiddleware)"""
+    def decorator(func):
+        func.rate_limit = (key or func.__name__, rate, burst)
+        return func
+    return decorator
+
+class RateLimitMiddleware(BaseMiddleware):
+    """Общий лимит на пользователя до любых обращений к БД и лимиты отдельных хэндлеров"""
+    def __init__(self, limiter: RateLimiter, rate: float, burst: int):
+        super().__init__()
+        self.limiter = limiter
+        self.rate = rate
+        self.burst = burst
+
+    async def _reject(self, obj: Union[types.Message, types.CallbackQuery], key: str, retry_after: float):
+        if self.limiter.should_warn(key, obj.from_user.id):
+            text = f"⏳ Слишком часто. Подождите {max(1, int(retry_after + 0.999))} секунд."
+            if isinstance(obj, types.CallbackQuery):
+                await obj.answer(text)
+            else:
+                await obj.reply(text)
+        raise CancelHandler()
+
+    async def _check_global(self, obj: Union[types.Message, types.CallbackQuery]):
+        if not obj.from_user:
+            return
+        retry_after = self.limiter.hit('*', obj.from_user.id, self.rate, self.burst)
+        if retry_after:
+            await self._reject(obj, '*', retry_after)
+
+    async def _check_handler(self, obj: Union[types.Message, types.CallbackQuery]):
+        handler = current_handler.get()
+        limit = getattr(handler, 'rate_limit', None)
+        if not limit or not obj.from_user:
+            return
+        key, rate, burst = limit
+        retry_after = self.limiter.hit(key, obj.from_user.id, rate, burst)
+        if retry_after:
+            await self._reject(obj, key, retry_after)
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        await self._check_global(message)
+
+    async def on_pre_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        await self._check_global(call)
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        await self._check_handler(message)
+
+    async def on_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        await self._check_handler(call)
+
+class MetricsMiddleware(BaseMiddleware):
+    """Время работы хэндлера: от выбора хэндлера до конца обработки, метка — имя функции"""
+    @staticmethod
+    def _start(data: dict):
+        data['_metrics_handler'] = (current_handler.get().__name__, time.perf_counter())
+
+    @staticmethod
+    def _finish(data: dict):
+        started = data.pop('_metrics_handler', None)
+        if started:
+            metrics.observe('rudeps_handler_seconds', time.perf_counter() - started[1], started[0])
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self._start(data)
+
+    async def on_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        self._start(data)
+
+    async def on_post_process_message(self, message: types.Message, results: list, data: dict):
+        self._finish(data)
+
+    async def on_post_process_callback_query(self, call: types.CallbackQuery, results: list, data: dict):
+        self._finish(data)
+
+class TracingMiddleware(BaseMiddleware):
+    """Спан хэндлера внутри спана апдейта"""
+    @staticmethod
+    def _start(data: dict):
+        data['_trace_handler'] = (current_handler.get().__name__, time.perf_counter())
+
+    @staticmethod
+    def _finish(data: dict):
+        started = data.pop('_trace_handler', None)
+        if started:
+            tracer.record('handler', *started)
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self._start(data)
+
+    async def on_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        self._start(data)
+
+    async def on_post_process_message(self, message: types.Message, results: list, data: dict):
+        self._finish(data)
+
+    async def on_post_process_callback_query(self, call: types.CallbackQuery, results: list, data: dict):
+        self._finish(data)
+
+class UserContext:
+    """Строка пользователя, загруженная один раз на апдейт"""
+    def __init__(self, user_id: int, user: Optional[Dict]):
+        self.user_id = user_id
+        self.user = user
+
+    @property
+    def is_banned(self) -> bool:
+        return bool(self.user and self.user['is_permanently_banned'])
+
+    @property
+    def is_blocked(self) -> bool:
+        return bool(self.user['is_blocked']) if self.user else True
+
+    @property
+    def is_admin(self) -> bool:
+        return bool(self.user and self.user['is_admin'])
+
+    @property
+    def accepted_rules(self) -> bool:
+        return bool(self.user and self.user['accepted_rules'])
+
+    def patch(self, **fields):
+        """Применяет к кэшированной строке результат известной записи без повторного чтения"""
+        if self.user:
+            self.user.update(fields)
+
+class UserContextMiddleware(BaseMiddleware):
+    """Загружает пользователя один раз на апдейт и выполняет общие проверки доступа"""
+    def __init__(self, db: Database):
+        super().__init__()
+        self.db = db
+
+    async def _resolve(self, user_id: int, data: dict) -> UserContext:
+        ctx = UserContext(user_id, await self.db.get_user(user_id))
+        data['user_ctx'] = ctx
+        return ctx
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        if not message.from_user:
+            return
+        ctx = await self._resolve(message.from_user.id, data)
+        if ctx.is_banned:
+            # Отвечаем только на осмысленные действия, остальное молча отбрасываем
+            if message.is_command() or message.text in MENU_BUTTONS or message.photo:
+                await message.reply("⛔ Вы забанены навсегда. Доступ к боту закрыт.")
+            raise CancelHandler()
+        if message.text in MENU_BUTTONS:
+            if not ctx.accepted_rules:
+                await message.reply("Пожалуйста, используйте /start для начала.")
+                raise CancelHandler()
+            # Активность — до проверки блокировки: нажатия заблокированных тоже считаются
+            await self.db.update_user_activity(ctx.user_id)
+            if ctx.is_blocked and message.text != "📝 Проверить комментарий":
+                remaining = max(0, config.COMMENT_THRESHOLD - ctx.user['comment_balance'])
+                markup = InlineKeyboardMarkup().add(InlineKeyboardButton("📖 Инструкция", callback_data="instruction"))
+                await message.reply(
+                    f"⛔ Доступ временно заблокирован. Требуется {config.COMMENT_THRESHOLD} комментариев.\n"
+                    f"📝 Баланс: {ctx.user['comment_balance']}\n⏳ Осталось: {remaining}",
+                    reply_markup=markup
+                )
+                raise CancelHandler()
+
+    async def on_pre_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        ctx = await self._resolve(call.from_user.id, data)
+        if ctx.is_banned:
+            await call.answer("Вы забанены навсегда.")
+            raise CancelHandler()
+
+# ==================== ОБРАБОТЧИКИ ====================
+
+class Handlers:
+    def __init__(self, dp: Dispatcher, bot: Bot, db: Database,
+                 state_manager: UserStateManager, logger: Logger,
+                 rate_limiter: Optional[RateLimiter] = None):
+        self.dp = dp
+        self.bot = bot
+        self.db = db
+        self.state_manager = state_manager
+        self.logger = logger
+        # Пустой RateLimiter ложен (__len__), поэтому сравнение с None, а не `or`
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter(config.RATE_LIMIT_IDLE_TTL)
+        # Фоновые задачи вне критического пути ответа пользователю (уведомления админам, рассылки)
+        self._background_tasks: set = set()
+        # Выставляется при остановке: долгие фоновые задачи сохраняют прогресс и выходят
+        self.stopping = False
+        # RuntimeInspector для /debug; подключается после создания очередей приёма
+        self.inspector = None
+
+    def _in_state(self, state: UserState):
+        """Фильтр хэндлера по состоянию диалога. Проверять состояние в теле хэндлера нельзя:
+        message-хэндлеры срабатывают по первому совпадению, и хэндлер без фильтров
+        перехватывал все сообщения, до следующих по порядку не доходило"""
+        async def check(message: types.Message) -> bool:
+            return await self.state_manager.has_state(message.from_user.id, state)
+        return check
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    async def wait_background(self):
+        while self._background_tasks:
+            await asyncio.gather(*list(self._background_tasks), return_exceptions=True)
+
+    async def cancel_background(self):
+        tasks = list(self._background_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def resume_broadcasts(self):
+        """Досылает рассылки, прерванные прошлой остановкой бота"""
+        for row in await self.db.get_interrupted_broadcasts():
+            user_ids = json.loads(row['recipient_ids'])
+            offset = row['sent_offset']
+            self.logger.info(f"Возобновление рассылки {row['id']} ({row['status']}): "
+                             f"осталось получателей {len(user_ids) - offset}")
+            self._spawn(self._run_broadcast(
+                row['id'], row['admin_id'], user_ids, row['message_text'], row['link'],
+                row['reward_amount'], row['sent_count'], row['error_count'], offset
+            ))
+
+    def register_all(self):
+        self._register_common()
+        self._register_comment()
+        self._register_withdraw()
+        self._register_admin()
+        # Добавляем общий обработчик для inline-кнопки инструкции
+        self.dp.callback_query_handler(lambda c: c.data == "instruction")(self.cmd_instruction)
+
+    # ---------- ВСПОМОГАТЕЛЬНЫЕ МЕТОДЫ ----------
+
+    async def _send_main_menu(self, chat_id: int, user_id: int, user: Optional[Dict] = None):
+        if user is None:
+            user = await self.db.get_user(user_id)
+        if not user:
+            return
+        banned = user['is_permanently_banned']
+        blocked = user['is_blocked']
+
+        if banned:
+            await self.bot.send_message(chat_id, "⛔ Вы забанены навсегда.")
+            return
+
+        if blocked:
+            remaining = max(0, config.COMMENT_THRESHOLD - user['comment_balance'])
+            text = (
+                f"🔒 *Доступ заблокирован*\n\n"
+                f"📝 Текущий баланс: {user['comment_balance']}\n"
+                f"⏳ Осталось для разблокировки: {remaining}\n\n"
+                f"Отправляйте скриншоты с упоминанием @{config.BOT_NAME} чтобы получить комментарии!"
+            )
+            # Добавляем inline-кнопку с инструкцией
+            markup = InlineKeyboardMarkup().add(InlineKeyboardButton("📖 Инструкция", callback_data="instruction"))
+            await self.bot.send_message(chat_id, text, reply_markup=markup)
+        else:
+            await self.bot.send_message(chat_id, "Главное меню:", reply_markup=KeyboardFactory.main())
 
     async def _show_rules(self, chat_id: int):
         markup = InlineKeyboardMarkup()
@@ -579,8 +2824,7 @@ class Handlers:
         )
         await self.bot.send_message(chat_id, text, parse_mode=ParseMode.MARKDOWN, reply_markup=markup)
 
-    async def _show_balance(self, message: types.Message):
-        user = await self.db.get_user(message.from_user.id)
+    async def _show_balance(self, message: types.Message, user: Optional[Dict]):
         if not user:
             return
         status = "🔒 Заблокирован" if user['is_blocked'] else "✅ Разблокирован"
@@ -592,7 +2836,10 @@ class Handlers:
         )
         if user['is_blocked']:
             text += f"⏳ До разблокировки: {remaining}\n"
-        text += f"💵 Денег: {user['money_balance']} руб.\n✅ Всего выполнено заданий: {user['tasks_completed']}"
+        text += f"💵 Денег: {user['money_balance']} руб.\n"
+        if user['money_held']:
+            text += f"⏳ В заявках на вывод: {user['money_held']} руб.\n"
+        text += f"✅ Всего выполнено заданий: {user['tasks_completed']}"
         await message.reply(text, parse_mode=ParseMode.MARKDOWN)
 
     async def _send_help(self, message: types.Message):
@@ -634,12 +2881,9 @@ class Handlers:
 
     def _register_common(self):
         @self.dp.message_handler(commands=['start'])
-        async def cmd_start(message: types.Message):
+        async def cmd_start(message: types.Message, user_ctx: UserContext):
             user_id = message.from_user.id
-            user = await self.db.get_user(user_id)
-            if user and user['is_permanently_banned']:
-                await message.reply("⛔ Вы забанены навсегда. Доступ к боту закрыт.")
-                return
+            user = user_ctx.user
             if user:
                 if user['accepted_rules']:
                     await self.db.update_user_activity(user_id)
@@ -661,7 +2905,7 @@ class Handlers:
                             reply_markup=markup
                         )
                     else:
-                        await self._send_main_menu(message.chat.id, user_id)
+                        await self._send_main_menu(message.chat.id, user_id, user)
                 else:
                     await self._show_rules(message.chat.id)
             else:
@@ -674,19 +2918,15 @@ class Handlers:
                 await self._show_rules(message.chat.id)
 
         @self.dp.message_handler(commands=['admin'])
-        async def cmd_admin(message: types.Message):
-            user_id = message.from_user.id
-            user = await self.db.get_user(user_id)
-            if user and user['is_admin']:
+        async def cmd_admin(message: types.Message, user_ctx: UserContext):
+            if user_ctx.is_admin:
                 await message.reply("🔧 Админ-панель", reply_markup=KeyboardFactory.admin())
             else:
                 await message.reply("У вас нет прав администратора.")
 
         @self.dp.message_handler(commands=['ban'])
-        async def cmd_ban(message: types.Message):
-            user_id = message.from_user.id
-            user = await self.db.get_user(user_id)
-            if not user or not user['is_admin']:
+        async def cmd_ban(message: types.Message, user_ctx: UserContext):
+            if not user_ctx.is_admin:
                 return
             args = message.get_args()
             if not args or not args.isdigit():
@@ -707,82 +2947,79 @@ class Handlers:
             except:
                 pass
 
+        @self.dp.message_handler(commands=['queries'])
+        async def cmd_queries(message: types.Message, user_ctx: UserContext):
+            if not user_ctx.is_admin:
+                return
+            await self._show_query_stats(message)
+
+        @self.dp.message_handler(commands=['debug'])
+        async def cmd_debug(message: types.Message, user_ctx: UserContext):
+            if not user_ctx.is_admin:
+                return
+            await self._show_debug(message)
+
         @self.dp.message_handler(commands=['stats'])
-        async def cmd_stats(message: types.Message):
-            user_id = message.from_user.id
-            user = await self.db.get_user(user_id)
-            if not user or user['is_permanently_banned']:
+        async def cmd_stats(message: types.Message, user_ctx: UserContext):
+            user = user_ctx.user
+            if not user:
                 await message.reply("Статистика недоступна.")
                 return
             status = "🔒 Заблокирован" if user['is_blocked'] else "✅ Разблокирован"
             remaining = max(0, config.COMMENT_THRESHOLD - user['comment_balance']) if user['is_blocked'] else 0
+            week_comments, month_comments = await self.db.get_user_comment_activity(user['user_id'])
             text = (
                 f"📊 *Твоя статистика:*\n"
-                f"📅 Регистрация: {user['registration_date']}\n"
+                f"📅 Регистрация: {format_timestamp(user['registration_date'])}\n"
                 f"💬 Всего комментариев: {user['total_comments_ever']}\n"
+                f"📆 За неделю: {week_comments}, за месяц: {month_comments}\n"
                 f"📝 Текущий баланс: {user['comment_balance']}\n"
                 f"🔒 Статус: {status}\n"
             )
             if user['is_blocked']:
                 text += f"⏳ Осталось: {remaining}\n"
             text += f"✅ Заданий: {user['tasks_completed']}\n💰 Денег: {user['money_balance']} руб."
+            if not user['is_permanently_banned']:
+                for column, title in (('comment_balance', "по комментариям"), ('tasks_completed', "по заданиям")):
+                    rank, total = await self.db.get_rank(column, user[column])
+                    text += f"\n🏆 Место {title}: {f'{rank} из {total}' if rank else '—'}"
             await message.reply(text, parse_mode=ParseMode.MARKDOWN)
 
         @self.dp.message_handler(commands=['help'])
         async def cmd_help(message: types.Message):
             await self._send_help(message)
 
-        @self.dp.message_handler(lambda m: m.text in [
-            "📝 Проверить комментарий", "💰 Мой баланс", "💎 Вывод средств",
-            "📊 Статистика", "❓ Помощь"
-        ])
-        async def handle_menu_buttons(message: types.Message):
-            user_id = message.from_user.id
-            user = await self.db.get_user(user_id)
-            if not user or not user['accepted_rules']:
-                await message.reply("Пожалуйста, используйте /start для начала.")
-                return
-            if user['is_permanently_banned']:
-                await message.reply("⛔ Вы забанены навсегда. Доступ к боту закрыт.")
-                return
-            await self.db.update_user_activity(user_id)
-
-            if user['is_blocked'] and message.text != "📝 Проверить комментарий":
-                remaining = max(0, config.COMMENT_THRESHOLD - user['comment_balance'])
-                markup = InlineKeyboardMarkup().add(InlineKeyboardButton("📖 Инструкция", callback_data="instruction"))
-                await message.reply(
-                    f"⛔ Доступ временно заблокирован. Требуется {config.COMMENT_THRESHOLD} комментариев.\n"
-                    f"📝 Баланс: {user['comment_balance']}\n⏳ Осталось: {remaining}",
-                    reply_markup=markup
-                )
-                return
-
+        @self.dp.message_handler(lambda m: m.text in MENU_BUTTONS)
+        @rate_limit(config.RATE_LIMIT_MENU_RATE, burst=config.RATE_LIMIT_MENU_BURST)
+        async def handle_menu_buttons(message: types.Message, user_ctx: UserContext):
+            # Бан, принятие правил и блокировка проверены в UserContextMiddleware, там же
+            # обновляется last_activity
             if message.text == "📝 Проверить комментарий":
                 await self._handle_check_comment(message)
             elif message.text == "💰 Мой баланс":
-                await self._show_balance(message)
+                await self._show_balance(message, user_ctx.user)
             elif message.text == "💎 Вывод средств":
-                await self._start_withdrawal(message)
+                await self._start_withdrawal(message, user_ctx.user)
             elif message.text == "📊 Статистика":
-                await cmd_stats(message)
+                await cmd_stats(message, user_ctx)
             elif message.text == "❓ Помощь":
                 await self._send_help(message)
 
         @self.dp.callback_query_handler(lambda c: c.data == "accept_rules")
-        async def accept_rules(call: types.CallbackQuery):
+        async def accept_rules(call: types.CallbackQuery, user_ctx: UserContext):
             user_id = call.from_user.id
             await self.db.set_accepted_rules(user_id)
+            user_ctx.patch(accepted_rules=1)
             await call.answer("Правила приняты!")
             await call.message.delete()
-            user = await self.db.get_user(user_id)
-            if user['is_blocked']:
+            if user_ctx.is_blocked:
                 markup = InlineKeyboardMarkup().add(InlineKeyboardButton("📖 Инструкция", callback_data="instruction"))
                 await call.message.answer(
                     "🔒 Доступ заблокирован. Требуется 10 комментариев для разблокировки.",
                     reply_markup=markup
                 )
             else:
-                await self._send_main_menu(call.message.chat.id, user_id)
+                await self._send_main_menu(call.message.chat.id, user_id, user_ctx.user)
 
         @self.dp.callback_query_handler(lambda c: c.data == "reject_rules")
         async def reject_rules(call: types.CallbackQuery):
@@ -794,68 +3031,51 @@ class Handlers:
 
     def _register_comment(self):
         @self.dp.message_handler(lambda m: m.text == "❌ Отмена")
-        async def cancel_photo(message: types.Message):
+        async def cancel_photo(message: types.Message, user_ctx: UserContext):
             # Проверяем состояние внутри хэндлера
             if await self.state_manager.has_state(message.from_user.id, UserState.WAITING_PHOTO):
                 await self.state_manager.clear_state(message.from_user.id)
-                user = await self.db.get_user(message.from_user.id)
-                banned = user['is_permanently_banned'] if user else False
-                blocked = user['is_blocked'] if user else True
                 await message.reply(
                     "❌ Отправка фото отменена. Возврат в главное меню.",
-                    reply_markup=KeyboardFactory.main(blocked, banned)
+                    reply_markup=KeyboardFactory.main(user_ctx.is_blocked, user_ctx.is_banned)
                 )
 
         @self.dp.message_handler(content_types=['photo'])
-        async def photo_message(message: types.Message):
+        async def photo_message(message: types.Message, user_ctx: UserContext):
             # Проверяем состояние
             if not await self.state_manager.has_state(message.from_user.id, UserState.WAITING_PHOTO):
-                user = await self.db.get_user(message.from_user.id)
                 await message.reply(
                     "❌ Сначала нажмите кнопку '📝 Проверить комментарий' в меню.",
-                    reply_markup=KeyboardFactory.main(user['is_blocked'] if user else True)
+                    reply_markup=KeyboardFactory.main(user_ctx.is_blocked)
                 )
                 return
-            await self._handle_photo(message)
+            await self._handle_photo(message, user_ctx)
 
-        @self.dp.message_handler()
+        # Пользователь в состоянии WAITING_PHOTO прислал не фото
+        @self.dp.message_handler(self._in_state(UserState.WAITING_PHOTO))
         async def unexpected_message(message: types.Message):
-            # Если пользователь в состоянии WAITING_PHOTO и прислал не фото
-            if await self.state_manager.has_state(message.from_user.id, UserState.WAITING_PHOTO):
-                await message.reply(
-                    "❌ Пожалуйста, отправьте ФОТО (изображение).\n\n"
-                    "Для отмены нажмите кнопку '❌ Отмена' в меню."
-                )
+            await message.reply(
+                "❌ Пожалуйста, отправьте ФОТО (изображение).\n\n"
+                "Для отмены нажмите кнопку '❌ Отмена' в меню."
+            )
 
     # ---------- ОБРАБОТЧИКИ ВЫВОДА (ИСПРАВЛЕННЫЕ) ----------
 
     def _register_withdraw(self):
         @self.dp.callback_query_handler(lambda c: c.data.startswith("withdraw_"))
-        async def withdraw_method(call: types.CallbackQuery):
-            if await self.db.is_permanently_banned(call.from_user.id):
-                await call.answer("Вы забанены навсегда.")
-                return
-            await self._callback_withdraw_method(call)
+        async def withdraw_method(call: types.CallbackQuery, user_ctx: UserContext):
+            await self._callback_withdraw_method(call, user_ctx.user)
 
-        @self.dp.message_handler()
-        async def withdraw_amount(message: types.Message):
-            if await self.state_manager.has_state(message.from_user.id, UserState.WAITING_WITHDRAW_AMOUNT):
-                if await self.db.is_permanently_banned(message.from_user.id):
-                    await message.reply("Вы забанены навсегда.")
-                    return
-                await self._handle_withdraw_amount(message)
+        @self.dp.message_handler(self._in_state(UserState.WAITING_WITHDRAW_AMOUNT))
+        async def withdraw_amount(message: types.Message, user_ctx: UserContext):
+            await self._handle_withdraw_amount(message, user_ctx.user)
 
-        @self.dp.message_handler()
+        @self.dp.message_handler(self._in_state(UserState.WAITING_WITHDRAW_DETAILS))
         async def withdraw_details(message: types.Message):
-            if await self.state_manager.has_state(message.from_user.id, UserState.WAITING_WITHDRAW_DETAILS):
-                if await self.db.is_permanently_banned(message.from_user.id):
-                    await message.reply("Вы забанены навсегда.")
-                    return
-                await self._handle_withdraw_details(message)
+            await self._handle_withdraw_details(message)
 
-    async def _start_withdrawal(self, message: types.Message):
-        user_id = message.from_user.id
-        money = await self.db.get_money_balance(user_id)
+    async def _start_withdrawal(self, message: types.Message, user: Optional[Dict]):
+        money = user['money_balance'] if user else 0
         # Проверяем, что хватает хотя бы на минимальный вывод (телефон 100)
         if money < config.MIN_WITHDRAW_PHONE:
             await message.reply(
@@ -869,10 +3089,10 @@ class Handlers:
         )
         await message.reply("Выберите способ вывода:", reply_markup=markup)
 
-    async def _callback_withdraw_method(self, call: types.CallbackQuery):
+    async def _callback_withdraw_method(self, call: types.CallbackQuery, user: Optional[Dict]):
         user_id = call.from_user.id
         method = call.data.split('_')[1]  # 'card' или 'phone'
-        money = await self.db.get_money_balance(user_id)
+        money = user['money_balance'] if user else 0
         min_amount = config.MIN_WITHDRAW_CARD if method == 'card' else config.MIN_WITHDRAW_PHONE
         if money < min_amount:
             await call.answer(f"Недостаточно средств. Минимум {min_amount}₽", show_alert=True)
@@ -883,7 +3103,7 @@ class Handlers:
             f"Введите сумму для вывода (минимум {min_amount}₽, целое число):"
         )
 
-    async def _handle_withdraw_amount(self, message: types.Message):
+    async def _handle_withdraw_amount(self, message: types.Message, user: Optional[Dict]):
         user_id = message.from_user.id
         data = await self.state_manager.get_data(user_id)
         method = data.get('method')
@@ -905,7 +3125,7 @@ class Handlers:
             await message.reply(f"Сумма должна быть не меньше {min_amount}₽.")
             return
 
-        money = await self.db.get_money_balance(user_id)
+        money = user['money_balance'] if user else 0
         if amount > money:
             await message.reply(f"Недостаточно средств. Ваш баланс: {money}₽.")
             return
@@ -936,10 +3156,15 @@ class Handlers:
                 await message.reply("Пожалуйста, введите номер телефона.")
                 return
 
-        await self.db.create_withdrawal(user_id, amount, method, details)
+        created = await self.db.create_withdrawal(user_id, amount, method, details)
         await self.state_manager.clear_state(user_id)
+        if not created:
+            # Баланс мог уменьшиться после ввода суммы (другая заявка, списание админом)
+            money = await self.db.get_money_balance(user_id)
+            await message.reply(f"Недостаточно средств. Ваш баланс: {money}₽.")
+            return
 
-        await message.reply("✅ Заявка на вывод создана. Ожидайте решения администратора.")
+        await message.reply(f"✅ Заявка на вывод создана, {amount}₽ зарезервировано. Ожидайте решения администратора.")
 
         for admin_id in config.ADMIN_IDS:
             try:
@@ -960,10 +3185,9 @@ class Handlers:
             "👥 Рассылка", "💰 Управление балансами", "📊 Статистика",
             "📤 Экспорт ID", "🔧 Тикеты на выплату", "🔙 Назад в меню"
         ])
-        async def handle_admin_buttons(message: types.Message):
+        async def handle_admin_buttons(message: types.Message, user_ctx: UserContext):
             user_id = message.from_user.id
-            user = await self.db.get_user(user_id)
-            if not user or not user['is_admin']:
+            if not user_ctx.is_admin:
                 return
             if message.text == "👥 Рассылка":
                 await self._start_broadcast(message)
@@ -972,71 +3196,88 @@ class Handlers:
             elif message.text == "📊 Статистика":
                 await self._show_admin_stats(message)
             elif message.text == "📤 Экспорт ID":
-                await self._export_user_ids(message)
+                await self._start_export(message)
             elif message.text == "🔧 Тикеты на выплату":
                 await self._show_pending_withdrawals(message)
             elif message.text == "🔙 Назад в меню":
-                await self._send_main_menu(message.chat.id, user_id)
+                await self._send_main_menu(message.chat.id, user_id, user_ctx.user)
 
-        # Обработчики состояний рассылки (проверка внутри)
-        @self.dp.message_handler()
+        # Обработчики состояний рассылки
+        @self.dp.message_handler(self._in_state(UserState.BROADCAST_TARGET_TYPE))
         async def handle_broadcast_target_type(message: types.Message):
-            if await self.state_manager.has_state(message.from_user.id, UserState.BROADCAST_TARGET_TYPE):
-                await self._handle_broadcast_target_type(message)
+            await self._handle_broadcast_target_type(message)
 
-        @self.dp.message_handler()
+        @self.dp.message_handler(self._in_state(UserState.BROADCAST_COUNT))
         async def handle_broadcast_count(message: types.Message):
-            if await self.state_manager.has_state(message.from_user.id, UserState.BROADCAST_COUNT):
-                await self._handle_broadcast_count(message)
+            await self._handle_broadcast_count(message)
 
-        @self.dp.message_handler()
+        @self.dp.message_handler(self._in_state(UserState.BROADCAST_SORT))
         async def handle_broadcast_sort(message: types.Message):
-            if await self.state_manager.has_state(message.from_user.id, UserState.BROADCAST_SORT):
-                await self._handle_broadcast_sort(message)
+            await self._handle_broadcast_sort(message)
 
-        @self.dp.message_handler()
+        @self.dp.message_handler(self._in_state(UserState.BROADCAST_TEXT))
         async def handle_broadcast_text(message: types.Message):
-            if await self.state_manager.has_state(message.from_user.id, UserState.BROADCAST_TEXT):
-                await self._handle_broadcast_text(message)
+            await self._handle_broadcast_text(message)
 
-        @self.dp.message_handler()
+        @self.dp.message_handler(self._in_state(UserState.BROADCAST_LINK))
         async def handle_broadcast_link(message: types.Message):
-            if await self.state_manager.has_state(message.from_user.id, UserState.BROADCAST_LINK):
-                await self._handle_broadcast_link(message)
+            await self._handle_broadcast_link(message)
 
-        @self.dp.message_handler()
+        @self.dp.message_handler(self._in_state(UserState.BROADCAST_REWARD))
         async def handle_broadcast_reward(message: types.Message):
-            if await self.state_manager.has_state(message.from_user.id, UserState.BROADCAST_REWARD):
-                await self._handle_broadcast_reward(message)
+            await self._handle_broadcast_reward(message)
 
         @self.dp.callback_query_handler(lambda c: c.data.startswith('complete_'))
+        @rate_limit(config.RATE_LIMIT_TASK_RATE, burst=config.RATE_LIMIT_TASK_BURST)
         async def callback_complete_task(call: types.CallbackQuery):
             await self._callback_complete_task(call)
 
         # Управление балансами
-        @self.dp.message_handler()
+        @self.dp.message_handler(self._in_state(UserState.MANAGE_BALANCES_SEARCH))
         async def handle_balance_search(message: types.Message):
-            if await self.state_manager.has_state(message.from_user.id, UserState.MANAGE_BALANCES_SEARCH):
-                await self._handle_balance_search(message)
+            await self._handle_balance_search(message)
 
         @self.dp.callback_query_handler(lambda c: c.data.startswith('mod_'))
-        async def callback_balance_modification(call: types.CallbackQuery):
-            await self._callback_balance_modification(call)
+        async def callback_balance_modification(call: types.CallbackQuery, user_ctx: UserContext):
+            await self._callback_balance_modification(call, user_ctx.user)
 
-        @self.dp.message_handler()
+        @self.dp.message_handler(self._in_state(UserState.MANAGE_BALANCES_ACTIONS))
         async def handle_balance_change(message: types.Message):
-            if await self.state_manager.has_state(message.from_user.id, UserState.MANAGE_BALANCES_ACTIONS):
-                await self._handle_balance_change(message)
+            await self._handle_balance_change(message)
+
+        @self.dp.message_handler(self._in_state(UserState.MANAGE_BALANCES_SEARCH), content_types=['document'])
+        async def handle_balance_csv(message: types.Message):
+            await self._handle_balance_csv(message)
+
+        @self.dp.callback_query_handler(lambda c: c.data.startswith('bal_csv:'))
+        async def callback_balance_csv(call: types.CallbackQuery, user_ctx: UserContext):
+            await self._callback_balance_csv(call, user_ctx.is_admin)
 
         # Заявки на вывод
         @self.dp.callback_query_handler(lambda c: c.data.startswith(('approve_', 'reject_')))
-        async def callback_withdrawal_action(call: types.CallbackQuery):
-            await self._callback_withdrawal_action(call)
+        async def callback_withdrawal_action(call: types.CallbackQuery, user_ctx: UserContext):
+            await self._callback_withdrawal_action(call, user_ctx.is_admin)
+
+        @self.dp.callback_query_handler(lambda c: c.data.startswith('wd:'))
+        async def callback_withdrawal_review(call: types.CallbackQuery, user_ctx: UserContext):
+            await self._callback_withdrawal_review(call, user_ctx.is_admin)
+
+        @self.dp.message_handler(self._in_state(UserState.WITHDRAW_BULK_FILTER))
+        async def handle_withdraw_bulk_filter(message: types.Message):
+            await self._handle_withdraw_bulk_filter(message)
 
-        @self.dp.message_handler()
+        @self.dp.message_handler(self._in_state(UserState.WAITING_REJECT_REASON))
         async def handle_reject_reason(message: types.Message):
-            if await self.state_manager.has_state(message.from_user.id, UserState.WAITING_REJECT_REASON):
-                await self._handle_reject_reason(message)
+            await self._handle_reject_reason(message)
+
+        # Экспорт пользователей
+        @self.dp.callback_query_handler(lambda c: c.data.startswith('export_'))
+        async def callback_export(call: types.CallbackQuery, user_ctx: UserContext):
+            await self._callback_export(call, user_ctx.is_admin)
+
+        @self.dp.message_handler(self._in_state(UserState.EXPORT_OPTIONS))
+        async def handle_export_period(message: types.Message):
+            await self._handle_export_period(message)
 
     # ---------- МЕТОДЫ РАССЫЛКИ ----------
     async def _start_broadcast(self, message: types.Message):
@@ -1049,11 +3290,10 @@ class Handlers:
     async def _handle_broadcast_target_type(self, message: types.Message):
         user_id = message.from_user.id
         if message.text == "1️⃣ Все пользователи":
-            await self.state_manager.update_data(user_id, target_type='all')
-            await self.state_manager.set_state(user_id, UserState.BROADCAST_TEXT)
+            await self.state_manager.advance(user_id, UserState.BROADCAST_TEXT, target_type='all')
             await message.reply("Введите текст сообщения для рассылки:")
         elif message.text == "2️⃣ Своё количество":
-            await self.state_manager.set_state(user_id, UserState.BROADCAST_COUNT)
+            await self.state_manager.advance(user_id, UserState.BROADCAST_COUNT)
             await message.reply("Введите количество пользователей для выборки:")
         else:
             await message.reply("Пожалуйста, выберите пункт меню.")
@@ -1067,8 +3307,7 @@ class Handlers:
         except ValueError:
             await message.reply("Введите положительное целое число.")
             return
-        await self.state_manager.update_data(user_id, count=count)
-        await self.state_manager.set_state(user_id, UserState.BROADCAST_SORT)
+        await self.state_manager.advance(user_id, UserState.BROADCAST_SORT, count=count)
         markup = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
         markup.add("1️⃣ Самые активные", "2️⃣ Самые неактивные", "3️⃣ Случайные")
         await message.reply("Выберите сортировку:", reply_markup=markup)
@@ -1084,21 +3323,18 @@ class Handlers:
         if text not in sort_map:
             await message.reply("Пожалуйста, выберите пункт меню.")
             return
-        await self.state_manager.update_data(user_id, target_type=sort_map[text])
-        await self.state_manager.set_state(user_id, UserState.BROADCAST_TEXT)
+        await self.state_manager.advance(user_id, UserState.BROADCAST_TEXT, target_type=sort_map[text])
         await message.reply("Введите текст сообщения для рассылки:")
 
     async def _handle_broadcast_text(self, message: types.Message):
         user_id = message.from_user.id
-        await self.state_manager.update_data(user_id, message_text=message.text)
-        await self.state_manager.set_state(user_id, UserState.BROADCAST_LINK)
+        await self.state_manager.advance(user_id, UserState.BROADCAST_LINK, message_text=message.text)
         await message.reply("Введите ссылку для кнопки (или отправьте '-' если ссылки не будет):")
 
     async def _handle_broadcast_link(self, message: types.Message):
         user_id = message.from_user.id
         link = message.text if message.text != '-' else None
-        await self.state_manager.update_data(user_id, link=link)
-        await self.state_manager.set_state(user_id, UserState.BROADCAST_REWARD)
+        await self.state_manager.advance(user_id, UserState.BROADCAST_REWARD, link=link)
         await message.reply("Введите сумму награды за выполнение задания (целое число рублей):")
 
     async def _handle_broadcast_reward(self, message: types.Message):
@@ -1122,38 +3358,45 @@ class Handlers:
             await message.reply("Нет пользователей для рассылки.")
             return
 
-        broadcast_id = int(time.time())
-        async with self.db._get_conn_sync() as conn:
-            cur = conn.cursor()
-            cur.execute('''
-                INSERT INTO broadcasts 
-                (admin_id, target_type, target_count, message_text, link, reward_amount, sent_count, error_count, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, 0, 0, ?)
-            ''', (user_id, data['target_type'], data.get('count', 0), data['message_text'], data.get('link'), reward, datetime.now()))
-            conn.commit()
-            broadcast_db_id = cur.lastrowid
+        broadcast_id = await self.db.create_broadcast(
+            user_id, data['target_type'], data.get('count', 0), data['message_text'], data.get('link'), reward, user_ids
+        )
+        # Рассылка идёт в фоне: очередь апдейтов админа не занята на всё время отправки
+        await message.reply(f"📨 Рассылка запущена, получателей: {len(user_ids)}. Итог пришлю по завершении.")
+        self._spawn(self._run_broadcast(broadcast_id, user_id, user_ids, data['message_text'], data.get('link'), reward))
 
+    async def _run_broadcast(self, broadcast_id: int, admin_id: int, user_ids: List[int], text: str,
+                             link: Optional[str], reward: int, sent: int = 0, errors: int = 0, offset: int = 0):
         markup = None
-        if data.get('link'):
+        if link:
             markup = InlineKeyboardMarkup()
-            markup.add(InlineKeyboardButton("✅ Выполнить", callback_data=f"complete_{broadcast_db_id}_{reward}"))
+            markup.add(InlineKeyboardButton("✅ Выполнить", callback_data=f"complete_{broadcast_id}_{reward}"))
 
-        sent = 0
-        errors = 0
-        for uid in user_ids:
-            try:
-                await self.bot.send_message(uid, data['message_text'], reply_markup=markup)
-                sent += 1
+        try:
+            while offset < len(user_ids) and not self.stopping:
+                try:
+                    await self.bot.send_message(user_ids[offset], text, reply_markup=markup)
+                    sent += 1
+                    metrics.inc('rudeps_broadcast_messages_total', 'sent')
+                except Exception:
+                    errors += 1
+                    metrics.inc('rudeps_broadcast_messages_total', 'error')
+                offset += 1
+                # Периодическая контрольная точка: после аварийного падения повторно уйдёт не больше сотни сообщений
+                if offset % 100 == 0:
+                    await self.db.update_broadcast_progress(broadcast_id, sent, errors, offset)
                 await asyncio.sleep(0.05)
-            except Exception:
-                errors += 1
-
-        async with self.db._get_conn_sync() as conn:
-            cur = conn.cursor()
-            cur.execute('UPDATE broadcasts SET sent_count = ?, error_count = ? WHERE id = ?', (sent, errors, broadcast_db_id))
-            conn.commit()
-
-        await message.reply(f"✅ Рассылка завершена.\n📨 Отправлено: {sent}\n❌ Ошибок: {errors}")
+        finally:
+            # Выполняется и при отмене задачи: смещение сохраняется для resume_broadcasts
+            status = 'done' if offset >= len(user_ids) else 'interrupted'
+            await self.db.update_broadcast_progress(broadcast_id, sent, errors, offset, status)
+        if offset < len(user_ids):
+            self.logger.info(f"Рассылка {broadcast_id} прервана остановкой, осталось получателей: {len(user_ids) - offset}")
+            return
+        try:
+            await self.bot.send_message(admin_id, f"✅ Рассылка завершена.\n📨 Отправлено: {sent}\n❌ Ошибок: {errors}")
+        except Exception as e:
+            self.logger.error(f"Не удалось отправить итог рассылки {broadcast_id}: {e}")
 
     async def _callback_complete_task(self, call: types.CallbackQuery):
         user_id = call.from_user.id
@@ -1163,25 +3406,59 @@ class Handlers:
             reward = int(parts[2])
         except:
             broadcast_id, reward = 0, 0
-        await self.db.increment_tasks_completed(user_id, reward)
-        link = None
-        if broadcast_id:
-            async with self.db._get_conn_sync() as conn:
-                cur = conn.cursor()
-                cur.execute("SELECT link FROM broadcasts WHERE id = ?", (broadcast_id,))
-                row = cur.fetchone()
-                if row:
-                    link = row[0]
+        await self.db.increment_tasks_completed(user_id, reward, broadcast_id or None)
+        link = await self.db.get_broadcast_link(broadcast_id) if broadcast_id else None
         await call.answer("Задание выполнено! Награда начислена.")
         await call.message.reply(f"✅ Спасибо за выполнение! Начислено {reward}₽ на ваш баланс.")
         if link:
             await call.message.reply(f"🔗 Ваша ссылка для перехода: {link}")
 
+    async def _show_query_stats(self, message: types.Message):
+        profiler = self.db.profiler
+        if not profiler:
+            await message.reply("Профилирование запросов выключено (SLOW_QUERY_MS=0).")
+            return
+        rows = profiler.top(config.SLOW_QUERY_TOP)
+        if not rows:
+            await message.reply("Запросов пока не было.")
+            return
+        lines = []
+        for row in rows:
+            scan = " ⚠️ SCAN" if row['full_scan'] else ""
+            lines.append(
+                f"{row['count']}× ср. {row['total'] / row['count'] * 1000:.1f} мс, "
+                f"макс. {row['max'] * 1000:.1f} мс, всего {row['total'] * 1000:.0f} мс{scan}\n  {row['query'][:200]}"
+            )
+        # Блок кода: SQL с * и _ иначе ломает Markdown
+        text = "\n".join(lines)
+        await message.reply(f"🐢 Запросы по суммарному времени (порог {profiler.slow_seconds * 1000:g} мс):\n```\n{text}\n```")
+
+    async def _show_debug(self, message: types.Message):
+        """/debug — снимок внутренностей процесса; /debug mem [start|stop] — tracemalloc"""
+        if not self.inspector:
+            await message.reply("Отладочная информация недоступна.")
+            return
+        args = message.get_args().split()
+        if args and args[0] == 'mem':
+            result = await self.inspector.memory(args[1] if len(args) > 1 else '', config.DEBUG_MEMORY_TOP)
+            if isinstance(result, str):
+                await message.reply(result)
+                return
+            text = "\n".join(result) or "нет данных"
+        else:
+            text = json.dumps(self.inspector.snapshot(), ensure_ascii=False, indent=1)
+        # Блок кода: пути и имена с _ иначе ломают Markdown
+        await message.reply(f"```\n{text[:4000]}\n```")
+
     # ---------- УПРАВЛЕНИЕ БАЛАНСАМИ ----------
     async def _start_balance_management(self, message: types.Message):
         user_id = message.from_user.id
         await self.state_manager.set_state(user_id, UserState.MANAGE_BALANCES_SEARCH)
-        await message.reply("Введите ID пользователя или username (без @) для поиска:")
+        await message.reply(
+            "Введите ID пользователя или username (без @) для поиска.\n\n"
+            "Для массовой корректировки пришлите CSV-файл: по строке на корректировку, колонки "
+            "user\\_id, комментарии, рубли, примечание (например `123456,5,-100,возврат`)."
+        )
 
     async def _handle_balance_search(self, message: types.Message):
         admin_id = message.from_user.id
@@ -1197,7 +3474,7 @@ class Handlers:
         text = (
             f"👤 Пользователь: {name} (ID: {user['user_id']})\n"
             f"📝 Комментариев: {user['comment_balance']}\n"
-            f"💰 Денег: {user['money_balance']} руб.\n"
+            f"💰 Денег: {user['money_balance']} руб. (в заявках: {user['money_held']})\n"
             f"✅ Заданий выполнено: {user['tasks_completed']}\n"
             f"🔒 Заблокирован: {'Да' if user['is_blocked'] else 'Нет'}\n"
             f"⛔ Забанен навсегда: {'Да' if user['is_permanently_banned'] else 'Нет'}"
@@ -1212,7 +3489,7 @@ class Handlers:
         )
         await message.reply(text, reply_markup=markup)
 
-    async def _callback_balance_modification(self, call: types.CallbackQuery):
+    async def _callback_balance_modification(self, call: types.CallbackQuery, admin: Optional[Dict]):
         admin_id = call.from_user.id
         data = call.data
         if not await self.state_manager.has_state(admin_id, UserState.MANAGE_BALANCES_ACTIONS):
@@ -1240,7 +3517,7 @@ class Handlers:
             await self.state_manager.clear_state(admin_id)
             await call.answer("Готово.")
             await call.message.edit_reply_markup(reply_markup=None)
-            await self._send_main_menu(call.message.chat.id, admin_id)
+            await self._send_main_menu(call.message.chat.id, admin_id, admin)
 
     async def _handle_balance_change(self, message: types.Message):
         admin_id = message.from_user.id
@@ -1260,10 +3537,10 @@ class Handlers:
             return
         user_id = target_user['user_id']
         if action == 'comment_add':
-            await self.db._execute("UPDATE users SET comment_balance = comment_balance + ? WHERE user_id = ?", (amount, user_id), commit=True)
+            await self.db.change_comment_balance(user_id, amount)
             await message.reply(f"✅ Начислено {amount} комментариев пользователю {user_id}")
         elif action == 'comment_sub':
-            await self.db._execute("UPDATE users SET comment_balance = comment_balance - ? WHERE user_id = ?", (amount, user_id), commit=True)
+            await self.db.change_comment_balance(user_id, -amount)
             await message.reply(f"✅ Списано {amount} комментариев у пользователя {user_id}")
         elif action == 'money_add':
             await self.db.add_money(user_id, amount)
@@ -1274,6 +3551,155 @@ class Handlers:
         await self.state_manager.clear_state(admin_id)
         await self._start_balance_management(message)
 
+    async def _download_balance_csv(self, file_id: str):
+        """Файл корректировок во временный файл и его sha256 — идентификатор пачки"""
+        file_info = await self.bot.get_file(file_id)
+        spool = tempfile.SpooledTemporaryFile(max_size=config.EXPORT_SPOOL_BYTES)
+        stream = await self.bot.download_file(file_info.file_path, destination=spool)
+        if stream is not spool:
+            spool.close()
+
+        def digest():
+            sha = hashlib.sha256()
+            for block in iter(lambda: stream.read(1024 * 1024), b''):
+                sha.update(block)
+            stream.seek(0)
+            return sha.hexdigest()[:32]
+        return stream, await asyncio.get_event_loop().run_in_executor(None, digest)
+
+    async def _balance_csv_chunks(self, stream, summary: BalanceCsvSummary):
+        """Корректные строки файла пачками по BULK_BALANCE_CHUNK. Разбор идёт в пуле потоков
+        по пачке за раз, файл целиком в память не читается; ошибки разбора — в summary"""
+        parsed = parse_balance_csv(stream)
+        loop = asyncio.get_event_loop()
+        seen = 0
+        while True:
+            batch = await loop.run_in_executor(None, lambda: list(itertools.islice(parsed, config.BULK_BALANCE_CHUNK)))
+            if not batch:
+                return
+            rows = []
+            for line, row, error in batch:
+                seen += 1
+                if seen > config.BULK_BALANCE_MAX_ROWS:
+                    summary.error(line, f"в файле больше {config.BULK_BALANCE_MAX_ROWS} строк, остаток не обработан")
+                    if rows:
+                        yield rows
+                    return
+                if error:
+                    summary.error(line, error)
+                else:
+                    rows.append((line, *row))
+            if rows:
+                yield rows
+
+    async def _send_balance_csv_report(self, chat_id: int, summary: BalanceCsvSummary, title: str,
+                                       markup: Optional[InlineKeyboardMarkup] = None):
+        await self.bot.send_message(chat_id, summary.text(title), reply_markup=markup)
+        errors = summary.errors_file()
+        if errors:
+            await self.bot.send_document(chat_id, errors, caption=f"Ошибки: {len(summary.errors)} строк")
+
+    async def _handle_balance_csv(self, message: types.Message):
+        """Проверка файла корректировок: разбор, пользователи и балансы с учётом предыдущих строк
+        файла, уже применённые строки. Ничего не меняет — применение после подтверждения"""
+        admin_id = message.from_user.id
+        document = message.document
+        if document.file_size and document.file_size > config.BULK_BALANCE_MAX_BYTES:
+            await message.reply(f"Файл больше {config.BULK_BALANCE_MAX_BYTES // (1024 * 1024)} МБ — разбейте его на части.")
+            return
+        await message.reply("⏳ Проверяю файл…")
+        try:
+            stream, batch_id = await self._download_balance_csv(document.file_id)
+        except Exception as e:
+            self.logger.error(f"Ошибка скачивания файла корректировок: {e}")
+            await message.reply("❌ Ошибка при скачивании файла.")
+            return
+        summary = BalanceCsvSummary()
+        applied = await self.db.get_applied_adjustment_lines(batch_id)
+        balances: Dict[int, Tuple[int, int]] = {}
+        try:
+            async for rows in self._balance_csv_chunks(stream, summary):
+                unknown = list({row[1] for row in rows} - balances.keys())
+                if unknown:
+                    balances.update(await self.db.get_balances(unknown))
+                for row in rows:
+                    line, user_id, comments, money, _ = row
+                    if line in applied:
+                        summary.duplicates += 1
+                    elif user_id not in balances:
+                        summary.error(line, f"пользователь {user_id} не найден")
+                    elif (comments < 0 and balances[user_id][0] + comments < 0) or (money < 0 and balances[user_id][1] + money < 0):
+                        summary.error(line, f"баланс ушёл бы в минус (комментарии {balances[user_id][0]}, рубли {balances[user_id][1]})")
+                    else:
+                        balances[user_id] = (balances[user_id][0] + comments, balances[user_id][1] + money)
+                        summary.add(row)
+        finally:
+            stream.close()
+        markup = None
+        if summary.rows:
+            await self.state_manager.set_state(admin_id, UserState.BALANCE_CSV_CONFIRM,
+                                               file_id=document.file_id, batch_id=batch_id)
+            markup = InlineKeyboardMarkup(row_width=2)
+            markup.add(
+                InlineKeyboardButton(f"✅ Применить {summary.rows}", callback_data="bal_csv:apply"),
+                InlineKeyboardButton("❌ Отмена", callback_data="bal_csv:cancel"),
+            )
+        else:
+            await self.state_manager.clear_state(admin_id)
+        await self._send_balance_csv_report(message.chat.id, summary, "🔎 Проверка файла корректировок", markup)
+
+    async def _callback_balance_csv(self, call: types.CallbackQuery, is_admin: bool):
+        admin_id = call.from_user.id
+        if not is_admin:
+            await call.answer("Нет прав.")
+            return
+        if not await self.state_manager.has_state(admin_id, UserState.BALANCE_CSV_CONFIRM):
+            await call.answer("Сессия устарела. Пришлите файл заново.")
+            return
+        data = await self.state_manager.get_data(admin_id)
+        await self.state_manager.clear_state(admin_id)
+        await call.message.edit_reply_markup(reply_markup=None)
+        if call.data == 'bal_csv:cancel':
+            await call.answer("Отменено.")
+            return
+        await call.answer("Применяю…")
+        self._spawn(self._run_balance_csv(admin_id, call.message.chat.id, data['file_id'], data['batch_id']))
+
+    async def _run_balance_csv(self, admin_id: int, chat_id: int, file_id: str, batch_id: str):
+        """Применение пачками по BULK_BALANCE_CHUNK строк, каждая — своя транзакция. Прерванный
+        прогон безопасно повторить тем же файлом: применённые строки пропускаются"""
+        summary = BalanceCsvSummary()
+        started = time.perf_counter()
+        try:
+            stream, digest = await self._download_balance_csv(file_id)
+            try:
+                if digest != batch_id:
+                    raise ValueError("содержимое файла изменилось после проверки")
+                async for rows in self._balance_csv_chunks(stream, summary):
+                    result = await self.db.apply_balance_adjustments(batch_id, admin_id, rows)
+                    by_line = {row[0]: row for row in rows}
+                    for line in result['applied']:
+                        summary.add(by_line[line])
+                    summary.duplicates += len(result['duplicate'])
+                    for line in result['rejected']:
+                        summary.error(line, "не применено: баланс ушёл бы в минус или пользователь не найден")
+            finally:
+                stream.close()
+        except Exception as e:
+            self.logger.error(f"Массовая корректировка {batch_id} прервана: {e}")
+            await self.bot.send_message(
+                chat_id, f"❌ Применение прервано: {escape_markdown(e)}\nУспело применено строк: {summary.rows}. "
+                         f"Повторная загрузка того же файла применит только оставшиеся.")
+            return
+        metrics.inc('rudeps_balance_adjustments_total', 'applied', value=summary.rows)
+        metrics.inc('rudeps_balance_adjustments_total', 'duplicate', value=summary.duplicates)
+        metrics.inc('rudeps_balance_adjustments_total', 'error', value=len(summary.errors))
+        self.logger.info(f"Массовая корректировка {batch_id} от {admin_id}: применено {summary.rows}, "
+                         f"повторов {summary.duplicates}, ошибок {len(summary.errors)}, "
+                         f"рубли +{summary.money_added}/-{summary.money_removed}, "
+                         f"{time.perf_counter() - started:.1f} с")
+        await self._send_balance_csv_report(chat_id, summary, "✅ Корректировки применены")
+
     # ---------- СТАТИСТИКА ДЛЯ АДМИНА ----------
     async def _show_admin_stats(self, message: types.Message):
         total_users = await self.db.get_total_users()
@@ -1281,6 +3707,7 @@ class Handlers:
         blocked = await self.db.get_blocked_users()
         permanently_banned = await self.db.get_permanently_banned_users()
         total_photos = await self.db.get_total_unique_photos()
+        activity = await self.db.get_comment_activity()
         withdrawal_stats = await self.db.get_withdrawal_stats()
         top_comments = await self.db.get_top_comment_balance(10)
         top_tasks = await self.db.get_top_tasks_completed(10)
@@ -1292,6 +3719,8 @@ class Handlers:
             f"🔒 Временно заблокированных: {blocked}\n"
             f"⛔ Забанено навсегда: {permanently_banned}\n"
             f"📸 Всего уникальных фото: {total_photos}\n"
+            f"📆 Комментариев за неделю: {activity['week_comments']} (авторов: {activity['week_authors']})\n"
+            f"🗓 Комментариев за месяц: {activity['month_comments']} (авторов: {activity['month_authors']})\n"
             f"💳 Заявки на вывод:\n"
             f"  • Ожидают: {withdrawal_stats.get('pending', 0)}\n"
             f"  • Принято: {withdrawal_stats.get('approved', 0)}\n"
@@ -1309,43 +3738,297 @@ class Handlers:
             text += f"{name}: {tasks}\n"
         await message.reply(text, parse_mode=ParseMode.MARKDOWN)
 
-    async def _export_user_ids(self, message: types.Message):
-        ids = await self.db.get_all_user_ids()
-        filename = "user_ids.txt"
-        async with aiofiles.open(filename, 'w') as f:
-            await f.write('\n'.join(str(uid) for uid in ids))
-        with open(filename, 'rb') as f:
-            await self.bot.send_document(message.chat.id, types.InputFile(f), caption=f"📤 Экспортировано {len(ids)} ID пользователей")
-        os.remove(filename)
+    # ---------- ЭКСПОРТ ПОЛЬЗОВАТЕЛЕЙ ----------
+    async def _start_export(self, message: types.Message):
+        options = {'columns': ['user_id'], 'segment': 'all', 'registered_from': None, 'registered_to': None}
+        await self.state_manager.set_state(message.from_user.id, UserState.EXPORT_OPTIONS, **options)
+        await message.reply(self._export_summary(options), reply_markup=self._export_markup(options))
+
+    @staticmethod
+    def _export_summary(options: Dict) -> str:
+        columns = ', '.join(EXPORT_COLUMNS[c] for c in options['columns']) or "—"
+        period = f"{options.get('registered_from') or '…'} — {options.get('registered_to') or '…'}"
+        return (
+            f"📤 *Экспорт пользователей* (CSV в gzip)\n\n"
+            f"Колонки: {columns}\n"
+            f"Сегмент: {EXPORT_SEGMENTS[options['segment']][0]}\n"
+            f"Регистрация: {period}\n\n"
+            f"Период регистрации можно прислать сообщением: `ГГГГ-ММ-ДД ГГГГ-ММ-ДД` "
+            f"(открытую границу — `-`), просто `-` — без ограничения."
+        )
+
+    @staticmethod
+    def _export_markup(options: Dict) -> InlineKeyboardMarkup:
+        markup = InlineKeyboardMarkup(row_width=2)
+        markup.add(*[
+            InlineKeyboardButton(f"{'✅' if column in options['columns'] else '▫️'} {label}", callback_data=f"export_col:{column}")
+            for column, label in EXPORT_COLUMNS.items()
+        ])
+        markup.add(*[
+            InlineKeyboardButton(f"{'🔘' if segment == options['segment'] else '⚪'} {label}", callback_data=f"export_seg:{segment}")
+            for segment, (label, _) in EXPORT_SEGMENTS.items()
+        ])
+        markup.row(
+            InlineKeyboardButton("📤 Выгрузить", callback_data="export_run"),
+            InlineKeyboardButton("❌ Отмена", callback_data="export_cancel"),
+        )
+        return markup
+
+    async def _callback_export(self, call: types.CallbackQuery, is_admin: bool):
+        admin_id = call.from_user.id
+        if not is_admin:
+            await call.answer("Нет доступа.")
+            return
+        if not await self.state_manager.has_state(admin_id, UserState.EXPORT_OPTIONS):
+            await call.answer("Сессия устарела. Начните заново.")
+            return
+        options = await self.state_manager.get_data(admin_id)
+        action, _, value = call.data[len('export_'):].partition(':')
+        if action == 'col' and value in EXPORT_COLUMNS:
+            # Порядок колонок в файле — как в EXPORT_COLUMNS, а не в порядке нажатий
+            options['columns'] = [c for c in EXPORT_COLUMNS if (c in options['columns']) != (c == value)]
+        elif action == 'seg' and value in EXPORT_SEGMENTS:
+            options['segment'] = value
+        elif action == 'cancel':
+            await self.state_manager.clear_state(admin_id)
+            await call.answer("Экспорт отменён.")
+            await call.message.edit_reply_markup(reply_markup=None)
+            return
+        elif action == 'run':
+            if not options['columns']:
+                await call.answer("Выберите хотя бы одну колонку.")
+                return
+            await self.state_manager.clear_state(admin_id)
+            await call.answer("Экспорт запущен.")
+            await call.message.edit_reply_markup(reply_markup=None)
+            self._spawn(self._run_export(call.message.chat.id, options))
+            return
+        await self.state_manager.update_data(admin_id, **options)
+        await call.answer()
+        await call.message.edit_text(self._export_summary(options), reply_markup=self._export_markup(options))
+
+    async def _handle_export_period(self, message: types.Message):
+        admin_id = message.from_user.id
+        bounds = (message.text or '').split()
+        if bounds == ['-']:
+            bounds = ['-', '-']
+        try:
+            if len(bounds) != 2:
+                raise ValueError
+            registered_from, registered_to = (None if b == '-' else datetime.strptime(b, '%Y-%m-%d').strftime('%Y-%m-%d')
+                                              for b in bounds)
+            if registered_from and registered_to and registered_from > registered_to:
+                raise ValueError
+        except ValueError:
+            await message.reply("Формат: `ГГГГ-ММ-ДД ГГГГ-ММ-ДД`, начало не позже конца; открытую границу — `-`.")
+            return
+        await self.state_manager.update_data(admin_id, registered_from=registered_from, registered_to=registered_to)
+        options = await self.state_manager.get_data(admin_id)
+        await message.reply(self._export_summary(options), reply_markup=self._export_markup(options))
+
+    async def _run_export(self, chat_id: int, options: Dict):
+        """Постранично читает users и отправляет части по мере готовности: в памяти — страница
+        и буфер текущей части, а не весь список"""
+        columns = options['columns']
+        condition, params = export_filter(options['segment'], options.get('registered_from'), options.get('registered_to'))
+        writer = CsvGzipParts(columns, config.EXPORT_PART_BYTES, config.EXPORT_SPOOL_BYTES)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        started = time.perf_counter()
+        sent = 0
+        try:
+            async for rows in self.db.iter_users(columns, condition, params, config.EXPORT_PAGE_SIZE):
+                writer.write_rows(rows)
+                for part in writer.take_ready():
+                    sent += 1
+                    await self._send_export_part(chat_id, f"users-{stamp}-{sent}.csv.gz", part)
+            for part in writer.finish():
+                sent += 1
+                await self._send_export_part(chat_id, f"users-{stamp}-{sent}.csv.gz", part)
+        except Exception as e:
+            self.logger.error(f"Ошибка экспорта пользователей: {e}")
+            await self.bot.send_message(chat_id, "❌ Экспорт прерван из-за ошибки, подробности в логе.")
+            return
+        self.logger.info(f"Экспорт пользователей: {writer.rows} строк, частей {sent}, "
+                         f"{time.perf_counter() - started:.1f} с")
+        if not writer.rows:
+            await self.bot.send_message(chat_id, "📤 Под выбранные условия не подходит ни один пользователь.")
+            return
+        await self.bot.send_message(chat_id, f"📤 Экспортировано пользователей: {writer.rows}, файлов: {sent}")
+
+    async def _send_export_part(self, chat_id: int, filename: str, part: Tuple[Any, int]):
+        buffer, rows = part
+        try:
+            await self.bot.send_document(chat_id, types.InputFile(buffer, filename=filename), caption=f"{filename}: {rows} строк")
+        finally:
+            buffer.close()
 
     # ---------- ЗАЯВКИ НА ВЫВОД ----------
     async def _show_pending_withdrawals(self, message: types.Message):
-        withdrawals = await self.db.get_pending_withdrawals()
-        if not withdrawals:
-            await message.reply("Нет ожидающих заявок.")
-            return
-        for w in withdrawals:
-            user = await self.db.get_user(w['user_id'])
-            name = user.get('username') or f"{user['first_name']} {user['last_name']}".strip() or "Неизвестно"
-            text = (
-                f"🆔 Заявка #{w['id']}\n"
-                f"📅 Дата: {w['created_at']}\n"
-                f"👤 Пользователь: {name} (ID: {w['user_id']})\n"
-                f"💰 Сумма: {w['amount']} руб.\n"
-                f"💳 Способ: {w['method']}\n"
-                f"📝 Реквизиты: {w['details']}"
+        text, markup = await self._render_withdrawals_page()
+        await message.reply(text, reply_markup=markup)
+
+    async def _render_withdrawals_page(self, after_id: int = 0, before_id: Optional[int] = None):
+        """Страница просмотра заявок: текст и клавиатура. Кнопки несут id крайних заявок
+        страницы, так что листание и действия не зависят от состояния диалога"""
+        rows = await self.db.get_pending_withdrawals_page(after_id, before_id, config.WITHDRAW_PAGE_SIZE)
+        if not rows and (after_id or before_id is not None):
+            # Заявки страницы обработаны, дальше ничего нет — показываем начало
+            rows = await self.db.get_pending_withdrawals_page(0, None, config.WITHDRAW_PAGE_SIZE)
+        if not rows:
+            return "Нет ожидающих заявок.", None
+        first_id, last_id = rows[0]['id'], rows[-1]['id']
+        summary = await self.db.get_pending_withdrawals_summary(first_id, last_id)
+        lines = [
+            f"🔧 *Заявки на вывод:* {summary['count']} на {summary['amount']} руб. "
+            f"(показаны {summary['before'] + 1}–{summary['before'] + len(rows)})"
+        ]
+        for w in rows:
+            name = w['username'] or f"{w['first_name'] or ''} {w['last_name'] or ''}".strip() or "Неизвестно"
+            lines.append(
+                f"\n🆔 #{w['id']} · 📅 {format_timestamp(w['created_at'])}\n"
+                f"👤 {escape_markdown(name)} (ID: {w['user_id']})\n"
+                f"💰 {w['amount']} руб. · {escape_markdown(w['method'])} · {escape_markdown(w['details'])}"
             )
-            markup = InlineKeyboardMarkup(row_width=2)
-            markup.add(
-                InlineKeyboardButton("✅ Принять", callback_data=f"approve_{w['id']}"),
-                InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_{w['id']}")
+            if not w['held']:
+                lines.append("⚠️ Создана до резервирования: сумма спишется с баланса при одобрении")
+        markup = InlineKeyboardMarkup(row_width=2)
+        for w in rows:
+            markup.row(
+                InlineKeyboardButton(f"✅ #{w['id']}", callback_data=f"wd:ok:{w['id']}:{first_id}"),
+                InlineKeyboardButton(f"❌ #{w['id']}", callback_data=f"wd:no:{w['id']}:{first_id}"),
             )
-            await message.reply(text, reply_markup=markup)
+        navigation = []
+        if summary['before']:
+            navigation.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"wd:prev:{first_id}"))
+        navigation.append(InlineKeyboardButton("🔄", callback_data=f"wd:show:{first_id}"))
+        if summary['after']:
+            navigation.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f"wd:next:{last_id}"))
+        markup.row(*navigation)
+        page_amount = sum(w['amount'] for w in rows)
+        markup.row(InlineKeyboardButton(f"✅ Принять все на странице ({len(rows)} на {page_amount} руб.)",
+                                        callback_data=f"wd:page:{first_id}:{last_id}"))
+        markup.row(InlineKeyboardButton("⚙️ Принять по фильтру", callback_data="wd:bulk"))
+        return '\n'.join(lines), markup
+
+    async def _edit_withdrawals_page(self, chat_id: int, message_id: int, first_id: int):
+        text, markup = await self._render_withdrawals_page(after_id=first_id - 1)
+        try:
+            await self.bot.edit_message_text(text, chat_id, message_id, reply_markup=markup)
+        except Exception as e:
+            # «message is not modified» и удалённое сообщение — страница просто не обновится
+            self.logger.warning(f"Не удалось обновить страницу заявок: {e}")
+
+    async def _callback_withdrawal_review(self, call: types.CallbackQuery, is_admin: bool):
+        admin_id = call.from_user.id
+        if not is_admin:
+            await call.answer("Нет прав.")
+            return
+        _, action, *args = call.data.split(':')
+        chat_id, message_id = call.message.chat.id, call.message.message_id
+        if action in ('next', 'prev', 'show'):
+            anchor = int(args[0])
+            if action == 'next':
+                text, markup = await self._render_withdrawals_page(after_id=anchor)
+            elif action == 'prev':
+                text, markup = await self._render_withdrawals_page(before_id=anchor)
+            else:
+                text, markup = await self._render_withdrawals_page(after_id=anchor - 1)
+            await call.answer()
+            try:
+                await call.message.edit_text(text, reply_markup=markup)
+            except Exception as e:
+                self.logger.warning(f"Не удалось обновить страницу заявок: {e}")
+        elif action == 'ok':
+            withdraw_id, first_id = int(args[0]), int(args[1])
+            w = await self.db.get_withdrawal(withdraw_id)
+            approved = bool(w) and await self.db.approve_withdrawal(w)
+            await call.answer(f"Заявка #{withdraw_id} принята." if approved else "Заявка уже обработана.")
+            if approved:
+                await self._notify_withdrawal_approved(w['user_id'], w['amount'])
+            await self._edit_withdrawals_page(chat_id, message_id, first_id)
+        elif action == 'no':
+            withdraw_id, first_id = int(args[0]), int(args[1])
+            await self.state_manager.set_state(admin_id, UserState.WAITING_REJECT_REASON, withdraw_id=withdraw_id,
+                                               page=[chat_id, message_id, first_id])
+            await call.answer("Введите причину отказа.")
+            await self.bot.send_message(admin_id, f"Напишите причину отказа по заявке #{withdraw_id}:")
+        elif action == 'page':
+            first_id, last_id = int(args[0]), int(args[1])
+            approved = await self.db.approve_withdrawals_range(first_id, last_id)
+            await call.answer(f"Принято заявок: {len(approved)}.")
+            self._spawn(self._notify_withdrawals_approved(approved))
+            await self._edit_withdrawals_page(chat_id, message_id, last_id + 1)
+        elif action == 'bulk':
+            await self.state_manager.set_state(admin_id, UserState.WITHDRAW_BULK_FILTER, page=[chat_id, message_id])
+            await call.answer()
+            await self.bot.send_message(
+                admin_id,
+                "Одобрение всех ожидающих заявок по фильтру. Пришлите способ (`card`, `phone` или `все`) "
+                "и, если нужно, максимальную сумму заявки, например: `phone 500`",
+                reply_markup=KeyboardFactory.cancel())
+        elif action == 'bulkgo':
+            if not await self.state_manager.has_state(admin_id, UserState.WITHDRAW_BULK_FILTER):
+                await call.answer("Сессия устарела. Начните заново.")
+                return
+            data = await self.state_manager.get_data(admin_id)
+            if 'max_id' not in data:
+                await call.answer("Сначала пришлите фильтр.")
+                return
+            await self.state_manager.clear_state(admin_id)
+            approved = await self.db.approve_withdrawals_filtered(data['method'], data['max_amount'], data['max_id'])
+            await call.answer()
+            await call.message.edit_text(f"✅ Принято заявок: {len(approved)} на {sum(w['amount'] for w in approved)} руб.")
+            self._spawn(self._notify_withdrawals_approved(approved))
+            page_chat, page_message = data['page']
+            await self._edit_withdrawals_page(page_chat, page_message, 1)
+        elif action == 'bulkno':
+            await self.state_manager.clear_state(admin_id)
+            await call.answer("Отменено.")
+            await call.message.edit_reply_markup(reply_markup=None)
 
-    async def _callback_withdrawal_action(self, call: types.CallbackQuery):
+    async def _handle_withdraw_bulk_filter(self, message: types.Message):
+        admin_id = message.from_user.id
+        parts = (message.text or '').lower().split()
+        method = parts[0] if parts else ''
+        try:
+            if method not in ('card', 'phone', 'все', 'all') or len(parts) > 2:
+                raise ValueError
+            max_amount = int(parts[1]) if len(parts) == 2 else None
+            if max_amount is not None and max_amount <= 0:
+                raise ValueError
+        except ValueError:
+            await message.reply("Формат: способ (`card`, `phone` или `все`) и необязательная максимальная сумма, например `phone 500`.")
+            return
+        method = method if method in ('card', 'phone') else None
+        preview = await self.db.preview_withdrawals(method, max_amount)
+        if not preview['count']:
+            await self.state_manager.clear_state(admin_id)
+            await message.reply("Под фильтр не подходит ни одна ожидающая заявка.")
+            return
+        await self.state_manager.update_data(admin_id, method=method, max_amount=max_amount, max_id=preview['max_id'])
+        markup = InlineKeyboardMarkup(row_width=2)
+        markup.add(
+            InlineKeyboardButton("✅ Одобрить", callback_data="wd:bulkgo"),
+            InlineKeyboardButton("❌ Отмена", callback_data="wd:bulkno"),
+        )
+        await message.reply(f"Под фильтр подходит заявок: {preview['count']} на {preview['amount']} руб. "
+                            f"Одобрить все одной операцией?", reply_markup=markup)
+
+    async def _notify_withdrawal_approved(self, user_id: int, amount: int):
+        try:
+            await self.bot.send_message(user_id, f"✅ Ваша заявка на вывод {amount}₽ принята. Ожидайте поступления в течение часа.")
+        except Exception as e:
+            self.logger.error(f"Не удалось уведомить пользователя {user_id}: {e}")
+
+    async def _notify_withdrawals_approved(self, withdrawals: List[Dict]):
+        # Фоном и с паузой, как рассылка: массовое одобрение — сотни сообщений
+        for w in withdrawals:
+            await self._notify_withdrawal_approved(w['user_id'], w['amount'])
+            await asyncio.sleep(0.05)
+
+    async def _callback_withdrawal_action(self, call: types.CallbackQuery, is_admin: bool):
         admin_id = call.from_user.id
-        user = await self.db.get_user(admin_id)
-        if not user or not user['is_admin']:
+        if not is_admin:
             await call.answer("Нет прав.")
             return
         action, withdraw_id = call.data.split('_')
@@ -1355,12 +4038,11 @@ class Handlers:
             if not w:
                 await call.answer("Заявка не найдена.")
                 return
-            await self.db.update_withdrawal_status(withdraw_id, 'approved')
-            await self.db.deduct_money(w['user_id'], w['amount'])
-            try:
-                await self.bot.send_message(w['user_id'], f"✅ Ваша заявка на вывод {w['amount']}₽ принята. Ожидайте поступления в течение часа.")
-            except Exception as e:
-                self.logger.error(f"Не удалось уведомить пользователя {w['user_id']}: {e}")
+            if not await self.db.approve_withdrawal(w):
+                await call.answer("Заявка уже обработана.")
+                await call.message.edit_reply_markup(reply_markup=None)
+                return
+            await self._notify_withdrawal_approved(w['user_id'], w['amount'])
             await call.answer("Заявка принята.")
             await call.message.edit_reply_markup(reply_markup=None)
         elif action == 'reject':
@@ -1378,25 +4060,31 @@ class Handlers:
             await message.reply("Заявка не найдена.")
             await self.state_manager.clear_state(admin_id)
             return
-        await self.db.update_withdrawal_status(withdraw_id, 'rejected', reason)
+        if not await self.db.reject_withdrawal(w, reason):
+            await self.state_manager.clear_state(admin_id)
+            await message.reply("Заявка уже обработана.")
+            return
         try:
             await self.bot.send_message(w['user_id'], f"❌ Заявка на вывод {w['amount']}₽ отклонена.\nПричина: {reason}")
         except Exception as e:
             self.logger.error(f"Не удалось уведомить пользователя {w['user_id']}: {e}")
-        try:
-            await self.bot.delete_message(data['msg'].chat.id, data['msg'].message_id)
-        except:
-            pass
         await self.state_manager.clear_state(admin_id)
         await message.reply("✅ Заявка отклонена.")
+        if data.get('page'):
+            await self._edit_withdrawals_page(*data['page'])
+        else:
+            # Кнопки старого формата: одна заявка — одно сообщение
+            try:
+                await self.bot.delete_message(data['msg'].chat.id, data['msg'].message_id)
+            except:
+                pass
 
     # ---------- ОСНОВНАЯ ЛОГИКА ФОТО ----------
     async def _handle_check_comment(self, message: types.Message):
         user_id = message.from_user.id
-        now = time.time()
-        last = self._last_photo_time.get(user_id, 0)
-        if now - last < config.ANTIFLOOD_SECONDS:
-            remaining = int(config.ANTIFLOOD_SECONDS - (now - last))
+        retry_after = self.rate_limiter.peek('photo', user_id, 1 / config.ANTIFLOOD_SECONDS)
+        if retry_after:
+            remaining = int(retry_after)
             await message.reply(f"⏳ Слишком часто. Подождите {remaining} секунд.")
             return
         await self.state_manager.set_state(user_id, UserState.WAITING_PHOTO)
@@ -1412,50 +4100,83 @@ class Handlers:
             reply_markup=markup
         )
 
-    async def _handle_photo(self, message: types.Message):
+    async def _handle_photo(self, message: types.Message, user_ctx: UserContext):
         user_id = message.from_user.id
-        if await self.db.is_permanently_banned(user_id):
-            await message.reply("⛔ Вы забанены навсегда. Доступ к боту закрыт.")
-            return
         await self.state_manager.clear_state(user_id)
-        now = time.time()
-        last = self._last_photo_time.get(user_id, 0)
-        if now - last < config.ANTIFLOOD_SECONDS:
-            remaining = int(config.ANTIFLOOD_SECONDS - (now - last))
-            user = await self.db.get_user(user_id)
-            await message.reply(f"⏳ Слишком часто. Подождите {remaining} секунд.", reply_markup=KeyboardFactory.main(user['is_blocked'] if user else True))
+        retry_after = self.rate_limiter.hit('photo', user_id, 1 / config.ANTIFLOOD_SECONDS)
+        if retry_after:
+            remaining = int(retry_after)
+            await message.reply(f"⏳ Слишком часто. Подождите {remaining} секунд.", reply_markup=KeyboardFactory.main(user_ctx.is_blocked))
             return
-        self._last_photo_time[user_id] = now
         if not message.photo:
-            user = await self.db.get_user(user_id)
-            await message.reply("❌ Ошибка: фото не обнаружено.", reply_markup=KeyboardFactory.main(user['is_blocked'] if user else True))
+            await message.reply("❌ Ошибка: фото не обнаружено.", reply_markup=KeyboardFactory.main(user_ctx.is_blocked))
             return
         photo = message.photo[-1]
         if photo.file_size > config.MAX_PHOTO_SIZE:
-            user = await self.db.get_user(user_id)
-            await message.reply(f"❌ Файл слишком большой. Максимальный размер: {config.MAX_PHOTO_SIZE_MB} MB.", reply_markup=KeyboardFactory.main(user['is_blocked'] if user else True))
+            await message.reply(f"❌ Файл слишком большой. Максимальный размер: {config.MAX_PHOTO_SIZE_MB} MB.", reply_markup=KeyboardFactory.main(user_ctx.is_blocked))
+            return
+        work = asyncio.ensure_future(self._credit_photo(photo, user_id))
+        # Быстрая обработка обходится без промежуточного сообщения, медленная показывает «печатает…»
+        done, _ = await asyncio.wait({work}, timeout=config.PHOTO_CHAT_ACTION_DELAY)
+        if not done:
+            try:
+                await self.bot.send_chat_action(message.chat.id, types.ChatActions.TYPING)
+            except Exception as e:
+                self.logger.error(f"Не удалось отправить chat action {user_id}: {e}")
+        error, new_balance = await work
+        if error:
+            await message.reply(error, reply_markup=KeyboardFactory.main(user_ctx.is_blocked))
             return
-        processing_msg = await message.reply("⏳ Обрабатываю фото, пожалуйста, подождите...")
+        # add_comment детерминированно меняет эти поля — обновляем строку без повторного чтения
+        user_ctx.patch(
+            comment_balance=new_balance,
+            total_comments_ever=user_ctx.user['total_comments_ever'] + 1,
+            is_blocked=new_balance < config.COMMENT_THRESHOLD
+        )
+        user = user_ctx.user
+        self._spawn(self._notify_admins_photo(photo.file_id, user, new_balance))
+        # Клавиатура меню идёт в том же сообщении, что и результат
+        if user['is_blocked']:
+            remaining = config.COMMENT_THRESHOLD - new_balance
+            markup = InlineKeyboardMarkup().add(InlineKeyboardButton("📖 Инструкция", callback_data="instruction"))
+            await message.reply(
+                f"✅ Комментарий засчитан!\n\n"
+                f"📝 Текущий баланс: {new_balance}\n"
+                f"🔒 СТАТУС: ЗАБЛОКИРОВАН\n"
+                f"⏳ Осталось до разблокировки: {remaining}",
+                reply_markup=markup
+            )
+        else:
+            await message.reply(
+                f"✅ Комментарий засчитан!\n\n"
+                f"📝 Текущий баланс: {new_balance}\n"
+                f"🎉 СТАТУС: РАЗБЛОКИРОВАН\n"
+                f"💫 Теперь вам доступны все функции бота!",
+                reply_markup=KeyboardFactory.main()
+            )
+
+    async def _credit_photo(self, photo: types.PhotoSize, user_id: int) -> Tuple[Optional[str], int]:
+        """Скачивает фото, проверяет уникальность и начисляет комментарий. Возвращает (ошибка, баланс)"""
         try:
             file_info = await self.bot.get_file(photo.file_id)
             downloaded = await self.bot.download_file(file_info.file_path)
             data = downloaded.getvalue()
         except Exception as e:
             self.logger.error(f"Ошибка скачивания файла: {e}")
-            await processing_msg.edit_text("❌ Ошибка при скачивании файла.")
-            return
-        photo_hash = hashlib.sha256(data).hexdigest()
+            return "❌ Ошибка при скачивании файла.", 0
+        # Хэш до 20 МБ считается десятки миллисекунд — не на event loop'е
+        photo_hash = await asyncio.get_event_loop().run_in_executor(None, lambda: hashlib.sha256(data).hexdigest())
         if await self.db.check_photo_hash(photo_hash):
-            await processing_msg.edit_text("❌ Этот скриншот уже использовался ранее.")
-            return
+            return "❌ Этот скриншот уже использовался ранее.", 0
         await self.db.save_photo_hash(user_id, photo_hash)
-        new_balance = await self.db.add_comment(user_id)
-        user = await self.db.get_user(user_id)
+        return None, await self.db.add_comment(user_id)
+
+    async def _notify_admins_photo(self, file_id: str, user: Dict, new_balance: int):
         username = user.get('username') or f"{user['first_name']} {user['last_name']}".strip() or "Неизвестно"
         log_text = (
             f"📸 *НОВОЕ ФОТО (начислен комментарий)*\n"
             f"👤 Пользователь: {username}\n"
-            f"🆔 ID: {user_id}\n"
+            f"🆔 ID: {user['user_id']}\n"
             f"⏰ Время: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
             f"📝 Новый баланс комментариев: {new_balance}\n"
             f"💰 Денег: {user['money_balance']} руб.\n"
@@ -1463,58 +4184,1000 @@ class Handlers:
         )
         for admin_id in config.ADMIN_IDS:
             try:
-                await self.bot.send_photo(admin_id, photo.file_id, caption=log_text, parse_mode=ParseMode.MARKDOWN)
+                await self.bot.send_photo(admin_id, file_id, caption=log_text, parse_mode=ParseMode.MARKDOWN)
             except Exception as e:
                 self.logger.error(f"Не удалось отправить фото админу {admin_id}: {e}")
-        if user['is_blocked']:
-            remaining = config.COMMENT_THRESHOLD - new_balance
-            await processing_msg.edit_text(
-                f"✅ Комментарий засчитан!\n\n"
-                f"📝 Текущий баланс: {new_balance}\n"
-                f"🔒 СТАТУС: ЗАБЛОКИРОВАН\n"
-                f"⏳ Осталось до разблокировки: {remaining}"
+
+# ==================== ОЧЕРЕДИ ПОЛЬЗОВАТЕЛЕЙ ====================
+
+def update_user_id(update: Dict) -> int:
+    """Отправитель апдейта; для апдейтов без отправителя — update_id"""
+    for key in ('message', 'edited_message', 'callback_query', 'inline_query',
+                'chosen_inline_result', 'my_chat_member', 'chat_member', 'poll_answer'):
+        obj = update.get(key)
+        if obj:
+            sender = obj.get('from') or obj.get('user')
+            if sender:
+                return sender['id']
+    return update.get('update_id', 0)
+
+def update_type(update: Dict) -> str:
+    return next((key for key in update if key != 'update_id'), 'unknown')
+
+class UserMailboxes:
+    """Апдейты одного пользователя обрабатываются строго по очереди, разных — параллельно"""
+    def __init__(self, dp: Dispatcher, logger: Logger, max_pending: int = 20, max_concurrency: int = 256):
+        self.dp = dp
+        self.logger = logger
+        self.max_pending = max_pending
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._boxes: Dict[int, deque] = {}
+        self._tasks: set = set()
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self._boxes)
+
+    async def submit(self, update: Dict, done=None):
+        """done — необязательный колбэк, вызываемый после обработки или отбрасывания апдейта"""
+        user_id = update_user_id(update)
+        box = self._boxes.get(user_id)
+        if box is None:
+            box = self._boxes[user_id] = deque()
+            task = asyncio.create_task(self._drain(user_id, box))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif len(box) >= self.max_pending:
+            self.dropped += 1
+            metrics.inc('rudeps_updates_dropped_total')
+            self.logger.warning(f"Очередь пользователя {user_id} переполнена, апдейт {update.get('update_id')} отброшен")
+            if done:
+                done()
+            return
+        box.append((update, done))
+
+    async def _drain(self, user_id: int, box: deque):
+        # Очередь живёт, пока в ней есть апдейты; опустевшая сразу освобождается
+        while box:
+            update, done = box.popleft()
+            async with self._semaphore:
+                log_token = log_update.set((user_id, update.get('update_id')))
+                try:
+                    with self.dp.bot.track_update(), tracer.update(user_id, update.get('update_id')):
+                        await self.dp.process_update(types.Update.to_object(update))
+                except Exception as e:
+                    self.logger.error(f"Ошибка обработки апдейта {update.get('update_id')}: {e}")
+                finally:
+                    log_update.reset(log_token)
+                    if done:
+                        done()
+        del self._boxes[user_id]
+
+    async def wait_closed(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    async def cancel(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+class PriorityIntake:
+    """Планировщик приёма: очереди по классам приоритета и сброс нагрузки по дедлайнам.
+
+    В обработку (в UserMailboxes) одновременно допускается не больше capacity апдейтов;
+    следующий берётся из самого приоритетного непустого класса. У пользователя в
+    очередях классов и в обработке в каждый момент не больше одного апдейта: остальные
+    ждут в его собственной очереди (FIFO) и попадают в очередь своего класса, когда
+    предыдущий обработан. Так приоритет решает только, чей апдейт обработать раньше,
+    а порядок апдейтов одного пользователя не меняется — кнопка не обгонит введённую
+    перед ней сумму. Апдейт, не дождавшийся своей очереди до дедлайна или не
+    поместившийся в очередь, получает дешёвый ответ «бот перегружен» вместо обработки.
+    """
+    LANES = ('admin', 'callback', 'text', 'photo')
+
+    def __init__(self, mailboxes: UserMailboxes, bot: Bot, logger: Logger,
+                 lanes: Dict[str, Tuple[int, float]], capacity: int, max_pending: int = 20):
+        self.mailboxes = mailboxes
+        self.bot = bot
+        self.logger = logger
+        self.limits = lanes
+        self._queues: Dict[str, deque] = {lane: deque() for lane in self.LANES}
+        self.max_pending = max_pending
+        # Пользователи с апдейтом в очереди класса или в обработке и их следующие апдейты
+        # (lane, deadline, update) в порядке поступления
+        self._active: set = set()
+        self._parked: Dict[int, deque] = {}
+        self._parked_count = 0
+        self._slots = asyncio.Semaphore(capacity)
+        self._available = asyncio.Event()
+        # Не чаще одного ответа «перегружен» на пользователя за 10 секунд
+        self._busy_notices = RateLimiter(idle_ttl=60)
+        self.shed: Counter = Counter()
+
+    @staticmethod
+    def classify(update: Dict) -> str:
+        if update_user_id(update) in config.ADMIN_IDS:
+            return 'admin'
+        if 'callback_query' in update:
+            return 'callback'
+        message = update.get('message') or {}
+        if 'photo' in message or 'document' in message:
+            return 'photo'
+        return 'text'
+
+    def backlog(self) -> Dict[str, int]:
+        backlog = {lane: len(q) for lane, q in self._queues.items()}
+        backlog['parked'] = self._parked_count
+        return backlog
+
+    async def submit(self, update: Dict):
+        metrics.inc('rudeps_updates_total', update_type(update))
+        lane = self.classify(update)
+        limit, max_wait = self.limits[lane]
+        deadline = time.monotonic() + max_wait
+        user_id = update_user_id(update)
+        if user_id in self._active:
+            self._park(user_id, lane, deadline, update)
+            return
+        lane_queue = self._queues[lane]
+        if len(lane_queue) >= limit:
+            self._shed(lane, update)
+            return
+        self._active.add(user_id)
+        lane_queue.append((deadline, update))
+        self._available.set()
+
+    def _next(self) -> Optional[Dict]:
+        now = time.monotonic()
+        for lane in self.LANES:
+            lane_queue = self._queues[lane]
+            while lane_queue:
+                deadline, update = lane_queue.popleft()
+                if deadline < now:
+                    self._shed(lane, update)
+                    self._advance(update_user_id(update))
+                    continue
+                return update
+        return None
+
+    def _park(self, user_id: int, lane: str, deadline: float, update: Dict):
+        parked = self._parked.setdefault(user_id, deque())
+        if len(parked) >= self.max_pending:
+            metrics.inc('rudeps_updates_dropped_total')
+            self._shed(lane, update)
+            return
+        parked.append((lane, deadline, update))
+        self._parked_count += 1
+
+    def _advance(self, user_id: int):
+        """Текущий апдейт пользователя обработан или сброшен: следующий из его очереди
+        встаёт в очередь своего класса. Он ждал дольше поступивших после него, поэтому
+        ставится в начало; просроченные сбрасываются"""
+        parked = self._parked.get(user_id)
+        now = time.monotonic()
+        while parked:
+            lane, deadline, update = parked.popleft()
+            self._parked_count -= 1
+            if deadline < now:
+                self._shed(lane, update)
+                continue
+            if not parked:
+                del self._parked[user_id]
+            self._queues[lane].appendleft((deadline, update))
+            self._available.set()
+            return
+        self._parked.pop(user_id, None)
+        self._active.discard(user_id)
+
+    def _finish(self, user_id: int):
+        self._advance(user_id)
+        self._slots.release()
+
+    def _shed(self, lane: str, update: Dict):
+        self.shed[lane] += 1
+        metrics.inc('rudeps_updates_shed_total', lane)
+        if self.shed[lane] % 100 == 1:
+            self.logger.warning(f"Перегрузка: сброшено апдейтов класса {lane}: {self.shed[lane]}, очереди {self.backlog()}")
+        if not self._busy_notices.hit('busy', update_user_id(update), rate=0.1):
+            asyncio.create_task(self._reply_busy(update))
+
+    async def _reply_busy(self, update: Dict):
+        text = "⏳ Бот сейчас перегружен, попробуйте чуть позже."
+        try:
+            if 'callback_query' in update:
+                await self.bot.answer_callback_query(update['callback_query']['id'], text)
+            elif 'message' in update:
+                await self.bot.send_message(update['message']['chat']['id'], text)
+        except Exception as e:
+            self.logger.error(f"Не удалось отправить ответ о перегрузке: {e}")
+
+    async def run(self):
+        while True:
+            await self._slots.acquire()
+            update = self._next()
+            while update is None:
+                self._available.clear()
+                await self._available.wait()
+                update = self._next()
+            user_id = update_user_id(update)
+            await self.mailboxes.submit(update, done=lambda user_id=user_id: self._finish(user_id))
+
+    async def wait_closed(self):
+        while any(self._queues.values()) or self._parked:
+            await asyncio.sleep(0.05)
+        await self.mailboxes.wait_closed()
+
+    async def abort(self):
+        """Бросает недообработанное: вызывается, когда дедлайн остановки исчерпан"""
+        backlog = sum(self.backlog().values())
+        for lane_queue in self._queues.values():
+            lane_queue.clear()
+        self._parked.clear()
+        self._parked_count = 0
+        self._active.clear()
+        await self.mailboxes.cancel()
+        self.logger.warning(f"Остановка: брошено апдейтов в очередях приёма: {backlog}")
+
+async def poll_raw_updates(bot: Bot, handler, logger: Logger, timeout: int = 20):
+    """Long polling без разбора апдейтов: для маршрутизации достаточно user_id из dict"""
+    await bot.delete_webhook()
+    offset = None
+    try:
+        while True:
+            payload = {'timeout': timeout}
+            if offset is not None:
+                payload['offset'] = offset
+            try:
+                updates = await bot.request('getUpdates', payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка getUpdates: {e}")
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                await handler(update)
+                offset = update['update_id'] + 1
+    except asyncio.CancelledError:
+        # Подтверждаем уже принятые апдейты, иначе после перезапуска Telegram пришлёт их снова
+        if offset is not None:
+            try:
+                await bot.request('getUpdates', {'offset': offset, 'timeout': 0, 'limit': 1})
+            except Exception as e:
+                logger.error(f"Не удалось подтвердить offset {offset}: {e}")
+        raise
+
+# ==================== WEBHOOK ====================
+
+class WebhookServer:
+    """Приём апдейтов через webhook: встроенный aiohttp-сервер и ограниченная очередь"""
+    def __init__(self, bot: Bot, logger: Logger, handler, host: str, port: int, path: str,
+                 url: str = '', secret: str = '', queue_size: int = 1000, workers: int = 32):
+        self.bot = bot
+        # Корутина, принимающая сырой апдейт (dict)
+        self.handler = handler
+        self.logger = logger
+        self.host = host
+        self.port = port
+        self.path = path
+        self.url = url
+        self.secret = secret
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._runner: Optional[web.AppRunner] = None
+        self._tasks: List[asyncio.Task] = []
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret:
+            return web.Response(status=403)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Не копим бесконечный хвост: Telegram сам повторит доставку позже
+            self.logger.warning(f"Очередь webhook переполнена, апдейт {update.get('update_id')} отклонён")
+            return web.Response(status=503)
+        return web.Response()
+
+    async def _worker(self):
+        Bot.set_current(self.bot)
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.handler(update)
+            except Exception as e:
+                self.logger.error(f"Ошибка обработки апдейта {update.get('update_id')}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self):
+        app = web.Application(client_max_size=1024 * 1024)
+        app.router.add_post(self.path, self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if self.url:
+            await self.bot.set_webhook(
+                self.url.rstrip('/') + self.path,
+                secret_token=self.secret or None,
+                max_connections=config.WEBHOOK_MAX_CONNECTIONS
             )
+        self.logger.info(f"Webhook слушает http://{self.host}:{self.port}{self.path}")
+
+    async def stop(self, timeout: Optional[float] = None):
+        """Перестаёт принимать апдейты и ждёт разбора уже принятых, но не дольше timeout"""
+        if self._runner:
+            await self._runner.cleanup()
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            self.logger.warning(f"Webhook: остановка по дедлайну, не разобрано апдейтов: {self.queue.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+# ==================== ЗАПИСЬ АПДЕЙТОВ ====================
+
+# Тексты кнопок: запись сохраняет их как есть, иначе проигрыш пойдёт по другим веткам
+KEYBOARD_TEXTS = frozenset(MENU_BUTTONS + [
+    "👥 Рассылка", "💰 Управление балансами", "📤 Экспорт ID", "🔧 Тикеты на выплату", "🔙 Назад в меню",
+    "❌ Отмена", "1️⃣ Все пользователи", "2️⃣ Своё количество",
+    "1️⃣ Самые активные", "2️⃣ Самые неактивные", "3️⃣ Случайные",
+])
+_RECORD_MASK_RE = re.compile(r'\w')
+_ANON_ID_BASE = 1 << 45                    # выше любых настоящих ID Telegram
+
+def anonymize_user_id(user_id: int, salt: str) -> int:
+    """Стабильная замена user_id: тот же ID с той же солью всегда даёт то же число"""
+    digest = hmac.new(salt.encode(), str(user_id).encode(), hashlib.sha256).digest()
+    return _ANON_ID_BASE + int.from_bytes(digest[:5], 'big')
+
+def mask_text(text: str, salt: str) -> str:
+    """Свободный текст без персональных данных: буквы и цифры маскируются с сохранением
+    длины; кнопки, команды и короткие числа остаются, длинные числа считаются ID"""
+    if text in KEYBOARD_TEXTS:
+        return text
+    if text.startswith('/'):
+        command, _, rest = text.partition(' ')
+        return command + (' ' + mask_text(rest, salt) if rest else '')
+    if text.isdigit():
+        return text if len(text) <= 6 else str(anonymize_user_id(int(text), salt))
+    return _RECORD_MASK_RE.sub(lambda m: '0' if m.group().isdigit() else 'x', text)
+
+class UpdateRecorder:
+    """Запись входящих апдейтов для replay.py: строки JSON, только дозапись.
+
+    Строка — {"t": время приёма, "u": апдейт}; при каждом запуске дописывается
+    заголовок {"v": 1, "admins": [...]}. Из апдейта сохраняются только поля, которые
+    читают хэндлеры: user_id заменяются anonymize_user_id, имена и username
+    отбрасываются, file_id хэшируются (повторы остаются повторами). В свободном тексте
+    буквы и цифры маскируются с сохранением длины; кнопки, команды и короткие числа
+    (суммы, количества) сохраняются, длинные числа считаются ID и анонимизируются.
+    Файл пишет отдельный поток.
+    """
+    def __init__(self, path: str, salt: str, logger: Logger):
+        self.path = path
+        self.salt = salt
+        self.logger = logger
+        self.recorded = 0
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write, name='update-recorder', daemon=True)
+
+    def start(self):
+        header = {'v': 1, 'started': round(time.time(), 3),
+                  'admins': [self._user(admin_id) for admin_id in config.ADMIN_IDS]}
+        self._queue.put(json.dumps(header, separators=(',', ':')))
+        self._thread.start()
+        self.logger.info(f"Запись апдейтов в {self.path}")
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+            self.logger.info(f"Записано апдейтов: {self.recorded}")
+
+    def _write(self):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            while True:
+                line = self._queue.get()
+                if line is None:
+                    break
+                f.write(line + '\n')
+                if self._queue.empty():
+                    f.flush()
+
+    def wrap(self, submit):
+        """Обёртка над приёмником апдейтов: запись, затем передача дальше"""
+        async def recording_submit(update: Dict):
+            self.record(update)
+            await submit(update)
+        return recording_submit
+
+    def record(self, update: Dict):
+        try:
+            scrubbed = self._scrub(update)
+        except Exception as e:
+            self.logger.warning(f"Апдейт {update.get('update_id')} не записан: {e}")
+            return
+        if scrubbed is not None:
+            self.recorded += 1
+            entry = {'t': round(time.time(), 3), 'u': scrubbed}
+            self._queue.put(json.dumps(entry, ensure_ascii=False, separators=(',', ':')))
+
+    # ---------- анонимизация ----------
+
+    def _user(self, user_id: int) -> int:
+        return anonymize_user_id(user_id, self.salt)
+
+    def _file_id(self, file_id: str) -> str:
+        return hmac.new(self.salt.encode(), file_id.encode(), hashlib.sha256).hexdigest()[:32]
+
+    def _text(self, text: str) -> str:
+        return mask_text(text, self.salt)
+
+    def _from(self, user: Dict) -> Dict:
+        return {'id': self._user(user['id']), 'is_bot': user.get('is_bot', False), 'first_name': 'User'}
+
+    def _chat(self, chat: Dict) -> Dict:
+        return {'id': self._user(chat['id']), 'type': chat.get('type', 'private')}
+
+    def _message(self, message: Dict) -> Dict:
+        result = {'message_id': message['message_id'], 'date': message.get('date', 0),
+                  'chat': self._chat(message['chat'])}
+        if 'from' in message:
+            result['from'] = self._from(message['from'])
+        if 'text' in message:
+            result['text'] = self._text(message['text'])
+            if 'entities' in message:
+                result['entities'] = [e for e in message['entities'] if e.get('type') == 'bot_command']
+        if 'caption' in message:
+            result['caption'] = self._text(message['caption'])
+        if 'photo' in message:
+            result['photo'] = [
+                {'file_id': self._file_id(p['file_id']), 'file_unique_id': self._file_id(p['file_unique_id']),
+                 'width': p.get('width', 0), 'height': p.get('height', 0), 'file_size': p.get('file_size')}
+                for p in message['photo']
+            ]
+        if 'document' in message:
+            document = message['document']
+            result['document'] = {'file_id': self._file_id(document['file_id']),
+                                  'file_unique_id': self._file_id(document['file_unique_id']),
+                                  'mime_type': document.get('mime_type'), 'file_size': document.get('file_size')}
+        return result
+
+    def _scrub(self, update: Dict) -> Optional[Dict]:
+        if 'message' in update:
+            return {'update_id': update['update_id'], 'message': self._message(update['message'])}
+        if 'callback_query' in update:
+            call = update['callback_query']
+            scrubbed = {'id': call['id'], 'chat_instance': '', 'from': self._from(call['from']),
+                        'data': call.get('data')}
+            if 'message' in call:
+                scrubbed['message'] = self._message(call['message'])
+            return {'update_id': update['update_id'], 'callback_query': scrubbed}
+        # Остальные типы бот не обрабатывает
+        return None
+
+def start_recorder(logger: Logger) -> Optional[UpdateRecorder]:
+    if not config.RECORD_FILE:
+        return None
+    recorder = UpdateRecorder(config.RECORD_FILE, config.RECORD_SALT or config.BOT_TOKEN, logger)
+    recorder.start()
+    return recorder
+
+# ==================== ОСТАНОВКА ====================
+
+class ShutdownPhases:
+    """Поэтапная остановка с общим дедлайном; длительность и исход каждого этапа пишутся в лог"""
+    def __init__(self, logger: Logger, timeout: float):
+        self.logger = logger
+        self.started = time.monotonic()
+        self.deadline = self.started + timeout
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    async def run(self, name: str, coro, bounded: bool = True, on_timeout=None):
+        """bounded=False — этап выполняется до конца даже после дедлайна (сброс буферов на диск)"""
+        started = time.monotonic()
+        status = "ok"
+        try:
+            if bounded:
+                await asyncio.wait_for(coro, self.remaining())
+            else:
+                await coro
+        except asyncio.TimeoutError:
+            status = "прервано по дедлайну"
+            if on_timeout:
+                await on_timeout()
+        except Exception as e:
+            status = f"ошибка: {e}"
+        self.logger.info(f"Остановка: {name} — {time.monotonic() - started:.2f} с ({status})")
+
+    def finish(self):
+        self.logger.info(f"Остановка завершена за {time.monotonic() - self.started:.2f} с")
+
+def install_stop_signals(stop: asyncio.Event):
+    """SIGTERM (deploy, systemd) и SIGINT (Ctrl+C) запускают мягкую остановку"""
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+async def serve_until_stopped(stop: asyncio.Event, receiver: Optional[asyncio.Task] = None):
+    """Ждёт сигнала остановки; падение приёма апдейтов тоже останавливает бота"""
+    stopper = asyncio.create_task(stop.wait())
+    waiting = {stopper} | ({receiver} if receiver else set())
+    await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+    stopper.cancel()
+    if receiver and receiver.done() and not receiver.cancelled():
+        receiver.result()
+
+async def stop_receiver(receiver: Optional[asyncio.Task], webhook: Optional[WebhookServer], phases: ShutdownPhases):
+    async def _stop():
+        if receiver and not receiver.done():
+            receiver.cancel()
+            await asyncio.gather(receiver, return_exceptions=True)
+        if webhook:
+            await webhook.stop(timeout=phases.remaining())
+    await phases.run("приём апдейтов", _stop(), bounded=False)
+
+async def drain_bot_stack(phases: ShutdownPhases, intake: PriorityIntake, intake_task: asyncio.Task,
+                          handlers: Handlers, state_store: StateStore, store_task: asyncio.Task,
+                          dp: Dispatcher, db: Database):
+    """Общая часть остановки процесса, обрабатывающего апдейты (одиночный режим и воркер)"""
+    handlers.stopping = True
+    await phases.run("дообработка принятых апдейтов", intake.wait_closed(), on_timeout=intake.abort)
+    intake_task.cancel()
+    await phases.run("фоновые задачи", handlers.wait_background(), on_timeout=handlers.cancel_background)
+
+    async def _flush():
+        await state_store.close()
+        store_task.cancel()
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+    await phases.run("сброс состояний", _flush(), bounded=False)
+    await phases.run("закрытие БД", db.close(), bounded=False)
+
+# ==================== ШАРДИРОВАНИЕ ПО ПРОЦЕССАМ ====================
+
+class SingleWriter:
+    """Единственный писатель БД: последовательно применяет записи всех процессов"""
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _apply_sync(self, queries: List[tuple]) -> Optional[int]:
+        # Соединение живёт в единственном потоке executor'а
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, timeout=30)
+        cur = None
+        with self._conn:
+            for query, params in queries:
+                cur = self._conn.execute(query, params)
+        # Без изменений lastrowid остаётся от прошлой вставки соединения — он не наш
+        return cur.lastrowid if cur and cur.rowcount else None
+
+    async def execute(self, queries: List[tuple]) -> Optional[int]:
+        """Применяет запросы одной транзакцией; возвращает lastrowid последнего,
+        None — если последний запрос ничего не изменил"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self._apply_sync, queries)
+
+    def serve(self, requests: multiprocessing.Queue, responses: List[multiprocessing.Queue]):
+        """Поток супервизора: принимает записи воркеров и отвечает об их результате"""
+        while True:
+            item = requests.get()
+            if item is None:
+                break
+            index, request_id, queries = item
+            result, error = None, None
+            try:
+                result = self.executor.submit(self._apply_sync, queries).result()
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            responses[index].put((request_id, error, result))
+
+    def close(self):
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+        self.executor.submit(_close).result()
+        self.executor.shutdown(wait=True)
+
+class RemoteWriter:
+    """Writer воркера: пересылает записи супервизору и ждёт подтверждения"""
+    def __init__(self, index: int, requests: multiprocessing.Queue, responses: multiprocessing.Queue):
+        self.index = index
+        self.requests = requests
+        self.responses = responses
+        self._ids = itertools.count()
+        self._futures: Dict[int, asyncio.Future] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self):
+        self._loop = asyncio.get_event_loop()
+        threading.Thread(target=self._read_responses, name='writer-responses', daemon=True).start()
+
+    def _read_responses(self):
+        while True:
+            item = self.responses.get()
+            if item is None:
+                break
+            self._loop.call_soon_threadsafe(self._resolve, *item)
+
+    def _resolve(self, request_id: int, error: Optional[str], result: Optional[int]):
+        future = self._futures.pop(request_id, None)
+        if future is None or future.done():
+            return
+        if error:
+            future.set_exception(sqlite3.OperationalError(error))
         else:
-            await processing_msg.edit_text(
-                f"✅ Комментарий засчитан!\n\n"
-                f"📝 Текущий баланс: {new_balance}\n"
-                f"🎉 СТАТУС: РАЗБЛОКИРОВАН\n"
-                f"💫 Теперь вам доступны все функции бота!"
+            future.set_result(result)
+
+    async def execute(self, queries: List[tuple]) -> Optional[int]:
+        request_id = next(self._ids)
+        future = self._loop.create_future()
+        self._futures[request_id] = future
+        self.requests.put((self.index, request_id, queries))
+        return await future
+
+class UpdateRouter:
+    """Раздаёт сырые апдейты воркерам: один пользователь всегда попадает в один процесс"""
+    def __init__(self, queues: List[multiprocessing.Queue]):
+        self.queues = queues
+
+    async def route(self, update: Dict):
+        target = self.queues[update_user_id(update) % len(self.queues)]
+        try:
+            target.put_nowait(update)
+        except queue.Full:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, target.put, update)
+
+def _next_update(updates: multiprocessing.Queue) -> Optional[Dict]:
+    """Блокирующее чтение очереди; None — пора завершаться (в т.ч. если супервизор умер)"""
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            return updates.get(timeout=1)
+        except queue.Empty:
+            if parent is not None and not parent.is_alive():
+                return None
+
+def _worker_file(path: str, index: int) -> str:
+    base, ext = os.path.splitext(path)
+    return f"{base}.worker{index}{ext}"
+
+async def worker_main(index: int, count: int, updates: multiprocessing.Queue,
+                      requests: multiprocessing.Queue, responses: multiprocessing.Queue, ready):
+    logger = Logger(_worker_file(config.LOG_FILE, index))
+    if config.TRACE_FILE:
+        start_tracing(_worker_file(config.TRACE_FILE, index))
+    bot = create_bot()
+    writer = RemoteWriter(index, requests, responses)
+    writer.start()
+    db = Database(config.DATABASE_FILE, writer=writer, profiler=create_profiler(logger))
+    state_store = StateStore(config.STATE_DB_FILE, logger,
+                             config.STATE_FLUSH_INTERVAL, config.STATE_FLUSH_BATCH)
+    state_manager = UserStateManager(state_store, shard=(index, count))
+    dp, handlers = setup_dispatcher(bot, db, state_manager, logger)
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    store_task = asyncio.create_task(state_store.run())
+    logger.info(f"Воркер {index}/{count} запущен, состояний: {len(state_manager._states)}")
+    if index == 0:
+        await handlers.resume_broadcasts()
+    ready.set()
+
+    mailboxes = UserMailboxes(dp, logger, config.MAILBOX_MAX_PENDING, config.MAX_CONCURRENT_UPDATES)
+    intake = PriorityIntake(mailboxes, bot, logger, config.INTAKE_LANES, config.MAX_CONCURRENT_UPDATES,
+                            config.MAILBOX_MAX_PENDING)
+    intake_task = asyncio.create_task(intake.run())
+    register_gauges(db, intake, handlers, state_store)
+    handlers.inspector = RuntimeInspector(db, intake, handlers, state_store)
+    metrics_server = await start_metrics_server(logger, config.METRICS_PORT + 1 + index, handlers.inspector)
+    monitor_task = start_loop_monitor(logger)
+    loop = asyncio.get_event_loop()
+    try:
+        # Сигнал остановки воркеру — None в очереди от супервизора
+        while True:
+            raw = await loop.run_in_executor(None, _next_update, updates)
+            if raw is None:
+                break
+            await intake.submit(raw)
+    finally:
+        phases = ShutdownPhases(logger, config.SHUTDOWN_DRAIN_TIMEOUT)
+        await drain_bot_stack(phases, intake, intake_task, handlers, state_store, store_task, dp, db)
+        await phases.run("сессия Bot API", bot.session.close(), bounded=False)
+        if metrics_server:
+            await metrics_server.stop()
+        if monitor_task:
+            monitor_task.cancel()
+        tracer.close()
+        phases.finish()
+        logger.info(f"Воркер {index} остановлен")
+        logger.close()
+
+def _worker_entry(index: int, count: int, updates, requests, responses, ready):
+    # Ctrl+C приходит всей группе процессов; воркер останавливает только супервизор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(worker_main(index, count, updates, requests, responses, ready))
+
+async def run_supervisor(logger: Logger, count: int):
+    ctx = multiprocessing.get_context('spawn')
+    update_queues = [ctx.Queue(config.WORKER_QUEUE_SIZE) for _ in range(count)]
+    requests = ctx.Queue()
+    responses = [ctx.Queue() for _ in range(count)]
+
+    bot = create_bot()
+    writer = SingleWriter(config.DATABASE_FILE)
+    # Схема создаётся один раз здесь, до старта воркеров
+    db = Database(config.DATABASE_FILE, writer=writer)
+    threading.Thread(target=writer.serve, args=(requests, responses), name='db-writer', daemon=True).start()
+    scheduler = Scheduler(bot, db, logger)
+    scheduler_task = asyncio.create_task(scheduler.start())
+    stop = asyncio.Event()
+    install_stop_signals(stop)
+
+    ready = [ctx.Event() for _ in range(count)]
+    processes = [
+        ctx.Process(target=_worker_entry, args=(i, count, update_queues[i], requests, responses[i], ready[i]),
+                    name=f"rudeps-worker-{i}", daemon=True)
+        for i in range(count)
+    ]
+    for process in processes:
+        process.start()
+    # Приём апдейтов начинаем только когда все воркеры готовы
+    loop = asyncio.get_event_loop()
+    for event in ready:
+        await loop.run_in_executor(None, event.wait, 60)
+    logger.info(f"Супервизор запущен: воркеров {count}, режим {config.MODE}")
+
+    router = UpdateRouter(update_queues)
+    metrics.gauge('rudeps_worker_queue', 'Апдейты, ждущие воркера', lambda: {
+        str(i): q.qsize() for i, q in enumerate(update_queues)
+    }, ('worker',))
+    metrics_server = await start_metrics_server(logger, config.METRICS_PORT)
+    monitor_task = start_loop_monitor(logger)
+    recorder = start_recorder(logger)
+    submit = recorder.wrap(router.route) if recorder else router.route
+    webhook = None
+    receiver = None
+    try:
+        if config.MODE == 'webhook':
+            webhook = WebhookServer(
+                bot, logger, submit, config.WEBAPP_HOST, config.WEBAPP_PORT, config.WEBHOOK_PATH,
+                config.WEBHOOK_URL, config.WEBHOOK_SECRET,
+                config.WEBHOOK_QUEUE_SIZE, config.WEBHOOK_WORKERS
             )
-        await self._send_main_menu(message.chat.id, user_id)
+            await webhook.start()
+        else:
+            receiver = asyncio.create_task(poll_raw_updates(bot, submit, logger))
+        await serve_until_stopped(stop, receiver)
+    finally:
+        phases = ShutdownPhases(logger, config.SHUTDOWN_DRAIN_TIMEOUT)
+        await stop_receiver(receiver, webhook, phases)
+        if recorder:
+            recorder.close()
+        await phases.run("планировщик", _stop_scheduler(scheduler, scheduler_task))
+
+        async def _stop_workers():
+            for update_queue in update_queues:
+                await loop.run_in_executor(None, update_queue.put, None)
+            # Воркеры сами укладываются в тот же дедлайн; запас — на сброс их буферов
+            for process in processes:
+                await loop.run_in_executor(None, process.join, phases.remaining() + 10)
+                if process.is_alive():
+                    logger.warning(f"Воркер {process.name} не остановился, завершаем принудительно")
+                    process.terminate()
+        await phases.run("воркеры", _stop_workers(), bounded=False)
+
+        async def _close_writer():
+            requests.put(None)
+            for response_queue in responses:
+                response_queue.put(None)
+            await loop.run_in_executor(None, writer.close)
+            await db.close()
+        await phases.run("закрытие БД", _close_writer(), bounded=False)
+        await phases.run("сессия Bot API", bot.session.close(), bounded=False)
+        if metrics_server:
+            await metrics_server.stop()
+        if monitor_task:
+            monitor_task.cancel()
+        phases.finish()
+        logger.info("Супервизор остановлен")
 
 # ==================== ОСНОВНОЙ ЗАПУСК ====================
 
+def create_bot() -> CountingBot:
+    server = TelegramAPIServer.from_base(config.API_SERVER) if config.API_SERVER else TELEGRAM_PRODUCTION
+    return CountingBot(token=config.BOT_TOKEN, parse_mode=ParseMode.MARKDOWN, server=server)
+
+async def _stop_scheduler(scheduler: Scheduler, task: asyncio.Task):
+    await scheduler.stop()
+    # Между проверками расписания задача спит минуту — будить её незачем
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+def create_profiler(logger: Logger) -> Optional[QueryProfiler]:
+    return QueryProfiler(logger, config.SLOW_QUERY_MS) if config.SLOW_QUERY_MS > 0 else None
+
+class RuntimeInspector:
+    """Живые внутренности процесса для /debug и HTTP /debug: размеры структур и очередей,
+    задачи loop'а, потоки, память. Снимок дешёвый; tracemalloc включается только по запросу"""
+    def __init__(self, db: Database, intake: PriorityIntake, handlers: Handlers, state_store: StateStore):
+        self.db = db
+        self.intake = intake
+        self.handlers = handlers
+        self.state_store = state_store
+
+    @staticmethod
+    def _rss_bytes() -> Optional[int]:
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def snapshot(self) -> Dict[str, Any]:
+        tasks = asyncio.all_tasks()
+        by_coro = Counter(getattr(task.get_coro(), '__qualname__', '?') for task in tasks)
+        return {
+            'pid': os.getpid(),
+            'rss_bytes': self._rss_bytes(),
+            'gc_counts': gc.get_count(),
+            'threads': threading.active_count(),
+            'loop_tasks': len(tasks),
+            'loop_tasks_top': dict(by_coro.most_common(10)),
+            'db_executor': {'in_flight': self.db.executor_pending, 'queue': self.db.executor_queue(),
+                            'max_threads': self.db.executor_workers},
+            'user_states': len(self.handlers.state_manager._states),
+            'state_store_pending': len(self.state_store._pending),
+            'rate_limiter_entries': len(self.handlers.rate_limiter),
+            'active_mailboxes': len(self.intake.mailboxes),
+            'intake_backlog': self.intake.backlog(),
+            'background_tasks': len(self.handlers._background_tasks),
+            'caches': {
+                'query_labels': len(_query_labels),
+                'query_plans': len(self.db.profiler._plans) if self.db.profiler else None,
+            },
+            'tracemalloc': tracemalloc.is_tracing(),
+        }
+
+    @staticmethod
+    def memory_top(limit: int) -> List[str]:
+        """Топ мест выделения памяти; вызывать вне event loop'а — снимок занимает время"""
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        lines = []
+        for stat in snapshot.statistics('lineno')[:limit]:
+            frame = stat.traceback[0]
+            lines.append(f"{stat.size / 1024:.0f} КиБ, {stat.count} блоков: {frame.filename}:{frame.lineno}")
+        return lines
+
+    async def memory(self, command: str, limit: int) -> Union[str, List[str]]:
+        """command: '' — топ аллокаций, 'start' / 'stop' — включить / выключить учёт"""
+        if command == 'stop':
+            tracemalloc.stop()
+            return "tracemalloc выключен"
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            return "tracemalloc включён: учитываются выделения с этого момента, повторите запрос позже"
+        if command == 'start':
+            return "tracemalloc уже включён"
+        return await asyncio.get_event_loop().run_in_executor(None, self.memory_top, limit)
+
+def register_gauges(db: Database, intake: PriorityIntake, handlers: Handlers, state_store: StateStore):
+    """Мгновенные значения, снимаемые при каждом опросе /metrics"""
+    metrics.gauge('rudeps_db_executor_queue', "Запросы к БД, ждущие потока executor'а",
+                  db.executor_queue)
+    metrics.gauge('rudeps_intake_backlog', 'Апдейты в очередях приёма', intake.backlog, ('lane',))
+    metrics.gauge('rudeps_active_mailboxes', 'Пользователи с апдейтами в обработке', lambda: len(intake.mailboxes))
+    metrics.gauge('rudeps_background_tasks', 'Фоновые задачи (рассылки, уведомления)',
+                  lambda: len(handlers._background_tasks))
+    metrics.gauge('rudeps_rate_limiter_entries', 'Пользователи, отслеживаемые rate limit', lambda: len(handlers.rate_limiter))
+    metrics.gauge('rudeps_state_store_pending', 'Изменения состояний, ждущие записи', lambda: len(state_store._pending))
+
+def setup_dispatcher(bot: Bot, db: Database, state_manager: UserStateManager,
+                     logger: Logger) -> Tuple[Dispatcher, Handlers]:
+    storage = MemoryStorage()
+    dp = Dispatcher(bot, storage=storage)
+    rate_limiter = RateLimiter(config.RATE_LIMIT_IDLE_TTL)
+    if metrics.enabled:
+        dp.middleware.setup(MetricsMiddleware())
+    if tracer.enabled:
+        dp.middleware.setup(TracingMiddleware())
+    # Порядок важен: лимит отсекает флуд до чтения пользователя из БД
+    dp.middleware.setup(RateLimitMiddleware(rate_limiter, config.RATE_LIMIT_USER_RATE, config.RATE_LIMIT_USER_BURST))
+    dp.middleware.setup(UserContextMiddleware(db))
+    handlers = Handlers(dp, bot, db, state_manager, logger, rate_limiter)
+    handlers.register_all()
+    return dp, handlers
+
 async def main():
     logger = Logger(config.LOG_FILE)
     logger.info("=" * 50)
     logger.info("Запуск RudepsBot v4.1 (исправленная версия)")
     logger.info("=" * 50)
 
-    bot = Bot(token=config.BOT_TOKEN, parse_mode=ParseMode.MARKDOWN)
-    storage = MemoryStorage()
-    dp = Dispatcher(bot, storage=storage)
-
-    db = Database(config.DATABASE_FILE)
-    state_manager = UserStateManager()
+    if config.WORKERS > 1:
+        await run_supervisor(logger, config.WORKERS)
+        logger.close()
+        return
+
+    start_tracing(config.TRACE_FILE)
+    bot = create_bot()
+    db = Database(config.DATABASE_FILE, profiler=create_profiler(logger))
+    state_store = StateStore(config.STATE_DB_FILE, logger,
+                             config.STATE_FLUSH_INTERVAL, config.STATE_FLUSH_BATCH)
+    state_manager = UserStateManager(state_store)
+    logger.info(f"Восстановлено состояний диалогов: {len(state_manager._states)}")
+    dp, handlers = setup_dispatcher(bot, db, state_manager, logger)
     scheduler = Scheduler(bot, db, logger)
 
-    handlers = Handlers(dp, bot, db, state_manager, logger)
-    handlers.register_all()
-
-    asyncio.create_task(scheduler.start())
-
+    scheduler_task = asyncio.create_task(scheduler.start())
+    store_task = asyncio.create_task(state_store.run())
+    stop = asyncio.Event()
+    install_stop_signals(stop)
+
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    mailboxes = UserMailboxes(dp, logger, config.MAILBOX_MAX_PENDING, config.MAX_CONCURRENT_UPDATES)
+    intake = PriorityIntake(mailboxes, bot, logger, config.INTAKE_LANES, config.MAX_CONCURRENT_UPDATES,
+                            config.MAILBOX_MAX_PENDING)
+    intake_task = asyncio.create_task(intake.run())
+    register_gauges(db, intake, handlers, state_store)
+    handlers.inspector = RuntimeInspector(db, intake, handlers, state_store)
+    metrics_server = await start_metrics_server(logger, config.METRICS_PORT, handlers.inspector)
+    monitor_task = start_loop_monitor(logger)
+    await handlers.resume_broadcasts()
+    recorder = start_recorder(logger)
+    submit = recorder.wrap(intake.submit) if recorder else intake.submit
+    webhook = None
+    receiver = None
     try:
-        await dp.start_polling()
+        if config.MODE == 'webhook':
+            webhook = WebhookServer(
+                bot, logger, submit, config.WEBAPP_HOST, config.WEBAPP_PORT, config.WEBHOOK_PATH,
+                config.WEBHOOK_URL, config.WEBHOOK_SECRET,
+                config.WEBHOOK_QUEUE_SIZE, config.WEBHOOK_WORKERS
+            )
+            await webhook.start()
+        else:
+            receiver = asyncio.create_task(poll_raw_updates(bot, submit, logger))
+        await serve_until_stopped(stop, receiver)
+        logger.info("Получен сигнал остановки")
     except Exception as e:
         logger.critical(f"Критическая ошибка: {e}")
         raise
     finally:
-        await scheduler.stop()
-        await dp.storage.close()
-        await dp.storage.wait_closed()
-        await bot.session.close()
+        # Порядок: сначала перестаём принимать, затем дообрабатываем принятое и только потом закрываем ресурсы
+        phases = ShutdownPhases(logger, config.SHUTDOWN_DRAIN_TIMEOUT)
+        await stop_receiver(receiver, webhook, phases)
+        if recorder:
+            recorder.close()
+        await phases.run("планировщик", _stop_scheduler(scheduler, scheduler_task))
+        await drain_bot_stack(phases, intake, intake_task, handlers, state_store, store_task, dp, db)
+        await phases.run("сессия Bot API", bot.session.close(), bounded=False)
+        if metrics_server:
+            await metrics_server.stop()
+        if monitor_task:
+            monitor_task.cancel()
+        tracer.close()
+        phases.finish()
+        logger.info(f"Вызовов Bot API на апдейт в среднем: {bot.average_calls_per_update():.2f}")
         logger.info("Бот остановлен")
+        logger.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+Локальная подмена Telegram Bot API для офлайн-прогонов RudepsBot.
+
+Стенд поднимает фейковый Bot API, запускает bot.py отдельным процессом
+(TELEGRAM_API_SERVER указывает на стенд) и гоняет синтетических пользователей
+в замкнутом цикле: апдейт -> ждём первый ответ бота в этот чат -> пауза -> следующий.
+Апдейты доставляются либо POST-запросами в webhook, либо через getUpdates,
+поэтому оба режима сравниваются на одной и той же нагрузке:
+
+    python fake_telegram.py --mode polling --users 200 --duration 30
+    python fake_telegram.py --mode webhook --users 200 --duration 30
+    python fake_telegram.py --mode polling --workers 4 --users 200 --duration 30
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+from typing import Deque, Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+TOKEN = "123456:FAKE-TOKEN"
+WEBHOOK_SECRET = "fake-secret"
+# Методы, которые считаются ответом пользователю
+REPLY_METHODS = {'sendMessage', 'sendPhoto', 'sendDocument', 'editMessageText', 'answerCallbackQuery'}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class FakeTelegram:
+    """Минимальный Bot API: очередь getUpdates, ответы на send*-методы, учёт вызовов"""
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.port = port or free_port()
+        self.calls: Counter = Counter()
+        self.ready = asyncio.Event()
+        self._updates: Deque[dict] = deque()
+        self._updates_event = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._callback_chats: Dict[str, int] = {}
+        self._waiters: Dict[int, Deque[asyncio.Future]] = defaultdict(deque)
+        self._runner: Optional[web.AppRunner] = None
+        self.webhook_url: Optional[str] = None
+        self.webhook_target: Optional[str] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Сообщения с этим префиксом — рассылка: считаются отдельно и не завершают ожидание ответа
+        self.broadcast_marker: Optional[str] = None
+        self.broadcast_received = 0
+        # Чаты, где ответом считается только reply: туда же приходят уведомления (админы)
+        self.strict_chats: set = set()
+        self.file_size = 64 * 1024
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    # ---------- сервер ----------
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route('*', '/bot{token}/{method}', self._handle_method)
+        app.router.add_get('/file/bot{token}/{path:.+}', self._handle_file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._session = aiohttp.ClientSession()
+
+    async def stop(self):
+        if self._session:
+            await self._session.close()
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _params(self, request: web.Request) -> dict:
+        if request.content_type == 'application/json':
+            return await request.json()
+        params = dict(await request.post())
+        params.update(request.query)
+        return params
+
+    async def _handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = await self._params(request)
+        self.calls[method] += 1
+        handler = getattr(self, f"api_{method}", None)
+        result = await handler(params) if handler else True
+        if method in REPLY_METHODS:
+            self._resolve_reply(params)
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _handle_file(self, request: web.Request) -> web.Response:
+        self.calls['downloadFile'] += 1
+        # Содержимое уникально для пути: проверка дубликатов по хэшу не срабатывает
+        path = request.match_info['path'].encode()
+        return web.Response(body=path + b'\0' * max(0, self.file_size - len(path)))
+
+    def _resolve_reply(self, params: dict):
+        text = params.get('text') or ''
+        if self.broadcast_marker and text.startswith(self.broadcast_marker):
+            self.broadcast_received += 1
+            return
+        chat_id = params.get('chat_id')
+        if chat_id is None:
+            chat_id = self._callback_chats.pop(params.get('callback_query_id'), None)
+        elif int(chat_id) in self.strict_chats and not params.get('reply_to_message_id'):
+            return
+        if chat_id is None:
+            return
+        waiters = self._waiters.get(int(chat_id))
+        while waiters:
+            future = waiters.popleft()
+            if not future.done():
+                future.set_result(time.perf_counter())
+                break
+
+    def _message(self, chat_id, text: str = '') -> dict:
+        return {
+            'message_id': next(self._message_ids), 'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'}, 'text': text,
+        }
+
+    # ---------- методы Bot API ----------
+
+    async def api_getMe(self, params: dict) -> dict:
+        return {'id': int(TOKEN.split(':')[0]), 'is_bot': True, 'first_name': 'RudepsBot', 'username': 'RudepsBot'}
+
+    async def api_setWebhook(self, params: dict) -> bool:
+        self.webhook_url = params.get('url')
+        self.ready.set()
+        return True
+
+    async def api_getUpdates(self, params: dict) -> List[dict]:
+        self.ready.set()
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        while self._updates and self._updates[0]['update_id'] < offset:
+            self._updates.popleft()
+        if not self._updates and timeout:
+            self._updates_event.clear()
+            try:
+                await asyncio.wait_for(self._updates_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self._updates, limit))
+
+    async def api_sendMessage(self, params: dict) -> dict:
+        return self._message(params['chat_id'], params.get('text', ''))
+
+    async def api_editMessageText(self, params: dict) -> dict:
+        return self._message(params.get('chat_id') or 0, params.get('text', ''))
+
+    async def api_sendPhoto(self, params: dict) -> dict:
+        return self._message(params['chat_id'])
+
+    async def api_sendDocument(self, params: dict) -> dict:
+        return self._message(params['chat_id'])
+
+    async def api_getFile(self, params: dict) -> dict:
+        file_id = params['file_id']
+        return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': self.file_size,
+                'file_path': f"photos/{file_id}.jpg"}
+
+    # ---------- апдейты ----------
+
+    def message_update(self, user_id: int, text: Optional[str] = None, **extra) -> dict:
+        message = {
+            'message_id': next(self._message_ids), 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}"},
+        }
+        if text is not None:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        message.update(extra)
+        return {'message': message}
+
+    def photo_update(self, user_id: int, file_id: str) -> dict:
+        return self.message_update(user_id, photo=[{
+            'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 720,
+            'file_size': self.file_size,
+        }])
+
+    def expect_callback(self, query_id: str, chat_id: int):
+        """answerCallbackQuery на этот запрос будет считаться ответом в чат chat_id"""
+        self._callback_chats[query_id] = chat_id
+
+    def callback_update(self, user_id: int, data: str) -> dict:
+        query_id = str(next(self._message_ids))
+        self.expect_callback(query_id, user_id)
+        return {'callback_query': {
+            'id': query_id, 'chat_instance': str(user_id), 'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"},
+            'message': self._message(user_id),
+        }}
+
+    async def deliver(self, update: dict):
+        # update_id выдаётся в момент доставки, чтобы offset getUpdates оставался монотонным
+        update['update_id'] = next(self._update_ids)
+        if self.webhook_url:
+            async with self._session.post(
+                self.webhook_target, json=update,
+                headers={'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+            ) as resp:
+                if resp.status != 200:
+                    raise RuntimeError(f"webhook ответил {resp.status}")
+        else:
+            self._updates.append(update)
+            self._updates_event.set()
+
+    async def send_and_wait(self, chat_id: int, update: dict, timeout: float = 10) -> float:
+        """Доставляет апдейт и ждёт первого ответа в чат; возвращает задержку в секундах"""
+        future = asyncio.get_event_loop().create_future()
+        self._waiters[chat_id].append(future)
+        started = time.perf_counter()
+        await self.deliver(update)
+        finished = await asyncio.wait_for(future, timeout)
+        return finished - started
+
+
+async def start_bot_process(api: FakeTelegram, mode: str, workdir: str,
+                            extra_env: Optional[Dict[str, str]] = None,
+                            bot_path: Optional[str] = None) -> asyncio.subprocess.Process:
+    """Запускает bot.py против стенда; рабочая папка изолирует БД и логи прогона"""
+    env = dict(os.environ)
+    env.update({
+        'BOT_TOKEN': TOKEN,
+        'TELEGRAM_API_SERVER': api.base_url,
+        'BOT_MODE': mode,
+        'WEBHOOK_SECRET': WEBHOOK_SECRET,
+        'WEBAPP_PORT': str(free_port()),
+    })
+    if mode == 'webhook':
+        # Адрес нужен только чтобы бот вызвал setWebhook; апдейты стенд шлёт напрямую
+        env['WEBHOOK_URL'] = 'https://bot.invalid'
+    env.update(extra_env or {})
+    api.webhook_target = f"http://127.0.0.1:{env['WEBAPP_PORT']}{env.get('WEBHOOK_PATH', '/webhook')}"
+    bot_path = bot_path or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, bot_path, cwd=workdir, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+    )
+    await asyncio.wait_for(api.ready.wait(), 30)
+    if mode == 'webhook':
+        # setWebhook вызывается после старта сервера, но даём сокету время на accept
+        await asyncio.sleep(0.2)
+    return process
+
+
+async def stop_bot_process(process: asyncio.subprocess.Process):
+    if process.returncode is None:
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), 15)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+
+async def synthetic_user(api: FakeTelegram, user_id: int, deadline: float, think: float,
+                         latencies: List[float], errors: Counter):
+    script = [api.message_update(user_id, '/start'), api.callback_update(user_id, 'accept_rules')]
+    loop_texts = itertools.cycle(["❓ Помощь", "💰 Мой баланс", "/stats"])
+    while time.perf_counter() < deadline:
+        update = script.pop(0) if script else api.message_update(user_id, next(loop_texts))
+        try:
+            latencies.append(await api.send_and_wait(user_id, update))
+        except asyncio.TimeoutError:
+            errors['timeout'] += 1
+        except Exception as e:
+            errors[type(e).__name__] += 1
+        await asyncio.sleep(think)
+
+
+async def run(args) -> dict:
+    api = FakeTelegram()
+    await api.start()
+    workdir = tempfile.mkdtemp(prefix='rudeps-fake-')
+    process = await start_bot_process(api, args.mode, workdir, {'BOT_WORKERS': str(args.workers)})
+    latencies: List[float] = []
+    errors: Counter = Counter()
+    started = time.perf_counter()
+    deadline = started + args.duration
+    try:
+        await asyncio.gather(*(
+            synthetic_user(api, 1000 + i, deadline, args.think, latencies, errors)
+            for i in range(args.users)
+        ))
+    finally:
+        elapsed = time.perf_counter() - started
+        await stop_bot_process(process)
+        await api.stop()
+    return {
+        'mode': args.mode,
+        'workers': args.workers,
+        'users': args.users,
+        'elapsed_s': round(elapsed, 2),
+        'updates': len(latencies),
+        'updates_per_s': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'errors': dict(errors),
+        'api_calls': dict(api.calls),
+        'workdir': workdir,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default='polling')
+    parser.add_argument('--workers', type=int, default=1, help='процессов-воркеров бота (BOT_WORKERS)')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=20, help='секунды нагрузки')
+    parser.add_argument('--think', type=float, default=0.5, help='пауза пользователя между действиями')
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
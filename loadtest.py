@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный прогон RudepsBot целиком офлайн.
+
+Поднимает фейковый Bot API (fake_telegram.FakeTelegram: getUpdates, sendMessage,
+getFile, скачивание файлов), запускает настоящий bot.py в отдельной рабочей папке
+и гоняет синтетических пользователей по сценариям:
+
+    onboarding  /start и принятие правил (один раз на пользователя)
+    browse      кнопки меню и /stats
+    photo       «Проверить комментарий» + загрузка скриншота (getFile и скачивание)
+    withdraw    вывод средств до создания заявки
+    broadcast   админ проходит мастер рассылки; получатели — те же пользователи
+
+После онбординга пользователям выдаётся баланс прямо в БД, чтобы вывод доходил до
+заявки. В отчёте — пропускная способность, p50/p99 по сценариям, ошибки, вызовы
+Bot API и размер БД. Одинаковые параметры дают сравнимые цифры между релизами:
+
+    python loadtest.py --users 200 --duration 60
+    python loadtest.py --users 200 --duration 60 --mix browse=1,photo=1,withdraw=1 --workers 4
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+from fake_telegram import FakeTelegram, percentile, start_bot_process, stop_bot_process
+
+ADMIN_ID = 1
+FIRST_USER_ID = 1000
+BROADCAST_MARKER = "[loadtest]"
+BROWSE_TEXTS = ["💰 Мой баланс", "❓ Помощь", "/stats"]
+
+
+class LoadTest:
+    def __init__(self, api: FakeTelegram, args):
+        self.api = api
+        self.args = args
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self._photo_ids = itertools.count(1)
+        self._rng = random.Random(args.seed)
+
+    async def step(self, scenario: str, user_id: int, update: dict):
+        try:
+            latency = await self.api.send_and_wait(user_id, update, self.args.timeout)
+        except asyncio.TimeoutError:
+            self.errors[f"{scenario}:timeout"] += 1
+            return False
+        except Exception as e:
+            self.errors[f"{scenario}:{type(e).__name__}"] += 1
+            return False
+        self.latencies[scenario].append(latency)
+        return True
+
+    def text(self, user_id: int, text: str) -> dict:
+        return self.api.message_update(user_id, text)
+
+    # ---------- сценарии ----------
+
+    async def onboarding(self, user_id: int):
+        if await self.step('onboarding', user_id, self.text(user_id, '/start')):
+            await self.step('onboarding', user_id, self.api.callback_update(user_id, 'accept_rules'))
+
+    async def browse(self, user_id: int):
+        await self.step('browse', user_id, self.text(user_id, self._rng.choice(BROWSE_TEXTS)))
+
+    async def photo(self, user_id: int):
+        if await self.step('photo', user_id, self.text(user_id, "📝 Проверить комментарий")):
+            file_id = f"loadtest-{user_id}-{next(self._photo_ids)}"
+            await self.step('photo', user_id, self.api.photo_update(user_id, file_id))
+
+    async def withdraw(self, user_id: int):
+        script = [
+            self.text(user_id, "💎 Вывод средств"),
+            self.api.callback_update(user_id, 'withdraw_phone'),
+            self.text(user_id, "100"),
+            self.text(user_id, "+79990000000"),
+        ]
+        for update in script:
+            if not await self.step('withdraw', user_id, update):
+                return
+
+    async def broadcast(self, admin_id: int):
+        script = [
+            "👥 Рассылка", "2️⃣ Своё количество", str(self.args.broadcast_size), "3️⃣ Случайные",
+            f"{BROADCAST_MARKER} нагрузочная рассылка", "-", "0",
+        ]
+        for text in script:
+            if not await self.step('broadcast', admin_id, self.text(admin_id, text)):
+                return
+
+    # ---------- пользователи ----------
+
+    async def user_loop(self, user_id: int, deadline: float, mix: Dict[str, int]):
+        scenarios = list(mix)
+        weights = [mix[name] for name in scenarios]
+        while time.perf_counter() < deadline:
+            scenario = self._rng.choices(scenarios, weights)[0]
+            await getattr(self, scenario)(user_id)
+            await asyncio.sleep(self.args.think)
+
+    async def admin_loop(self, deadline: float):
+        while time.perf_counter() < deadline:
+            await self.broadcast(ADMIN_ID)
+            await asyncio.sleep(self.args.broadcast_interval)
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('browse', 'photo', 'withdraw'):
+            raise argparse.ArgumentTypeError(f"неизвестный сценарий: {name}")
+        mix[name] = int(weight or 1)
+    return mix
+
+
+def seed_balances(db_path: str, amount: int):
+    """Деньги на вывод: синтетические пользователи их иначе не заработают.
+    Начисление идёт и в денежный журнал, иначе сверка балансов покажет расхождения"""
+    with sqlite3.connect(db_path, timeout=30) as conn:
+        conn.execute('''
+            INSERT INTO ledger (user_id, amount, held, kind, created_at)
+            SELECT user_id, ? - money_balance, 0, 'admin_credit', CAST(strftime('%s', 'now') AS INTEGER)
+            FROM users WHERE user_id >= ? AND money_balance != ?
+        ''', (amount, FIRST_USER_ID, amount))
+        conn.execute("UPDATE users SET money_balance = ? WHERE user_id >= ?", (amount, FIRST_USER_ID))
+
+
+def db_size(workdir: str, name: str = 'bot_database.db') -> int:
+    path = os.path.join(workdir, name)
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+
+async def run(args) -> dict:
+    api = FakeTelegram()
+    api.broadcast_marker = BROADCAST_MARKER
+    api.file_size = args.photo_kb * 1024
+    await api.start()
+    workdir = tempfile.mkdtemp(prefix='rudeps-load-')
+    process = await start_bot_process(api, 'polling', workdir, {
+        'BOT_WORKERS': str(args.workers),
+        'ADMIN_IDS': str(ADMIN_ID),
+    })
+    test = LoadTest(api, args)
+    user_ids = [FIRST_USER_ID + i for i in range(args.users)]
+    try:
+        await asyncio.gather(*(test.onboarding(uid) for uid in [ADMIN_ID] + user_ids))
+        # Дальше в чат админа идут и уведомления (фото, заявки) — ответом считаем только reply
+        api.strict_chats.add(ADMIN_ID)
+        seed_balances(os.path.join(workdir, 'bot_database.db'), 1_000_000)
+
+        started = time.perf_counter()
+        deadline = started + args.duration
+        loops = [test.user_loop(uid, deadline, args.mix) for uid in user_ids]
+        if args.broadcast_interval > 0:
+            loops.append(test.admin_loop(deadline))
+        await asyncio.gather(*loops)
+        elapsed = time.perf_counter() - started
+    finally:
+        await stop_bot_process(process)
+        await api.stop()
+
+    measured = {name: values for name, values in test.latencies.items() if name != 'onboarding'}
+    everything = [v for values in measured.values() for v in values]
+    return {
+        'users': args.users,
+        'workers': args.workers,
+        'mix': args.mix,
+        'elapsed_s': round(elapsed, 2),
+        'updates': len(everything),
+        'updates_per_s': round(len(everything) / elapsed, 1),
+        'p50_ms': round(percentile(everything, 50) * 1000, 1),
+        'p99_ms': round(percentile(everything, 99) * 1000, 1),
+        'scenarios': {
+            name: {
+                'updates': len(values),
+                'p50_ms': round(percentile(values, 50) * 1000, 1),
+                'p99_ms': round(percentile(values, 99) * 1000, 1),
+            }
+            for name, values in sorted(test.latencies.items())
+        },
+        'broadcast_messages': api.broadcast_received,
+        'errors': dict(test.errors),
+        'api_calls': dict(api.calls),
+        'db_size_bytes': db_size(workdir),
+        'workdir': workdir,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=30, help='секунды нагрузки после онбординга')
+    parser.add_argument('--workers', type=int, default=1, help='процессов-воркеров бота (BOT_WORKERS)')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('browse=6,photo=3,withdraw=1'),
+                        help='веса сценариев пользователя, например browse=6,photo=3,withdraw=1')
+    parser.add_argument('--think', type=float, default=1.0,
+                        help='пауза пользователя между сценариями (фото не чаще ANTIFLOOD_SECONDS)')
+    parser.add_argument('--broadcast-interval', type=float, default=10,
+                        help='секунды между рассылками админа (0 — без рассылок)')
+    parser.add_argument('--broadcast-size', type=int, default=50, help='получателей в одной рассылке')
+    parser.add_argument('--photo-kb', type=int, default=64, help='размер скачиваемого скриншота')
+    parser.add_argument('--timeout', type=float, default=10, help='сколько ждать ответа бота')
+    parser.add_argument('--seed', type=int, default=1, help='зерно выбора сценариев')
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Проигрыш записанного потока апдейтов (RECORD_FILE) против фейкового Bot API.
+
+Запись (см. UpdateRecorder в bot.py) подаётся настоящему bot.py через
+fake_telegram.FakeTelegram в исходном темпе, ускоренно или без пауз. Бот работает
+на копии базы: ID пользователей в ней заменяются той же функцией, что и в записи,
+поэтому записанные пользователи узнаются ботом (нужна та же соль, что у записи —
+RECORD_SALT или токен бота). Без --db прогон идёт на пустой базе.
+
+Задержка апдейта — от доставки до первого ответа бота в этот чат; апдейты, на
+которые бот не ответил за --timeout, считаются отдельно (флуд-контроль, сброс
+нагрузки). Так пиковый час из продакшена воспроизводится офлайн:
+
+    python replay.py updates.jsonl --db bot_database.db --speed 1
+    python replay.py updates.jsonl --db bot_database.db --speed 20 --start 2026-10-12T08:00 --duration 3600
+    python replay.py updates.jsonl --speed max --workers 4
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import bot
+from fake_telegram import FakeTelegram, percentile, start_bot_process, stop_bot_process
+
+# Таблицы и колонки с ID пользователей
+USER_ID_COLUMNS = [
+    ('users', 'user_id'), ('used_photos', 'user_id'), ('comments_log', 'user_id'),
+    ('comments_weekly', 'user_id'), ('comments_monthly', 'user_id'),
+    ('withdrawals', 'user_id'), ('broadcasts', 'admin_id'), ('ledger', 'user_id'),
+    ('balance_adjustments', 'user_id'), ('balance_adjustments', 'admin_id'),
+]
+# Свободный текст: реквизиты выплат, причины отказа, тексты и ссылки рассылок, заметки корректировок
+TEXT_COLUMNS = [
+    ('withdrawals', 'details'), ('withdrawals', 'reject_reason'),
+    ('broadcasts', 'message_text'), ('broadcasts', 'link'), ('balance_adjustments', 'note'),
+]
+
+
+def load_log(path: str, start: Optional[float], duration: Optional[float],
+             limit: Optional[int]) -> Tuple[List[int], List[Tuple[float, dict]]]:
+    """Админы из заголовков и записи (время приёма, апдейт) в выбранном окне"""
+    admins = set()
+    entries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'v' in record:
+                admins.update(record.get('admins', []))
+                continue
+            t = record['t']
+            if start is not None and t < start:
+                continue
+            if start is not None and duration is not None and t >= start + duration:
+                break
+            entries.append((t, record['u']))
+            if limit and len(entries) >= limit:
+                break
+    return sorted(admins), entries
+
+
+def prepare_database(source: str, target: str, salt: str):
+    """Копия базы с анонимизированными ID и свободным текстом, замаскированным так же,
+    как в записи; незаконченные рассылки не возобновляются"""
+    with sqlite3.connect(source) as src, sqlite3.connect(target) as dst:
+        src.backup(dst)
+    conn = sqlite3.connect(target)
+    conn.create_function('anon', 1, lambda uid: None if uid is None else bot.anonymize_user_id(uid, salt))
+    conn.create_function('mask', 1, lambda text: None if text is None else bot.mask_text(str(text), salt))
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for table, column in USER_ID_COLUMNS:
+        if table in tables:
+            conn.execute(f"UPDATE {table} SET {column} = anon({column})")
+    for table, column in TEXT_COLUMNS:
+        if table in tables:
+            conn.execute(f"UPDATE {table} SET {column} = mask({column}) WHERE {column} IS NOT NULL")
+    if 'users' in tables:
+        conn.execute("UPDATE users SET username = NULL, first_name = 'User', last_name = NULL")
+    if 'broadcasts' in tables:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(broadcasts)")}
+        clear = ", recipient_ids = NULL" if 'recipient_ids' in columns else ""
+        conn.execute(f"UPDATE broadcasts SET status = 'done', pending_user_ids = NULL{clear} WHERE status != 'done'")
+    conn.commit()
+    conn.close()
+
+
+def update_kind(update: dict) -> str:
+    if 'callback_query' in update:
+        return 'callback'
+    message = update['message']
+    if 'photo' in message or 'document' in message:
+        return 'photo'
+    text = message.get('text', '')
+    if text.startswith('/'):
+        return 'command'
+    return 'button' if text in bot.KEYBOARD_TEXTS else 'text'
+
+
+def update_chat(update: dict) -> int:
+    if 'callback_query' in update:
+        return update['callback_query']['from']['id']
+    return update['message']['chat']['id']
+
+
+class Replay:
+    def __init__(self, api: FakeTelegram, speed: Optional[float], max_gap: float, timeout: float):
+        self.api = api
+        self.speed = speed
+        self.max_gap = max_gap
+        self.timeout = timeout
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.no_reply: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.max_behind = 0.0
+
+    async def deliver(self, update: dict):
+        kind = update_kind(update)
+        chat_id = update_chat(update)
+        if 'callback_query' in update:
+            self.api.expect_callback(update['callback_query']['id'], chat_id)
+        try:
+            self.latencies[kind].append(await self.api.send_and_wait(chat_id, update, self.timeout))
+        except asyncio.TimeoutError:
+            self.no_reply[kind] += 1
+        except Exception as e:
+            self.errors[type(e).__name__] += 1
+
+    async def run(self, entries: List[Tuple[float, dict]]):
+        """Доставка по расписанию записи; паузы длиннее max_gap сжимаются до max_gap"""
+        tasks = []
+        started = time.perf_counter()
+        offset = 0.0
+        previous = entries[0][0] if entries else 0.0
+        for t, update in entries:
+            offset += min(t - previous, self.max_gap)
+            previous = t
+            if self.speed:
+                delay = started + offset / self.speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    self.max_behind = max(self.max_behind, -delay)
+            tasks.append(asyncio.ensure_future(self.deliver(update)))
+        await asyncio.gather(*tasks)
+        return offset
+
+
+def parse_speed(value: str) -> Optional[float]:
+    if value == 'max':
+        return None
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("скорость должна быть больше нуля или max")
+    return speed
+
+
+async def run(args) -> dict:
+    start = datetime.fromisoformat(args.start).timestamp() if args.start else None
+    admins, entries = load_log(args.log, start, args.duration, args.limit)
+    if not entries:
+        raise SystemExit("в выбранном окне нет апдейтов")
+    workdir = tempfile.mkdtemp(prefix='rudeps-replay-')
+    if args.db:
+        prepare_database(args.db, os.path.join(workdir, 'bot_database.db'), args.salt)
+
+    api = FakeTelegram()
+    await api.start()
+    # В чаты админов идут и уведомления — ответом считаем только reply
+    api.strict_chats.update(admins)
+    process = await start_bot_process(api, args.mode, workdir, {
+        'BOT_WORKERS': str(args.workers),
+        'ADMIN_IDS': ','.join(map(str, admins)),
+        'RECORD_FILE': '',
+    })
+    replay = Replay(api, args.speed, args.max_gap, args.timeout)
+    try:
+        started = time.perf_counter()
+        recorded_span = await replay.run(entries)
+        elapsed = time.perf_counter() - started
+    finally:
+        await stop_bot_process(process)
+        await api.stop()
+
+    everything = [v for values in replay.latencies.values() for v in values]
+    return {
+        'updates': len(entries),
+        'users': len({update_chat(update) for _, update in entries}),
+        'speed': args.speed or 'max',
+        'recorded_s': round(recorded_span, 2),
+        'elapsed_s': round(elapsed, 2),
+        'updates_per_s': round(len(entries) / elapsed, 1),
+        'max_behind_schedule_s': round(replay.max_behind, 3),
+        'p50_ms': round(percentile(everything, 50) * 1000, 1),
+        'p99_ms': round(percentile(everything, 99) * 1000, 1),
+        'kinds': {
+            kind: {
+                'replied': len(values),
+                'no_reply': replay.no_reply[kind],
+                'p50_ms': round(percentile(values, 50) * 1000, 1),
+                'p99_ms': round(percentile(values, 99) * 1000, 1),
+            }
+            for kind, values in sorted(replay.latencies.items())
+        },
+        'no_reply': sum(replay.no_reply.values()),
+        'errors': dict(replay.errors),
+        'api_calls': dict(api.calls),
+        'workdir': workdir,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('log', help='файл записи апдейтов (RECORD_FILE)')
+    parser.add_argument('--db', help='база для копии (например, бэкап продакшена)')
+    parser.add_argument('--salt', default=bot.config.RECORD_SALT or bot.config.BOT_TOKEN,
+                        help='соль анонимизации записи (по умолчанию RECORD_SALT или BOT_TOKEN)')
+    parser.add_argument('--speed', type=parse_speed, default=1.0, help='1 — как в записи, N — в N раз быстрее, max — без пауз')
+    parser.add_argument('--start', help='начало окна, локальное время ISO (2026-10-12T08:00)')
+    parser.add_argument('--duration', type=float, help='длина окна в секундах записи')
+    parser.add_argument('--limit', type=int, help='не больше стольких апдейтов')
+    parser.add_argument('--max-gap', type=float, default=30, help='паузы записи длиннее этого сжимаются')
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default='polling')
+    parser.add_argument('--workers', type=int, default=1, help='процессов-воркеров бота (BOT_WORKERS)')
+    parser.add_argument('--timeout', type=float, default=30, help='сколько ждать ответа на апдейт')
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()